@@ -50,6 +50,12 @@ class FluxGenerator:
             self.pulid_model.face_helper.device = torch.device("cuda")
             self.pulid_model.device = torch.device("cuda")
         self.pulid_model.load_pretrain(args.pretrained_model, version=args.version)
+        if aggressive_offload and args.offload_budget_gb is not None:
+            if args.fp8:
+                # the quantized blocks can't be streamed, see `BlockStreamer`
+                print("--offload_budget_gb is ignored with --fp8")
+            else:
+                self.model.enable_block_streaming(memory_budget=int(args.offload_budget_gb * 2**30))
 
     @torch.inference_mode()
     def generate_image(
@@ -311,6 +317,8 @@ if __name__ == "__main__":
     parser.add_argument("--device", type=str, default="cuda", help="Device to use")
     parser.add_argument("--offload", action="store_true", help="Offload model to CPU when not in use")
     parser.add_argument("--aggressive_offload", action="store_true", help="Offload model more aggressively to CPU when not in use, for 24G GPUs")
+    parser.add_argument("--offload_budget_gb", type=float, default=None,
+                        help="with aggressive_offload, GPU memory (GiB) for the streamed transformer blocks")
     parser.add_argument("--fp8", action="store_true", help="use flux-dev-fp8 model")
     parser.add_argument("--onnx_provider", type=str, default="gpu", choices=["gpu", "cpu"],
                         help="set onnx_provider to cpu (default gpu) can help reduce RAM usage, and when combined with"
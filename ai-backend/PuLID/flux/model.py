@@ -1,4 +1,5 @@
 from dataclasses import dataclass
+from itertools import islice
 
 import torch
 from torch import Tensor, nn
@@ -11,6 +12,7 @@ from flux.modules.layers import (
     SingleStreamBlock,
     timestep_embedding,
 )
+from flux.offload import BlockStreamer
 
 DEVICE = torch.device("cuda")
 
@@ -84,6 +86,42 @@ class Flux(nn.Module):
         self.pulid_double_interval = 2
         self.pulid_single_interval = 4
 
+        # used by aggressive_offload, see `enable_block_streaming`
+        self.block_streamer = None
+
+    def enable_block_streaming(self, device=DEVICE, window: int = None, memory_budget: int = None):
+        """
+        Keeps the transformer blocks on the CPU and streams them to `device` while the model
+        runs, with `window` blocks (or as many as fit into `memory_budget` bytes) resident.
+        """
+        blocks = [*self.double_blocks, *self.single_blocks]
+        if window is None:
+            window = 2 if memory_budget is None else BlockStreamer.window_from_budget(blocks, memory_budget)
+        self.block_streamer = BlockStreamer(blocks, device, window=window)
+
+    def _moved_blocks(self):
+        """
+        Yields the blocks for aggressive_offload when they can't be streamed (e.g. quantized
+        weights): the double blocks are moved to the gpu at once, the single blocks in two halves,
+        and every block is moved back to the cpu once it has run.
+        """
+        self.double_blocks.to(DEVICE)
+        yield from self.double_blocks
+        self.double_blocks.cpu()
+
+        half = len(self.single_blocks) // 2
+        for i in range(half):
+            self.single_blocks[i].to(DEVICE)
+        for i, block in enumerate(self.single_blocks):
+            if i == half:
+                # put first half of the single blocks to cpu and last half to gpu
+                for j in range(half):
+                    self.single_blocks[j].cpu()
+                for j in range(half, len(self.single_blocks)):
+                    self.single_blocks[j].to(DEVICE)
+            yield block
+        self.single_blocks.cpu()
+
     def forward(
         self,
         img: Tensor,
@@ -115,28 +153,22 @@ class Flux(nn.Module):
 
         ca_idx = 0
         if aggressive_offload:
-            self.double_blocks = self.double_blocks.to(DEVICE)
-        for i, block in enumerate(self.double_blocks):
+            # stream the blocks to the gpu while they run instead of moving them all at once
+            if self.block_streamer is None and BlockStreamer.can_stream([*self.double_blocks, *self.single_blocks]):
+                self.enable_block_streaming()
+            blocks = iter(self.block_streamer) if self.block_streamer is not None else self._moved_blocks()
+        else:
+            blocks = iter([*self.double_blocks, *self.single_blocks])
+
+        for i, block in enumerate(islice(blocks, len(self.double_blocks))):
             img, txt = block(img=img, txt=txt, vec=vec, pe=pe)
 
             if i % self.pulid_double_interval == 0 and id is not None:
                 img = img + id_weight * self.pulid_ca[ca_idx](id, img)
                 ca_idx += 1
-        if aggressive_offload:
-            self.double_blocks.cpu()
 
         img = torch.cat((txt, img), 1)
-        if aggressive_offload:
-            # put half of the single blcoks to gpu
-            for i in range(len(self.single_blocks) // 2):
-                self.single_blocks[i] = self.single_blocks[i].to(DEVICE)
-        for i, block in enumerate(self.single_blocks):
-            if aggressive_offload and i == len(self.single_blocks)//2:
-                # put first half of the single blcoks to cpu and last half to gpu
-                for j in range(len(self.single_blocks) // 2):
-                    self.single_blocks[j].cpu()
-                for j in range(len(self.single_blocks) // 2, len(self.single_blocks)):
-                    self.single_blocks[j] = self.single_blocks[j].to(DEVICE)
+        for i, block in enumerate(blocks):
             x = block(img, vec=vec, pe=pe)
             real_img, txt = x[:, txt.shape[1]:, ...], x[:, :txt.shape[1], ...]
 
@@ -145,8 +177,6 @@ class Flux(nn.Module):
                 ca_idx += 1
 
             img = torch.cat((txt, real_img), 1)
-        if aggressive_offload:
-            self.single_blocks.cpu()
         img = img[:, txt.shape[1] :, ...]
 
         img = self.final_layer(img, vec)  # (N, T, patch_size ** 2 * out_channels)
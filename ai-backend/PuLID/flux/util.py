@@ -1,9 +1,14 @@
+import hashlib
+import importlib.metadata
 import json
 import os
+import time
+from collections import defaultdict
 from dataclasses import dataclass
 
 import torch
 from huggingface_hub import hf_hub_download
+from safetensors import safe_open
 from safetensors.torch import load_file as load_sft
 
 from flux.model import Flux, FluxParams
@@ -143,7 +148,56 @@ def print_load_warning(missing: list[str], unexpected: list[str]) -> None:
         print(f"Got {len(unexpected)} unexpected keys:\n\t" + "\n\t".join(unexpected))
 
 
-def load_flow_model(name: str, device: str = "cuda", hf_download: bool = True):
+def _block_prefix(key: str) -> str:
+    # "double_blocks.3.img_attn.qkv.weight" -> "double_blocks.3", "img_in.weight" -> "img_in"
+    parts = key.split(".")
+    return ".".join(parts[:2]) if len(parts) > 2 and parts[1].isdigit() else parts[0]
+
+
+def load_checkpoint_streamed(model: torch.nn.Module, ckpt_path: str, device: str = "cuda", keep_mmap: bool = False):
+    """
+    Loads a safetensors checkpoint into a meta-initialized model one block at a time, so
+    at most one block is held in addition to the model. With `keep_mmap` (CPU only) the
+    parameters stay backed by the memory-mapped file and are shared through the page cache.
+    """
+    device = torch.device(device)
+    if keep_mmap and device.type != "cpu":
+        raise ValueError(f"keep_mmap is only supported on CPU, got device {device}")
+
+    timings = defaultdict(float)
+    start = time.perf_counter()
+    model_keys = set(model.state_dict().keys())
+    with safe_open(ckpt_path, framework="pt", device="cpu") as f:
+        file_keys = list(f.keys())
+        blocks = defaultdict(list)
+        for key in file_keys:
+            if key in model_keys:
+                blocks[_block_prefix(key)].append(key)
+        timings["index"] = time.perf_counter() - start
+
+        for keys in blocks.values():
+            t = time.perf_counter()
+            block_sd = {key: f.get_tensor(key) for key in keys}
+            timings["read"] += time.perf_counter() - t
+
+            t = time.perf_counter()
+            if not keep_mmap:
+                block_sd = {key: value.to(device, copy=True) for key, value in block_sd.items()}
+            timings["materialize"] += time.perf_counter() - t
+
+            t = time.perf_counter()
+            model.load_state_dict(block_sd, strict=False, assign=True)
+            timings["assign"] += time.perf_counter() - t
+
+    phases = ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in timings.items())
+    print(f"Loaded {ckpt_path} in {time.perf_counter() - start:.2f}s ({phases})")
+
+    missing = sorted(model_keys.difference(file_keys))
+    unexpected = sorted(set(file_keys).difference(model_keys))
+    return missing, unexpected
+
+
+def load_flow_model(name: str, device: str = "cuda", hf_download: bool = True, keep_mmap: bool = False):
     # Loading Flux
     print("Init model")
     ckpt_path = configs[name].ckpt_path
@@ -155,19 +209,52 @@ def load_flow_model(name: str, device: str = "cuda", hf_download: bool = True):
     ):
         ckpt_path = hf_hub_download(configs[name].repo_id, configs[name].repo_flow, local_dir='models')
 
-    with torch.device(device):
+    # with a checkpoint the weights are assigned block by block, so skip the random init
+    with torch.device("meta" if ckpt_path is not None else device):
         model = Flux(configs[name].params).to(torch.bfloat16)
 
     if ckpt_path is not None:
         print("Loading checkpoint")
-        # load_sft doesn't support torch.device
-        sd = load_sft(ckpt_path, device=str(device))
-        missing, unexpected = model.load_state_dict(sd, strict=False)
+        missing, unexpected = load_checkpoint_streamed(model, ckpt_path, device, keep_mmap=keep_mmap)
         print_load_warning(missing, unexpected)
     return model
 
+
+def _file_fingerprint(path: str, chunk_size: int = 1 << 20) -> str:
+    # hashing multi-GB checkpoints on every start would defeat the purpose of the cache, so only
+    # the size and the first and last MiB (which include the safetensors header) are hashed
+    h = hashlib.sha256(str(os.path.getsize(path)).encode())
+    with open(path, "rb") as f:
+        h.update(f.read(chunk_size))
+        f.seek(max(0, os.path.getsize(path) - chunk_size))
+        h.update(f.read(chunk_size))
+    return h.hexdigest()
+
+
+def _quantized_cache_path(cache_dir: str, name: str, ckpt_path: str, json_path: str) -> str:
+    with open(json_path, "rb") as f:
+        map_hash = hashlib.sha256(f.read()).hexdigest()
+    # the cached model is pickled, so it is only valid for the library versions that wrote it
+    versions = f"{importlib.metadata.version('optimum-quanto')}-{torch.__version__}"
+    key = hashlib.sha256(f"{name}\0{_file_fingerprint(ckpt_path)}\0{map_hash}\0{versions}".encode()).hexdigest()
+    return os.path.join(cache_dir, f"{name}-{key[:16]}.pt")
+
+
 # from XLabs-AI https://github.com/XLabs-AI/x-flux/blob/1f8ef54972105ad9062be69fe6b7f841bce02a08/src/flux/util.py#L330
-def load_flow_model_quintized(name: str, device: str = "cuda", hf_download: bool = True):
+def load_flow_model_quintized(
+    name: str,
+    device: str = "cuda",
+    hf_download: bool = True,
+    cache_dir: str | None = None,
+):
+    """
+    Loads the fp8 checkpoint and requantizes it with optimum.quanto. The requantized model is
+    serialized to `cache_dir` (default FLUX_QUANTO_CACHE or models/quanto_cache, disabled with
+    an empty string), keyed by the checkpoint, the quantization map and the library versions,
+    and loaded from there directly on subsequent starts.
+    """
+    if cache_dir is None:
+        cache_dir = os.getenv("FLUX_QUANTO_CACHE", "models/quanto_cache")
     # Loading Flux
     print("Init model")
     ckpt_path = 'models/flux-dev-fp8.safetensors'
@@ -178,6 +265,16 @@ def load_flow_model_quintized(name: str, device: str = "cuda", hf_download: bool
         ckpt_path = hf_hub_download("XLabs-AI/flux-dev-fp8", "flux-dev-fp8.safetensors")
     json_path = hf_hub_download("XLabs-AI/flux-dev-fp8", 'flux_dev_quantization_map.json')
 
+    cache_path = None
+    if cache_dir:
+        cache_path = _quantized_cache_path(cache_dir, name, ckpt_path, json_path)
+        if os.path.exists(cache_path):
+            print(f"Loading quantized model from cache: {cache_path}")
+            start = time.perf_counter()
+            model = torch.load(cache_path, map_location=device, weights_only=False, mmap=True)
+            print(f"Loaded quantized model in {time.perf_counter() - start:.2f}s")
+            return model
+
     model = Flux(configs[name].params).to(torch.bfloat16)
 
     print("Loading checkpoint")
@@ -189,6 +286,14 @@ def load_flow_model_quintized(name: str, device: str = "cuda", hf_download: bool
     from optimum.quanto import requantize
     requantize(model, sd, quantization_map, device=device)
     print("Model is quantized!")
+
+    if cache_path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        # write to a temporary file first so concurrent starts never load partial files
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        torch.save(model, tmp_path)
+        os.replace(tmp_path, cache_path)
+        print(f"Saved quantized model to cache: {cache_path}")
     return model
 
 
@@ -201,7 +306,7 @@ def load_clip(device: str = "cuda") -> HFEmbedder:
     return HFEmbedder("openai/clip-vit-large-patch14", max_length=77, torch_dtype=torch.bfloat16).to(device)
 
 
-def load_ae(name: str, device: str = "cuda", hf_download: bool = True) -> AutoEncoder:
+def load_ae(name: str, device: str = "cuda", hf_download: bool = True, keep_mmap: bool = False) -> AutoEncoder:
     ckpt_path = configs[name].ae_path
     if (
         not os.path.exists(ckpt_path)
@@ -213,11 +318,10 @@ def load_ae(name: str, device: str = "cuda", hf_download: bool = True) -> AutoEn
 
     # Loading the autoencoder
     print("Init AE")
-    with torch.device(device):
+    with torch.device("meta" if ckpt_path is not None else device):
         ae = AutoEncoder(configs[name].ae_params)
 
     if ckpt_path is not None:
-        sd = load_sft(ckpt_path, device=str(device))
-        missing, unexpected = ae.load_state_dict(sd, strict=False)
+        missing, unexpected = load_checkpoint_streamed(ae, ckpt_path, device, keep_mmap=keep_mmap)
         print_load_warning(missing, unexpected)
     return ae
@@ -0,0 +1,74 @@
+import pytest
+import torch
+
+import flux.model
+from flux.model import Flux, FluxParams
+
+
+class WrappedTensor(torch.Tensor):
+    pass
+
+
+@pytest.fixture
+def cpu_device(monkeypatch):
+    # aggressive_offload moves blocks to flux.model.DEVICE
+    monkeypatch.setattr(flux.model, "DEVICE", torch.device("cpu"))
+
+
+def tiny_flux() -> Flux:
+    torch.manual_seed(0)
+    params = FluxParams(
+        in_channels=16,
+        vec_in_dim=32,
+        context_in_dim=32,
+        hidden_size=64,
+        mlp_ratio=4.0,
+        num_heads=4,
+        depth=2,
+        depth_single_blocks=4,
+        axes_dim=[4, 6, 6],
+        theta=10_000,
+        qkv_bias=True,
+        guidance_embed=True,
+    )
+    return Flux(params).eval()
+
+
+def run(model: Flux, aggressive_offload: bool) -> torch.Tensor:
+    torch.manual_seed(1)
+    img_ids = torch.zeros(1, 16, 3)
+    img_ids[..., 1] = torch.arange(16) // 4
+    img_ids[..., 2] = torch.arange(16) % 4
+    with torch.inference_mode():
+        return model(
+            img=torch.randn(1, 16, 16),
+            img_ids=img_ids,
+            txt=torch.randn(1, 8, 32),
+            txt_ids=torch.zeros(1, 8, 3),
+            timesteps=torch.tensor([0.5]),
+            y=torch.randn(1, 32),
+            guidance=torch.tensor([3.5]),
+            aggressive_offload=aggressive_offload,
+        )
+
+
+def test_aggressive_offload_moves_quantized_blocks(cpu_device):
+    model = tiny_flux()
+    # stands in for the weights of a model quantized with optimum.quanto
+    model.single_blocks[1].register_buffer("scale", torch.ones(1).as_subclass(WrappedTensor))
+    expected = run(model, aggressive_offload=False)
+
+    output = run(model, aggressive_offload=True)
+
+    assert model.block_streamer is None
+    torch.testing.assert_close(output, expected)
+
+
+def test_aggressive_offload_streams_plain_blocks(cpu_device):
+    model = tiny_flux()
+    expected = run(model, aggressive_offload=False)
+    model.enable_block_streaming(device="cpu")
+
+    output = run(model, aggressive_offload=True)
+
+    torch.testing.assert_close(output, expected)
@@ -0,0 +1,134 @@
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Any, Callable, Hashable, List, Optional
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+# Defaults for all backends, can be overridden per scheduler
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "4"))
+BATCH_MAX_WAIT_MS = float(os.getenv("BATCH_MAX_WAIT_MS", "50"))
+
+
+def make_generators(device: str, seeds: List[int]) -> List[torch.Generator]:
+    """One generator per batch item, so every request gets the image its seed would give alone"""
+    return [torch.Generator(device=device).manual_seed(seed) for seed in seeds]
+
+
+class BatchScheduler:
+    """Runs concurrent generation requests as batched pipeline calls.
+
+    Requests are grouped by a key that holds everything the batched call has to agree on
+    (pipeline, resolution, steps, strength, ...), while prompts, images and seeds can differ
+    per item. Whenever the executor is free, the oldest group is run once it has
+    `max_batch_size` requests or its first request has waited `max_wait` seconds. Requests
+    keep collecting while a batch runs, so batches grow with the load.
+
+    `run_batch(key, items)` is called on the executor and returns one result per item, which
+    is handed back to the awaiting `submit` call. If it raises, all requests of the batch fail,
+    if it returns fewer results than items, the requests without a result fail.
+    """
+
+    def __init__(
+        self,
+        run_batch: Callable[[Hashable, List[Any]], List[Any]],
+        max_batch_size: int = BATCH_MAX_SIZE,
+        max_wait: float = BATCH_MAX_WAIT_MS / 1000,
+        executor: Optional[Executor] = None,
+    ):
+        self.run_batch = run_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait
+        self.executor = executor or ThreadPoolExecutor(max_workers=1)
+        # key -> [(arrival time, item, future)], in order of the first request of each group
+        self._pending: "OrderedDict[Hashable, list]" = OrderedDict()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._worker: Optional[asyncio.Task] = None
+        self.batches = 0
+        self.requests = 0
+
+    async def submit(self, key: Hashable, item: Any) -> Any:
+        """Queue one request and wait for its result"""
+        loop = asyncio.get_running_loop()
+        if self._worker is None or self._worker.done():
+            self._wakeup = asyncio.Event()
+            self._worker = loop.create_task(self._run())
+
+        future = loop.create_future()
+        self._pending.setdefault(key, []).append((loop.time(), item, future))
+        self._wakeup.set()
+        return await future
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.batches,
+            "requests": self.requests,
+            "avg_batch_size": round(self.requests / self.batches, 2) if self.batches else 0.0,
+            "queued": sum(len(requests) for requests in self._pending.values()),
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000,
+        }
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            key, requests = next(iter(self._pending.items()))
+            deadline = requests[0][0] + self.max_wait
+            while len(requests) < self.max_batch_size and loop.time() < deadline:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), deadline - loop.time())
+                except asyncio.TimeoutError:
+                    break
+
+            # drop requests whose handler is gone, e.g. because the client disconnected
+            requests = [request for request in requests if not request[2].done()]
+            batch, rest = requests[: self.max_batch_size], requests[self.max_batch_size :]
+            if rest:
+                # the remainder goes behind the other groups, so a busy group can't starve them
+                self._pending[key] = rest
+                self._pending.move_to_end(key)
+            else:
+                del self._pending[key]
+            if not batch:
+                continue
+
+            logger.info(f"Running batch of {len(batch)} for {key}")
+            start_time = time.time()
+            try:
+                items = [item for _, item, _ in batch]
+                results = list(await loop.run_in_executor(self.executor, self.run_batch, key, items))
+            except Exception as e:
+                logger.error(f"Batch for {key} failed: {e}")
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            self.batches += 1
+            self.requests += len(batch)
+            logger.info(f"Batch of {len(batch)} took {time.time() - start_time:.2f} seconds")
+            error = None
+            if len(results) != len(batch):
+                # never leave a request waiting, the ones without a result fail
+                error = RuntimeError(
+                    f"Batch for {key} returned {len(results)} results for {len(batch)} requests"
+                )
+                logger.error(str(error))
+            for i, (_, _, future) in enumerate(batch):
+                if future.done():
+                    continue
+                if i < len(results):
+                    future.set_result(results[i])
+                else:
+                    future.set_exception(error)
@@ -13,6 +13,8 @@ import asyncio
 from concurrent.futures import ThreadPoolExecutor
 import time
 
+from batching import BatchScheduler, make_generators
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -211,11 +213,11 @@ def get_enhanced_art_style_prompts(art_style: str, cuteness_level: str, color_pa
     
     return base_style, cuteness, colors
 
-def convert_to_enhanced_pet_portrait(image: Image.Image, style: str, art_style: str = "popmart", 
-                                   cuteness_level: str = "high", color_palette: str = "vibrant",
-                                   custom_prompt: str = None, custom_negative: str = None,
-                                   use_controlnet: bool = True, controlnet_strength: float = 0.75) -> Image.Image:
-    """Convert image to high-quality pet portrait using Enhanced SDXL with dramatically different styles"""
+def prepare_enhanced_request(image: Image.Image, style: str, art_style: str = "popmart", 
+                             cuteness_level: str = "high", color_palette: str = "vibrant",
+                             custom_prompt: str = None, custom_negative: str = None,
+                             use_controlnet: bool = True, controlnet_strength: float = 0.75) -> tuple[tuple, dict]:
+    """Build the batch settings and the batch item (prompts, input image) for one request"""
     
     # Use custom prompt if provided, otherwise generate enhanced prompt
     if custom_prompt:
@@ -255,110 +257,131 @@ def convert_to_enhanced_pet_portrait(image: Image.Image, style: str, art_style:
         # Enhanced negative prompt - avoid changing the pet's features
         negative_prompt = "ugly, bad quality, blurry, distorted, deformed, low resolution, pixelated, artifacts, bad anatomy, missing limbs, extra limbs, duplicate, malformed, scary, dark, human, different animal, different breed, different fur color, different eye color, changed features, wrong pose"
     
-    try:
-        logger.info(f"ENHANCED GENERATION - Art Style: {art_style}, Cuteness: {cuteness_level}, Colors: {color_palette}")
-        logger.info(f"Using enhanced SDXL prompt: {prompt[:150]}...")
+    logger.info(f"ENHANCED GENERATION - Art Style: {art_style}, Cuteness: {cuteness_level}, Colors: {color_palette}")
+    logger.info(f"Using enhanced SDXL prompt: {prompt[:150]}...")
+    
+    # Resize to optimal size for SDXL
+    processed_img = image.resize((1024, 1024), Image.Resampling.LANCZOS)
+    
+    # Choose pipeline based on detail preservation needs
+    if use_controlnet and controlnet_pipeline:
+        logger.info(f"Using ControlNet for enhanced detail preservation (strength: {controlnet_strength})")
         
-        # Resize to optimal size for SDXL
-        processed_img = image.resize((1024, 1024), Image.Resampling.LANCZOS)
+        # Generate Canny edges for structure control
+        processed_img = canny_detector(processed_img)
         
-        # Choose pipeline based on detail preservation needs
-        if use_controlnet and controlnet_pipeline:
-            logger.info(f"Using ControlNet for enhanced detail preservation (strength: {controlnet_strength})")
-            
-            # Generate Canny edges for structure control
-            canny_image = canny_detector(processed_img)
-            
-            # Move VAE to device for generation
-            if ai_models.device == "mps":
-                controlnet_pipeline.vae.to(ai_models.device)
-            
-            # Generate with ControlNet for superior detail preservation
-            with torch.no_grad():
-                result_image = controlnet_pipeline(
-                    prompt=prompt,
-                    negative_prompt=negative_prompt,
-                    image=canny_image,
-                    num_inference_steps=25,
-                    guidance_scale=7.5,
-                    controlnet_conditioning_scale=max(0.85, controlnet_strength),  # Higher strength for better feature preservation
-                    generator=torch.Generator(device=ai_models.device).manual_seed(42)  # Fixed seed for consistency
-                ).images[0]
-                
-            # Move VAE back to CPU
-            if ai_models.device == "mps":
-                controlnet_pipeline.vae.to("cpu")
-        else:
-            logger.info("Using standard SDXL img2img pipeline")
-            
-            # Move VAE to device for generation
-            if ai_models.device == "mps":
-                img2img_pipeline.vae.to(ai_models.device)
-            
-            # Generate with Enhanced SDXL optimized settings
-            with torch.no_grad():
-                result_image = img2img_pipeline(
-                    prompt=prompt,
-                    negative_prompt=negative_prompt,
-                    image=processed_img,
-                    strength=0.45,  # Lower strength to preserve more original features
-                    num_inference_steps=30,  # More steps for better quality
-                    guidance_scale=8.0,  # Higher guidance for stronger style adherence
-                    generator=torch.Generator(device=ai_models.device).manual_seed(42)  # Fixed seed for consistency
-                ).images[0]
-                
-            # Move VAE back to CPU
-            if ai_models.device == "mps":
-                img2img_pipeline.vae.to("cpu")
+        # Higher conditioning strength for better feature preservation
+        settings = ("controlnet", 25, 7.5, max(0.85, controlnet_strength))
+    else:
+        logger.info("Using standard SDXL img2img pipeline")
         
-        # Dramatic post-processing based on art style to ensure visible differences
-        if art_style == "popmart" or art_style == "cartoon":
-            # Dramatic enhancement for toy/cartoon styles
-            enhancer = ImageEnhance.Color(result_image)
-            result_image = enhancer.enhance(1.5)  # Much more vibrant
-            
-            enhancer = ImageEnhance.Contrast(result_image)
-            result_image = enhancer.enhance(1.3)  # Higher contrast
-            
-            enhancer = ImageEnhance.Sharpness(result_image)
-            result_image = enhancer.enhance(1.2)  # Sharper for toy effect
-            
-        elif art_style == "watercolor":
-            # Softer, more artistic effect
-            enhancer = ImageEnhance.Color(result_image)
-            result_image = enhancer.enhance(0.9)  # Slightly desaturated
-            
-            enhancer = ImageEnhance.Contrast(result_image)
-            result_image = enhancer.enhance(0.95)  # Softer contrast
-            
-        elif art_style == "oil_painting":
-            # Rich, dramatic oil painting effect
-            enhancer = ImageEnhance.Color(result_image)
-            result_image = enhancer.enhance(1.2)
-            
-            enhancer = ImageEnhance.Contrast(result_image)
-            result_image = enhancer.enhance(1.25)
-            
-        elif art_style == "realistic":
-            # Crisp realistic enhancement
-            enhancer = ImageEnhance.Sharpness(result_image)
-            result_image = enhancer.enhance(1.1)
-            
-        elif art_style == "anime":
-            # Anime-style enhancement
-            enhancer = ImageEnhance.Color(result_image)
-            result_image = enhancer.enhance(1.4)  # Very vibrant anime colors
-            
-            enhancer = ImageEnhance.Contrast(result_image)
-            result_image = enhancer.enhance(1.2)
+        # Lower strength 0.45 to preserve more original features, 30 steps for better quality,
+        # higher guidance 8.0 for stronger style adherence
+        settings = ("img2img", 30, 8.0, 0.45)
+    
+    # Fixed seed for consistency
+    return settings, {"prompt": prompt, "negative_prompt": negative_prompt, "image": processed_img, "seed": 42}
+
+def run_enhanced_batch(settings: tuple, items: list) -> list:
+    """Run one ControlNet or img2img call for a batch of requests that share the same settings"""
+    mode, num_inference_steps, guidance_scale, strength = settings
+    if mode == "controlnet":
+        pipeline = controlnet_pipeline
+        pipeline_kwargs = {"controlnet_conditioning_scale": strength}
+    else:
+        pipeline = img2img_pipeline
+        pipeline_kwargs = {"strength": strength}
+    
+    # Move VAE to device for generation
+    if ai_models.device == "mps":
+        pipeline.vae.to(ai_models.device)
+    
+    with torch.no_grad():
+        result_images = pipeline(
+            prompt=[item["prompt"] for item in items],
+            negative_prompt=[item["negative_prompt"] for item in items],
+            image=[item["image"] for item in items],
+            num_inference_steps=num_inference_steps,
+            guidance_scale=guidance_scale,
+            generator=make_generators(ai_models.device, [item["seed"] for item in items]),
+            **pipeline_kwargs
+        ).images
+    
+    # Move VAE back to CPU
+    if ai_models.device == "mps":
+        pipeline.vae.to("cpu")
+    
+    # Memory cleanup
+    if ai_models.device == "mps":
+        torch.mps.empty_cache()
+    elif ai_models.device == "cuda":
+        torch.cuda.empty_cache()
+    
+    return result_images
+
+batcher = BatchScheduler(run_enhanced_batch, executor=executor)
+
+def enhance_pet_portrait(result_image: Image.Image, art_style: str) -> Image.Image:
+    """Post-processing for the selected art style"""
+    # Dramatic post-processing based on art style to ensure visible differences
+    if art_style == "popmart" or art_style == "cartoon":
+        # Dramatic enhancement for toy/cartoon styles
+        enhancer = ImageEnhance.Color(result_image)
+        result_image = enhancer.enhance(1.5)  # Much more vibrant
+        
+        enhancer = ImageEnhance.Contrast(result_image)
+        result_image = enhancer.enhance(1.3)  # Higher contrast
+        
+        enhancer = ImageEnhance.Sharpness(result_image)
+        result_image = enhancer.enhance(1.2)  # Sharper for toy effect
         
-        # Memory cleanup
-        if ai_models.device == "mps":
-            torch.mps.empty_cache()
-        elif ai_models.device == "cuda":
-            torch.cuda.empty_cache()
+    elif art_style == "watercolor":
+        # Softer, more artistic effect
+        enhancer = ImageEnhance.Color(result_image)
+        result_image = enhancer.enhance(0.9)  # Slightly desaturated
         
-        return result_image
+        enhancer = ImageEnhance.Contrast(result_image)
+        result_image = enhancer.enhance(0.95)  # Softer contrast
+        
+    elif art_style == "oil_painting":
+        # Rich, dramatic oil painting effect
+        enhancer = ImageEnhance.Color(result_image)
+        result_image = enhancer.enhance(1.2)
+        
+        enhancer = ImageEnhance.Contrast(result_image)
+        result_image = enhancer.enhance(1.25)
+        
+    elif art_style == "realistic":
+        # Crisp realistic enhancement
+        enhancer = ImageEnhance.Sharpness(result_image)
+        result_image = enhancer.enhance(1.1)
+        
+    elif art_style == "anime":
+        # Anime-style enhancement
+        enhancer = ImageEnhance.Color(result_image)
+        result_image = enhancer.enhance(1.4)  # Very vibrant anime colors
+        
+        enhancer = ImageEnhance.Contrast(result_image)
+        result_image = enhancer.enhance(1.2)
+    
+    return result_image
+
+async def convert_to_enhanced_pet_portrait(image: Image.Image, style: str, art_style: str = "popmart", 
+                                           cuteness_level: str = "high", color_palette: str = "vibrant",
+                                           custom_prompt: str = None, custom_negative: str = None,
+                                           use_controlnet: bool = True, controlnet_strength: float = 0.75) -> Image.Image:
+    """Convert image to high-quality pet portrait using Enhanced SDXL with dramatically different styles"""
+    loop = asyncio.get_event_loop()
+    
+    try:
+        # Prompt building, edge detection and post-processing run on the default thread pool,
+        # the pipeline call is batched with concurrent requests using the same settings
+        settings, item = await loop.run_in_executor(
+            None, prepare_enhanced_request, image, style, art_style, cuteness_level, color_palette,
+            custom_prompt, custom_negative, use_controlnet, controlnet_strength
+        )
+        result_image = await batcher.submit(settings, item)
+        return await loop.run_in_executor(None, enhance_pet_portrait, result_image, art_style)
         
     except Exception as e:
         logger.error(f"Enhanced SDXL conversion failed: {e}")
@@ -383,6 +406,7 @@ async def health_check():
         "status": "healthy",
         "device": ai_models.device,
         "models_loaded": ai_models.models_loaded,
+        "batching": batcher.stats(),
         "mode": "enhanced_sdxl",
         "model": "stabilityai/stable-diffusion-xl-base-1.0",
         "approach": "Enhanced SDXL with dramatic style transformations and variety"
@@ -412,14 +436,9 @@ async def generate_pet_portrait(
         
         logger.info(f"Processing image: {image.filename}, size: {input_image.size}")
         
-        # Run Enhanced SDXL conversion
-        loop = asyncio.get_event_loop()
-        
-        def enhanced_process():
-            return convert_to_enhanced_pet_portrait(input_image, style, art_style, cuteness_level, color_palette, prompt, negative_prompt, use_controlnet, controlnet_strength)
-        
+        # Run Enhanced SDXL conversion, batched with concurrent requests
         start_time = time.time()
-        result_image = await loop.run_in_executor(executor, enhanced_process)
+        result_image = await convert_to_enhanced_pet_portrait(input_image, style, art_style, cuteness_level, color_palette, prompt, negative_prompt, use_controlnet, controlnet_strength)
         generation_time = time.time() - start_time
         
         # Convert to base64
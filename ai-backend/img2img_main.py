@@ -9,8 +9,11 @@ import base64
 import logging
 import asyncio
 from concurrent.futures import ThreadPoolExecutor
+import random
 import time
 
+from batching import BatchScheduler, make_generators
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -158,10 +161,10 @@ def get_art_style_prompts(art_style: str, cuteness_level: str, color_palette: st
     
     return base_style, cuteness, colors
 
-def convert_to_popmart_style(image: Image.Image, style: str, art_style: str = "popmart", 
-                           cuteness_level: str = "high", color_palette: str = "vibrant",
-                           custom_prompt: str = None, custom_negative: str = None) -> Image.Image:
-    """Convert image to specified art style with enhanced cuteness and attractiveness"""
+def prepare_popmart_request(image: Image.Image, style: str, art_style: str = "popmart",
+                            cuteness_level: str = "high", color_palette: str = "vibrant",
+                            custom_prompt: str = None, custom_negative: str = None) -> dict:
+    """Build the prompts and the resized input image for one batch item"""
     
     # Use custom prompt if provided, otherwise generate enhanced style-based prompt
     if custom_prompt:
@@ -201,46 +204,79 @@ def convert_to_popmart_style(image: Image.Image, style: str, art_style: str = "p
         # Enhanced negative prompt for better ID preservation
         negative_prompt = "ugly, bad quality, blurry, distorted, deformed, realistic photography, human, scary, dark, different pose, changed position, different animal, wrong colors, missing features"
     
-    try:
-        logger.info(f"Art Style: {art_style}, Cuteness: {cuteness_level}, Colors: {color_palette}")
-        logger.info(f"Using prompt: {prompt[:100]}...")
-        
+    logger.info(f"Art Style: {art_style}, Cuteness: {cuteness_level}, Colors: {color_palette}")
+    logger.info(f"Using prompt: {prompt[:100]}...")
+    
+    return {
+        "prompt": prompt,
+        "negative_prompt": negative_prompt,
         # Resize to smaller size for faster processing
-        processed_img = image.resize((512, 512), Image.Resampling.LANCZOS)
-        
-        # Move VAE to device for generation
-        if ai_models.device == "mps":
-            img2img_pipeline.vae.to(ai_models.device)
-        
-        # Use img2img with ID preservation optimized settings
-        with torch.no_grad():
-            result_image = img2img_pipeline(
-                prompt=prompt,
-                negative_prompt=negative_prompt,
-                image=processed_img,
-                strength=0.5,  # Higher strength for more dramatic transformations
-                num_inference_steps=20,  # More steps for better ID preservation
-                guidance_scale=6.0,  # Lower guidance to maintain original structure
-                generator=torch.Generator(device=ai_models.device).manual_seed(int(time.time()) % 1000000)  # Random seed for variety
-            ).images[0]
-        
-        # Enhanced post-processing for PopMart aesthetic
-        enhancer = ImageEnhance.Color(result_image)
-        result_image = enhancer.enhance(1.4)  # More vibrant colors
-        
-        enhancer = ImageEnhance.Contrast(result_image)
-        result_image = enhancer.enhance(1.2)  # Better contrast
-        
-        # Add slight sharpness for cartoon clarity
-        enhancer = ImageEnhance.Sharpness(result_image)
-        result_image = enhancer.enhance(1.1)
-        
-        # Move VAE back to CPU
-        if ai_models.device == "mps":
-            img2img_pipeline.vae.to("cpu")
-            torch.mps.empty_cache()
-        
-        return result_image
+        "image": image.resize((512, 512), Image.Resampling.LANCZOS),
+        # Random seed per request for variety
+        "seed": random.randrange(1000000),
+    }
+
+def run_img2img_batch(settings: tuple, items: list) -> list:
+    """Run one img2img call for a batch of requests that share the same settings"""
+    strength, num_inference_steps, guidance_scale = settings
+    
+    # Move VAE to device for generation
+    if ai_models.device == "mps":
+        img2img_pipeline.vae.to(ai_models.device)
+    
+    # Use img2img with ID preservation optimized settings
+    with torch.no_grad():
+        result_images = img2img_pipeline(
+            prompt=[item["prompt"] for item in items],
+            negative_prompt=[item["negative_prompt"] for item in items],
+            image=[item["image"] for item in items],
+            strength=strength,
+            num_inference_steps=num_inference_steps,
+            guidance_scale=guidance_scale,
+            generator=make_generators(ai_models.device, [item["seed"] for item in items])
+        ).images
+    
+    # Move VAE back to CPU
+    if ai_models.device == "mps":
+        img2img_pipeline.vae.to("cpu")
+        torch.mps.empty_cache()
+    
+    return result_images
+
+# strength 0.5 for more dramatic transformations, 20 steps for better ID preservation,
+# guidance 6.0 to maintain original structure
+IMG2IMG_SETTINGS = (0.5, 20, 6.0)
+batcher = BatchScheduler(run_img2img_batch, executor=executor)
+
+def enhance_popmart_style(result_image: Image.Image) -> Image.Image:
+    """Enhanced post-processing for PopMart aesthetic"""
+    enhancer = ImageEnhance.Color(result_image)
+    result_image = enhancer.enhance(1.4)  # More vibrant colors
+    
+    enhancer = ImageEnhance.Contrast(result_image)
+    result_image = enhancer.enhance(1.2)  # Better contrast
+    
+    # Add slight sharpness for cartoon clarity
+    enhancer = ImageEnhance.Sharpness(result_image)
+    result_image = enhancer.enhance(1.1)
+    
+    return result_image
+
+async def convert_to_popmart_style(image: Image.Image, style: str, art_style: str = "popmart", 
+                                   cuteness_level: str = "high", color_palette: str = "vibrant",
+                                   custom_prompt: str = None, custom_negative: str = None) -> Image.Image:
+    """Convert image to specified art style with enhanced cuteness and attractiveness"""
+    loop = asyncio.get_event_loop()
+    
+    try:
+        # Prompt building and post-processing run on the default thread pool, the pipeline
+        # call is batched with concurrent requests
+        item = await loop.run_in_executor(
+            None, prepare_popmart_request, image, style, art_style, cuteness_level, color_palette,
+            custom_prompt, custom_negative
+        )
+        result_image = await batcher.submit(IMG2IMG_SETTINGS, item)
+        return await loop.run_in_executor(None, enhance_popmart_style, result_image)
         
     except Exception as e:
         logger.error(f"PopMart conversion failed: {e}")
@@ -263,6 +299,7 @@ async def health_check():
         "status": "healthy",
         "device": ai_models.device,
         "models_loaded": ai_models.models_loaded,
+        "batching": batcher.stats(),
         "mode": "popmart_blindbox_style",
         "approach": "PopMart blindbox style conversion with pose preservation"
     }
@@ -289,14 +326,9 @@ async def generate_pet_portrait(
         
         logger.info(f"Processing image: {image.filename}, size: {input_image.size}")
         
-        # Run img2img conversion
-        loop = asyncio.get_event_loop()
-        
-        def img2img_process():
-            return convert_to_popmart_style(input_image, style, art_style, cuteness_level, color_palette, prompt, negative_prompt)
-        
+        # Run img2img conversion, batched with concurrent requests
         start_time = time.time()
-        result_image = await loop.run_in_executor(executor, img2img_process)
+        result_image = await convert_to_popmart_style(input_image, style, art_style, cuteness_level, color_palette, prompt, negative_prompt)
         generation_time = time.time() - start_time
         
         # Convert to base64
@@ -11,6 +11,8 @@ import asyncio
 from concurrent.futures import ThreadPoolExecutor
 import time
 
+from batching import BatchScheduler, make_generators
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -158,10 +160,10 @@ def get_art_style_prompts(art_style: str, cuteness_level: str, color_palette: st
     
     return base_style, cuteness, colors
 
-def convert_to_pet_portrait(image: Image.Image, style: str, art_style: str = "popmart", 
-                          cuteness_level: str = "high", color_palette: str = "vibrant",
-                          custom_prompt: str = None, custom_negative: str = None) -> Image.Image:
-    """Convert image to high-quality pet portrait using Juggernaut XL"""
+def prepare_pet_portrait_request(image: Image.Image, style: str, art_style: str = "popmart",
+                                 cuteness_level: str = "high", color_palette: str = "vibrant",
+                                 custom_prompt: str = None, custom_negative: str = None) -> dict:
+    """Build the prompts and the resized input image for one batch item"""
     
     # Use custom prompt if provided, otherwise generate optimized prompt
     if custom_prompt:
@@ -201,55 +203,88 @@ def convert_to_pet_portrait(image: Image.Image, style: str, art_style: str = "po
         # Optimized negative prompt for Juggernaut XL
         negative_prompt = "ugly, bad quality, blurry, distorted, deformed, low resolution, pixelated, artifacts, overexposed, underexposed, bad anatomy, missing limbs, extra limbs, duplicate, malformed, scary, dark, human, realistic photography when cartoon style requested"
     
-    try:
-        logger.info(f"Art Style: {art_style}, Cuteness: {cuteness_level}, Colors: {color_palette}")
-        logger.info(f"Using optimized Juggernaut XL prompt: {prompt[:150]}...")
-        
+    logger.info(f"Art Style: {art_style}, Cuteness: {cuteness_level}, Colors: {color_palette}")
+    logger.info(f"Using optimized Juggernaut XL prompt: {prompt[:150]}...")
+    
+    return {
+        "prompt": prompt,
+        "negative_prompt": negative_prompt,
         # Resize to optimal size for SDXL (1024x1024 or maintain aspect ratio)
-        processed_img = image.resize((1024, 1024), Image.Resampling.LANCZOS)
-        
-        # Move VAE to device for generation
-        if ai_models.device == "mps":
-            img2img_pipeline.vae.to(ai_models.device)
-        
-        # Generate with Juggernaut XL optimized settings
-        with torch.no_grad():
-            result_image = img2img_pipeline(
-                prompt=prompt,
-                negative_prompt=negative_prompt,
-                image=processed_img,
-                strength=0.4,  # Balanced strength for good transformation while preserving identity
-                num_inference_steps=25,  # Optimal steps for quality/speed balance
-                guidance_scale=7.0,  # Juggernaut XL works well with this guidance
-                generator=torch.Generator(device=ai_models.device).manual_seed(42)
-            ).images[0]
-        
-        # Enhanced post-processing for different art styles
-        if art_style == "popmart" or art_style == "cartoon":
-            # Enhance colors and contrast for cartoon styles
-            enhancer = ImageEnhance.Color(result_image)
-            result_image = enhancer.enhance(1.3)
+        "image": image.resize((1024, 1024), Image.Resampling.LANCZOS),
+        "seed": 42,
+    }
+
+def run_juggernaut_batch(settings: tuple, items: list) -> list:
+    """Run one Juggernaut XL img2img call for a batch of requests that share the same settings"""
+    strength, num_inference_steps, guidance_scale = settings
+    
+    # Move VAE to device for generation
+    if ai_models.device == "mps":
+        img2img_pipeline.vae.to(ai_models.device)
+    
+    # Generate with Juggernaut XL optimized settings
+    with torch.no_grad():
+        result_images = img2img_pipeline(
+            prompt=[item["prompt"] for item in items],
+            negative_prompt=[item["negative_prompt"] for item in items],
+            image=[item["image"] for item in items],
+            strength=strength,
+            num_inference_steps=num_inference_steps,
+            guidance_scale=guidance_scale,
+            generator=make_generators(ai_models.device, [item["seed"] for item in items])
+        ).images
+    
+    # Move VAE back to CPU
+    if ai_models.device == "mps":
+        img2img_pipeline.vae.to("cpu")
+        torch.mps.empty_cache()
+    
+    return result_images
+
+# strength 0.4 balances transformation and identity, 25 steps for quality/speed balance,
+# Juggernaut XL works well with guidance 7.0
+JUGGERNAUT_SETTINGS = (0.4, 25, 7.0)
+batcher = BatchScheduler(run_juggernaut_batch, executor=executor)
+
+def enhance_pet_portrait(result_image: Image.Image, art_style: str) -> Image.Image:
+    """Post-processing for the selected art style"""
+    # Enhanced post-processing for different art styles
+    if art_style == "popmart" or art_style == "cartoon":
+        # Enhance colors and contrast for cartoon styles
+        enhancer = ImageEnhance.Color(result_image)
+        result_image = enhancer.enhance(1.3)
             
-            enhancer = ImageEnhance.Contrast(result_image)
-            result_image = enhancer.enhance(1.2)
+        enhancer = ImageEnhance.Contrast(result_image)
+        result_image = enhancer.enhance(1.2)
             
-            enhancer = ImageEnhance.Sharpness(result_image)
-            result_image = enhancer.enhance(1.1)
-        elif art_style == "watercolor":
-            # Softer enhancement for watercolor
-            enhancer = ImageEnhance.Color(result_image)
-            result_image = enhancer.enhance(1.1)
-        elif art_style == "realistic":
-            # Minimal enhancement for realistic style
-            enhancer = ImageEnhance.Sharpness(result_image)
-            result_image = enhancer.enhance(1.05)
-        
-        # Move VAE back to CPU
-        if ai_models.device == "mps":
-            img2img_pipeline.vae.to("cpu")
-            torch.mps.empty_cache()
+        enhancer = ImageEnhance.Sharpness(result_image)
+        result_image = enhancer.enhance(1.1)
+    elif art_style == "watercolor":
+        # Softer enhancement for watercolor
+        enhancer = ImageEnhance.Color(result_image)
+        result_image = enhancer.enhance(1.1)
+    elif art_style == "realistic":
+        # Minimal enhancement for realistic style
+        enhancer = ImageEnhance.Sharpness(result_image)
+        result_image = enhancer.enhance(1.05)
         
-        return result_image
+    return result_image
+
+async def convert_to_pet_portrait(image: Image.Image, style: str, art_style: str = "popmart", 
+                                  cuteness_level: str = "high", color_palette: str = "vibrant",
+                                  custom_prompt: str = None, custom_negative: str = None) -> Image.Image:
+    """Convert image to high-quality pet portrait using Juggernaut XL"""
+    loop = asyncio.get_event_loop()
+    
+    try:
+        # Prompt building and post-processing run on the default thread pool, the pipeline
+        # call is batched with concurrent requests
+        item = await loop.run_in_executor(
+            None, prepare_pet_portrait_request, image, style, art_style, cuteness_level, color_palette,
+            custom_prompt, custom_negative
+        )
+        result_image = await batcher.submit(JUGGERNAUT_SETTINGS, item)
+        return await loop.run_in_executor(None, enhance_pet_portrait, result_image, art_style)
         
     except Exception as e:
         logger.error(f"Juggernaut XL conversion failed: {e}")
@@ -273,6 +308,7 @@ async def health_check():
         "status": "healthy",
         "device": ai_models.device,
         "models_loaded": ai_models.models_loaded,
+        "batching": batcher.stats(),
         "mode": "juggernaut_xl_v9",
         "model": "RunDiffusion/Juggernaut-XL-v9",
         "approach": "High-quality pet portrait generation with photorealistic capabilities"
@@ -300,14 +336,9 @@ async def generate_pet_portrait(
         
         logger.info(f"Processing image: {image.filename}, size: {input_image.size}")
         
-        # Run Juggernaut XL conversion
-        loop = asyncio.get_event_loop()
-        
-        def juggernaut_process():
-            return convert_to_pet_portrait(input_image, style, art_style, cuteness_level, color_palette, prompt, negative_prompt)
-        
+        # Run Juggernaut XL conversion, batched with concurrent requests
         start_time = time.time()
-        result_image = await loop.run_in_executor(executor, juggernaut_process)
+        result_image = await convert_to_pet_portrait(input_image, style, art_style, cuteness_level, color_palette, prompt, negative_prompt)
         generation_time = time.time() - start_time
         
         # Convert to base64
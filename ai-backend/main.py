@@ -15,8 +15,11 @@ import os
 from typing import Optional
 import asyncio
 from concurrent.futures import ThreadPoolExecutor
+import random
 import time
 
+from batching import BatchScheduler, make_generators
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -137,7 +140,36 @@ def detect_pose(image: Image.Image) -> Image.Image:
         # Return a blank pose image if detection fails
         return Image.new('RGB', image.size, (0, 0, 0))
 
-def generate_styled_image(prompt: str, pose_image: Optional[Image.Image] = None, style: str = "default") -> Image.Image:
+def run_generation_batch(settings: tuple, items: list) -> list:
+    """Run one txt2img or pose-guided ControlNet call for a batch of requests that share the same settings"""
+    mode, num_inference_steps, guidance_scale = settings
+    if mode == "controlnet":
+        pipeline_fn = controlnet_pipeline
+        pipeline_kwargs = {"image": [item["pose_image"] for item in items], "controlnet_conditioning_scale": 1.0}
+    else:
+        pipeline_fn = pipeline
+        pipeline_kwargs = {}
+    
+    # An empty negative prompt is the same as none
+    return pipeline_fn(
+        prompt=[item["prompt"] for item in items],
+        negative_prompt=[item["negative_prompt"] for item in items],
+        num_inference_steps=num_inference_steps,
+        guidance_scale=guidance_scale,
+        width=512,
+        height=512,
+        generator=make_generators(ai_models.device, [item["seed"] for item in items]),
+        **pipeline_kwargs
+    ).images
+
+batcher = BatchScheduler(run_generation_batch, executor=executor)
+
+def generation_settings(pose_image: Optional[Image.Image]) -> tuple:
+    """Batch settings, use ControlNet for pose-guided generation if a pose is available"""
+    mode = "controlnet" if pose_image is not None and controlnet_pipeline is not None else "txt2img"
+    return (mode, 20, 7.5)
+
+async def generate_styled_image(prompt: str, pose_image: Optional[Image.Image] = None, style: str = "default") -> Image.Image:
     """Generate image with specific art style"""
     
     # Style-specific prompt enhancements
@@ -156,22 +188,13 @@ def generate_styled_image(prompt: str, pose_image: Optional[Image.Image] = None,
     logger.info(f"Generating {style} style image with prompt: {enhanced_prompt[:100]}...")
     
     try:
-        if pose_image is not None and controlnet_pipeline is not None:
-            # Use ControlNet for pose-guided generation
-            result = controlnet_pipeline(
-                prompt=enhanced_prompt,
-                image=pose_image,
-                num_inference_steps=20,
-                guidance_scale=7.5,
-                controlnet_conditioning_scale=1.0
-            ).images[0]
-        else:
-            # Use regular pipeline
-            result = pipeline(
-                prompt=enhanced_prompt,
-                num_inference_steps=20,
-                guidance_scale=7.5
-            ).images[0]
+        # Random seed per request
+        result = await batcher.submit(generation_settings(pose_image), {
+            "prompt": enhanced_prompt,
+            "negative_prompt": "",
+            "pose_image": pose_image,
+            "seed": random.randrange(2**32)
+        })
             
         logger.info(f"Successfully generated {style} style image")
         return result
@@ -181,7 +204,7 @@ def generate_styled_image(prompt: str, pose_image: Optional[Image.Image] = None,
         # Fallback to a simple colored image
         return Image.new('RGB', (512, 512), (200, 200, 200))
 
-def generate_popmart_image(prompt: str, pose_image: Optional[Image.Image] = None) -> Image.Image:
+async def generate_popmart_image(prompt: str, pose_image: Optional[Image.Image] = None) -> Image.Image:
     """Generate PopMart-style image"""
     
     # PopMart-specific prompt enhancement
@@ -200,32 +223,19 @@ def generate_popmart_image(prompt: str, pose_image: Optional[Image.Image] = None
     """
     
     try:
-        if pose_image is not None and controlnet_pipeline is not None:
+        settings = generation_settings(pose_image)
+        if settings[0] == "controlnet":
             # Use ControlNet for pose preservation
             logger.info("Generating with pose control...")
-            image = controlnet_pipeline(
-                prompt=enhanced_prompt,
-                negative_prompt=negative_prompt,
-                image=pose_image,
-                num_inference_steps=20,
-                guidance_scale=7.5,
-                controlnet_conditioning_scale=1.0,
-                width=512,
-                height=512,
-                generator=torch.Generator(device=ai_models.device).manual_seed(42)
-            ).images[0]
         else:
             # Use standard generation
             logger.info("Generating without pose control...")
-            image = pipeline(
-                prompt=enhanced_prompt,
-                negative_prompt=negative_prompt,
-                num_inference_steps=20,
-                guidance_scale=7.5,
-                width=512,
-                height=512,
-                generator=torch.Generator(device=ai_models.device).manual_seed(42)
-            ).images[0]
+        image = await batcher.submit(settings, {
+            "prompt": enhanced_prompt,
+            "negative_prompt": negative_prompt,
+            "pose_image": pose_image,
+            "seed": 42
+        })
         
         return image
         
@@ -243,6 +253,7 @@ async def health_check():
         "status": "healthy",
         "device": ai_models.device,
         "models_loaded": ai_models.models_loaded,
+        "batching": batcher.stats(),
         "cuda_available": torch.cuda.is_available(),
         "mps_available": torch.backends.mps.is_available()
     }
@@ -289,7 +300,7 @@ async def generate_pet_portrait(
         # Resize image for processing
         input_image = input_image.resize((512, 512), Image.Resampling.LANCZOS)
         
-        # Run pose detection and generation in thread pool
+        # Run pose detection and prompt building in thread pool
         loop = asyncio.get_event_loop()
         
         def process_image():
@@ -332,19 +343,19 @@ async def generate_pet_portrait(
                 
                 final_prompt = f"{base_prompt}, {style_modifiers.get(art_style, '')}, {cuteness_modifiers.get(cuteness_level, '')}, {color_modifiers.get(color_palette, '')}"
             
-            # Generate image with appropriate style
-            if art_style == "oil_painting":
-                generated_image = generate_styled_image(final_prompt, pose_image, "oil_painting")
-            elif art_style in ["anime", "cartoon", "watercolor", "photography", "minimalist"]:
-                generated_image = generate_styled_image(final_prompt, pose_image, art_style)
-            else:
-                # Fallback to PopMart style for unknown styles
-                generated_image = generate_popmart_image(final_prompt, pose_image)
-            
-            return generated_image, pose_image
+            return final_prompt, pose_image
         
         start_time = time.time()
-        generated_image, pose_image = await loop.run_in_executor(executor, process_image)
+        final_prompt, pose_image = await loop.run_in_executor(None, process_image)
+        
+        # Generate image with appropriate style, batched with concurrent requests
+        if art_style == "oil_painting":
+            generated_image = await generate_styled_image(final_prompt, pose_image, "oil_painting")
+        elif art_style in ["anime", "cartoon", "watercolor", "photography", "minimalist"]:
+            generated_image = await generate_styled_image(final_prompt, pose_image, art_style)
+        else:
+            # Fallback to PopMart style for unknown styles
+            generated_image = await generate_popmart_image(final_prompt, pose_image)
         generation_time = time.time() - start_time
         
         # Convert to base64 for response
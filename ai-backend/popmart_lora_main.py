@@ -11,6 +11,8 @@ import asyncio
 from concurrent.futures import ThreadPoolExecutor
 import time
 
+from batching import BatchScheduler, make_generators
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -92,8 +94,8 @@ async def startup_event():
     logger.info("Starting Pepmart AI Backend (PopMart LoRA Mode)...")
     await ai_models.load_models()
 
-def convert_to_popmart_blindbox(image: Image.Image, style: str) -> Image.Image:
-    """Convert image to authentic PopMart blindbox style using specialized LoRA"""
+def prepare_blindbox_request(image: Image.Image, style: str) -> dict:
+    """Build the prompts and the resized input image for one batch item"""
     
     # Use the exact trigger words from the LoRA documentation
     base_prompt = "blindbox, popmart, "
@@ -119,42 +121,68 @@ def convert_to_popmart_blindbox(image: Image.Image, style: str) -> Image.Image:
     # Use the negative prompt from examples
     negative_prompt = "ugly, bad quality, blurry, distorted, deformed, realistic photography, human"
     
-    try:
-        logger.info(f"Converting to PopMart blindbox style: {prompt[:100]}...")
-        
+    logger.info(f"Converting to PopMart blindbox style: {prompt[:100]}...")
+    
+    return {
+        "prompt": prompt,
+        "negative_prompt": negative_prompt,
         # Resize for SDXL (1024x1024 or maintain aspect ratio)
-        processed_img = image.resize((1024, 1024), Image.Resampling.LANCZOS)
-        
-        # Move VAE to device for generation
-        if ai_models.device == "mps":
-            img2img_pipeline.vae.to(ai_models.device)
-        
-        # Generate with PopMart LoRA
-        with torch.no_grad():
-            result_image = img2img_pipeline(
-                prompt=prompt,
-                negative_prompt=negative_prompt,
-                image=processed_img,
-                strength=0.5,  # Medium strength for good LoRA effect
-                num_inference_steps=30,  # Higher steps for SDXL quality
-                guidance_scale=7.5,
-                cross_attention_kwargs={"scale": 0.8},  # LoRA weight
-                generator=torch.Generator(device=ai_models.device).manual_seed(42)
-            ).images[0]
-        
-        # Enhance for PopMart aesthetic
-        enhancer = ImageEnhance.Color(result_image)
-        result_image = enhancer.enhance(1.2)
-        
-        enhancer = ImageEnhance.Contrast(result_image)
-        result_image = enhancer.enhance(1.1)
-        
-        # Move VAE back to CPU
-        if ai_models.device == "mps":
-            img2img_pipeline.vae.to("cpu")
-            torch.mps.empty_cache()
-        
-        return result_image
+        "image": image.resize((1024, 1024), Image.Resampling.LANCZOS),
+        "seed": 42,
+    }
+
+def run_blindbox_batch(settings: tuple, items: list) -> list:
+    """Run one PopMart LoRA img2img call for a batch of requests that share the same settings"""
+    strength, num_inference_steps, guidance_scale, lora_scale = settings
+    
+    # Move VAE to device for generation
+    if ai_models.device == "mps":
+        img2img_pipeline.vae.to(ai_models.device)
+    
+    # Generate with PopMart LoRA
+    with torch.no_grad():
+        result_images = img2img_pipeline(
+            prompt=[item["prompt"] for item in items],
+            negative_prompt=[item["negative_prompt"] for item in items],
+            image=[item["image"] for item in items],
+            strength=strength,
+            num_inference_steps=num_inference_steps,
+            guidance_scale=guidance_scale,
+            cross_attention_kwargs={"scale": lora_scale},
+            generator=make_generators(ai_models.device, [item["seed"] for item in items])
+        ).images
+    
+    # Move VAE back to CPU
+    if ai_models.device == "mps":
+        img2img_pipeline.vae.to("cpu")
+        torch.mps.empty_cache()
+    
+    return result_images
+
+# medium strength 0.5 for good LoRA effect, 30 steps for SDXL quality, guidance 7.5, LoRA weight 0.8
+BLINDBOX_SETTINGS = (0.5, 30, 7.5, 0.8)
+batcher = BatchScheduler(run_blindbox_batch, executor=executor)
+
+def enhance_blindbox(result_image: Image.Image) -> Image.Image:
+    """Enhance for PopMart aesthetic"""
+    enhancer = ImageEnhance.Color(result_image)
+    result_image = enhancer.enhance(1.2)
+    
+    enhancer = ImageEnhance.Contrast(result_image)
+    result_image = enhancer.enhance(1.1)
+    
+    return result_image
+
+async def convert_to_popmart_blindbox(image: Image.Image, style: str) -> Image.Image:
+    """Convert image to authentic PopMart blindbox style using specialized LoRA"""
+    loop = asyncio.get_event_loop()
+    
+    try:
+        # Resizing and post-processing run on the default thread pool, the pipeline call is
+        # batched with concurrent requests
+        item = await loop.run_in_executor(None, prepare_blindbox_request, image, style)
+        result_image = await batcher.submit(BLINDBOX_SETTINGS, item)
+        return await loop.run_in_executor(None, enhance_blindbox, result_image)
         
     except Exception as e:
         logger.error(f"PopMart LoRA conversion failed: {e}")
@@ -177,6 +205,7 @@ async def health_check():
         "status": "healthy",
         "device": ai_models.device,
         "models_loaded": ai_models.models_loaded,
+        "batching": batcher.stats(),
         "mode": "popmart_lora",
         "lora_model": "twn39/blindbox-popmart-xl",
         "base_model": "SDXL"
@@ -199,14 +228,9 @@ async def generate_pet_portrait(
         
         logger.info(f"Processing image: {image.filename}, size: {input_image.size}")
         
-        # Run PopMart LoRA conversion
-        loop = asyncio.get_event_loop()
-        
-        def popmart_lora_process():
-            return convert_to_popmart_blindbox(input_image, style)
-        
+        # Run PopMart LoRA conversion, batched with concurrent requests
         start_time = time.time()
-        result_image = await loop.run_in_executor(executor, popmart_lora_process)
+        result_image = await convert_to_popmart_blindbox(input_image, style)
         generation_time = time.time() - start_time
         
         # Convert to base64
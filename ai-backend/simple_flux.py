@@ -3,17 +3,22 @@
 Simple FLUX.1-Kontext backend with better timeout handling
 """
 import os
+import io
 import sys
+import queue
 import asyncio
-import subprocess
-import tempfile
-import shutil
 import base64
 import time
 import logging
+import threading
+import multiprocessing as mp
+from multiprocessing import shared_memory
 from pathlib import Path
 from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
+from PIL import Image
+
 from fastapi import FastAPI, HTTPException, File, UploadFile, Form, BackgroundTasks
 from fastapi.responses import JSONResponse
 import uvicorn
@@ -27,91 +32,240 @@ FLUX_PATH = Path(__file__).parent.parent / "flux"
 
 app = FastAPI(title="Simple FLUX.1-Kontext API")
 
-# Thread pool for background processing
-executor = ThreadPoolExecutor(max_workers=1)
+# Persistent FLUX worker processes, each loads the models once
+FLUX_WORKERS = int(os.getenv("FLUX_WORKERS", "1"))
+FLUX_DEVICE = os.getenv("FLUX_DEVICE", "mps")
+# keep the models on the CPU and move each to the device only while it runs, like `--offload`
+# of the CLI, so the encoders, autoencoder and transformer don't all have to fit at once
+FLUX_OFFLOAD = os.getenv("FLUX_OFFLOAD", "1") == "1"
+# seconds a job may take before its worker is killed and restarted, the first job of a worker
+# also gets the time to load the models
+FLUX_JOB_TIMEOUT = float(os.getenv("FLUX_JOB_TIMEOUT", "600"))
+FLUX_LOAD_TIMEOUT = float(os.getenv("FLUX_LOAD_TIMEOUT", "1800"))
+# the content filter (Pixtral 12B on CPU) is loaded once in this process and shared by all
+# workers, set to 1 to load one per worker instead, which multiplies its host memory
+FLUX_FILTER_PER_WORKER = os.getenv("FLUX_FILTER_PER_WORKER", "0") == "1"
+# sizes of the per-worker shared memory buffers for uploaded and generated images
+MAX_UPLOAD_BYTES = 32 * 1024 * 1024
+MAX_OUTPUT_PIXELS = 2048 * 2048
+
+# Thread pool for background processing, one thread per worker process
+executor = ThreadPoolExecutor(max_workers=FLUX_WORKERS)
+
+
+def flux_worker(conn, device: str, input_name: str, output_name: str):
+    """Worker process: loads FLUX.1-Kontext once and serves generation jobs received over `conn`"""
+    # same working directory as the flux CLI, checkpoints are resolved relative to it
+    os.chdir(FLUX_PATH)
+    sys.path.insert(0, str(FLUX_PATH / "src"))
+    # Suppress tokenizer warnings
+    os.environ['TOKENIZERS_PARALLELISM'] = 'false'
+    os.environ['TRANSFORMERS_VERBOSITY'] = 'error'
+
+    import torch
+    from einops import rearrange
+    from flux.content_filters import PixtralContentFilter
+    from flux.session import FluxSession
+    from flux.util import embed_watermark
+
+    input_shm = shared_memory.SharedMemory(name=input_name)
+    output_shm = shared_memory.SharedMemory(name=output_name)
+
+    session = FluxSession(device=device, offload=FLUX_OFFLOAD)
+    content_filter = PixtralContentFilter(torch.device("cpu")) if FLUX_FILTER_PER_WORKER else None
+    conn.send({"ready": True})
+
+    while True:
+        job = conn.recv()
+        if job is None:
+            break
+
+        try:
+            image_bytes = bytes(input_shm.buf[:job["size"]])
+            if content_filter is not None:
+                image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
+                if content_filter.test_txt(job["prompt"]):
+                    conn.send({"success": False, "error": "Your prompt has been automatically flagged"})
+                    continue
+                if content_filter.test_image(image):
+                    conn.send({"success": False, "error": "Your input image has been automatically flagged"})
+                    continue
+
+            x = session.generate_kontext(job["prompt"], io.BytesIO(image_bytes), num_steps=job["steps"], guidance=2.5)
+            if content_filter is not None and content_filter.test_image(x.cpu()):
+                conn.send({"success": False, "error": "Your output image has been automatically flagged"})
+                continue
+
+            x = embed_watermark(x.float().clamp(-1, 1))
+            pixels = (127.5 * (rearrange(x[0], "c h w -> h w c") + 1.0)).cpu().byte().numpy()
+            if pixels.nbytes > output_shm.size:
+                raise ValueError(f"Output image too large ({pixels.shape})")
+            np.ndarray(pixels.shape, dtype=np.uint8, buffer=output_shm.buf)[:] = pixels
+            conn.send({"success": True, "shape": pixels.shape})
+        except Exception as e:
+            # keep the loaded models, only crashes of the process itself need a restart
+            conn.send({"success": False, "error": str(e)})
+
+
+class FluxWorker:
+    """A worker process with its pipe and shared memory buffers for input and output images"""
+
+    def __init__(self, ctx, device: str):
+        self.ctx = ctx
+        self.device = device
+        self.input_shm = shared_memory.SharedMemory(create=True, size=MAX_UPLOAD_BYTES)
+        self.output_shm = shared_memory.SharedMemory(create=True, size=3 * MAX_OUTPUT_PIXELS)
+        self.start()
+
+    def start(self):
+        # set once the worker has loaded its models
+        self.ready = False
+        self.conn, child_conn = self.ctx.Pipe()
+        self.process = self.ctx.Process(
+            target=flux_worker,
+            args=(child_conn, self.device, self.input_shm.name, self.output_shm.name),
+            daemon=True,
+        )
+        self.process.start()
+
+    def restart(self):
+        logger.warning(f"♻️ Restarting FLUX worker (pid {self.process.pid})")
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+        self.start()
+
+    def run(self, image_bytes: bytes, prompt: str, steps: int) -> np.ndarray:
+        if len(image_bytes) > MAX_UPLOAD_BYTES:
+            raise ValueError(f"Image too large ({len(image_bytes)} bytes, max {MAX_UPLOAD_BYTES})")
+        if not self.process.is_alive():
+            # died while idle, don't send it the job
+            self.restart()
+        self.input_shm.buf[:len(image_bytes)] = image_bytes
+        self.conn.send({"size": len(image_bytes), "prompt": prompt, "steps": steps})
+
+        # the first job also waits for the models to load
+        deadline = time.monotonic() + FLUX_JOB_TIMEOUT + (0 if self.ready else FLUX_LOAD_TIMEOUT)
+        while True:
+            while not self.conn.poll(1.0):
+                if not self.process.is_alive():
+                    self.restart()
+                    raise RuntimeError("FLUX worker crashed")
+                if time.monotonic() > deadline:
+                    self.restart()
+                    raise TimeoutError(f"FLUX job timed out after {FLUX_JOB_TIMEOUT:.0f}s, restarted the worker")
+            result = self.conn.recv()
+            if not result.get("ready"):
+                break
+            self.ready = True
+            deadline = time.monotonic() + FLUX_JOB_TIMEOUT
+
+        if not result["success"]:
+            raise RuntimeError(result["error"])
+        shape = result["shape"]
+        return np.ndarray(shape, dtype=np.uint8, buffer=self.output_shm.buf).copy()
+
+    def close(self):
+        try:
+            self.conn.send(None)
+            self.process.join(timeout=10)
+        except (BrokenPipeError, OSError):
+            pass
+        if self.process.is_alive():
+            self.process.kill()
+        self.input_shm.close()
+        self.input_shm.unlink()
+        self.output_shm.close()
+        self.output_shm.unlink()
+
+
+class FluxWorkerPool:
+    """Pool of persistent FLUX workers, jobs go to the next idle worker"""
+
+    def __init__(self, num_workers: int, device: str):
+        ctx = mp.get_context("spawn")
+        self.workers = [FluxWorker(ctx, device) for _ in range(num_workers)]
+        self.idle = queue.Queue()
+        for worker in self.workers:
+            self.idle.put(worker)
+
+    def run(self, image_bytes: bytes, prompt: str, steps: int) -> np.ndarray:
+        worker = self.idle.get()
+        try:
+            return worker.run(image_bytes, prompt, steps)
+        finally:
+            self.idle.put(worker)
+
+    def close(self):
+        for worker in self.workers:
+            worker.close()
+
+
+pool: FluxWorkerPool | None = None
+# content filter shared by all workers, see FLUX_FILTER_PER_WORKER
+content_filter = None
+content_filter_lock = threading.Lock()
+
+
+def load_content_filter():
+    sys.path.insert(0, str(FLUX_PATH / "src"))
+    import torch
+    from flux.content_filters import PixtralContentFilter
+
+    return PixtralContentFilter(torch.device("cpu"))
+
 
-def run_flux_generation(image_path: str, prompt: str, output_dir: str, steps: int = 15) -> dict:
-    """Run FLUX generation in a separate thread"""
+@app.on_event("startup")
+def start_workers():
+    global pool, content_filter
+    logger.info(f"🔧 Starting {FLUX_WORKERS} FLUX worker(s) on {FLUX_DEVICE}")
+    pool = FluxWorkerPool(FLUX_WORKERS, FLUX_DEVICE)
+    if not FLUX_FILTER_PER_WORKER:
+        # loads while the workers load their models
+        content_filter = load_content_filter()
+
+
+@app.on_event("shutdown")
+def stop_workers():
+    if pool is not None:
+        pool.close()
+
+
+def run_flux_generation(image_bytes: bytes, prompt: str, steps: int = 15) -> dict:
+    """Run FLUX generation on the worker pool"""
     try:
-        cmd = [
-            sys.executable, "-m", "flux", "kontext",
-            "--prompt", prompt,
-            "--img_cond_path", image_path,
-            "--guidance", "2.5",
-            "--num_steps", str(steps),
-            "--device", "mps",
-            "--output_dir", output_dir,
-            "--offload"
-        ]
-        
-        env = os.environ.copy()
-        env['PYTHONPATH'] = str(FLUX_PATH / "src")
-        # Suppress tokenizer warnings
-        env['TOKENIZERS_PARALLELISM'] = 'false'
-        env['TRANSFORMERS_VERBOSITY'] = 'error'
-        
         logger.info(f"🚀 Running FLUX: {prompt}")
         start_time = time.time()
-        
-        # Run with no timeout - let it complete
-        result = subprocess.run(
-            cmd,
-            cwd=FLUX_PATH,
-            capture_output=True,
-            text=True,
-            env=env
-        )
-        
+
+        if content_filter is not None:
+            image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
+            with content_filter_lock:
+                if content_filter.test_txt(prompt):
+                    raise ValueError("Your prompt has been automatically flagged")
+                if content_filter.test_image(image):
+                    raise ValueError("Your input image has been automatically flagged")
+
+        pixels = pool.run(image_bytes, prompt, steps)
         generation_time = time.time() - start_time
-        
-        # Check for real errors vs warnings
-        if result.returncode != 0:
-            # Check if it's just the T5 tokenizer warning (not a real error)
-            if "T5Tokenizer" in result.stderr and "legacy" in result.stderr:
-                logger.info("ℹ️ T5 tokenizer legacy warning (can be ignored)")
-                # Check if output was actually generated despite warning
-                output_files = list(Path(output_dir).glob("*.png"))
-                if not output_files:
-                    output_files = list(Path(output_dir).glob("*.jpg"))
-                
-                if output_files:
-                    logger.info("✅ Generation succeeded despite warning")
-                    # Continue to success path below
-                else:
-                    logger.error(f"❌ FLUX failed: {result.stderr}")
-                    return {
-                        "success": False,
-                        "error": f"Generation failed: {result.stderr}",
-                        "generation_time": generation_time
-                    }
-            else:
-                logger.error(f"❌ FLUX failed: {result.stderr}")
-                return {
-                    "success": False,
-                    "error": f"Generation failed: {result.stderr}",
-                    "generation_time": generation_time
-                }
-        
-        if not output_files:
-            return {
-                "success": False,
-                "error": "No output image generated",
-                "generation_time": generation_time
-            }
-        
+
+        if content_filter is not None:
+            with content_filter_lock:
+                if content_filter.test_image(Image.fromarray(pixels)):
+                    raise ValueError("Your output image has been automatically flagged")
+
         # Convert to base64
-        with open(output_files[0], 'rb') as img_file:
-            img_data = img_file.read()
-            base64_image = f"data:image/png;base64,{base64.b64encode(img_data).decode('utf-8')}"
-        
+        buffer = io.BytesIO()
+        Image.fromarray(pixels).save(buffer, format="PNG")
+        base64_image = f"data:image/png;base64,{base64.b64encode(buffer.getvalue()).decode('utf-8')}"
+
         logger.info(f"✅ FLUX completed in {generation_time:.1f}s")
-        
+
         return {
             "success": True,
             "imageUrl": base64_image,
             "generation_time": generation_time
         }
-        
+
     except Exception as e:
         logger.error(f"❌ FLUX generation error: {e}")
         return {
@@ -123,7 +277,8 @@ def run_flux_generation(image_path: str, prompt: str, output_dir: str, steps: in
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
-    return {"status": "healthy", "models_loaded": True}
+    workers_alive = pool is not None and all(w.process.is_alive() for w in pool.workers)
+    return {"status": "healthy" if workers_alive else "degraded", "models_loaded": workers_alive}
 
 @app.post("/generate")
 async def generate_image(
@@ -159,45 +314,30 @@ async def generate_image(
             
             final_prompt = base_prompt + ", high quality, detailed, clean background"
         
-        # Save uploaded image
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.png') as temp_img:
-            shutil.copyfileobj(image.file, temp_img)
-            temp_img_path = temp_img.name
-        
-        output_dir = tempfile.mkdtemp()
-        
-        try:
-            # Run generation in thread pool
-            loop = asyncio.get_event_loop()
-            result = await loop.run_in_executor(
-                executor, 
-                run_flux_generation, 
-                temp_img_path, 
-                final_prompt, 
-                output_dir, 
-                15  # Steps
-            )
-            
-            if result["success"]:
-                return JSONResponse({
-                    "success": True,
-                    "imageUrl": result["imageUrl"],
-                    "analysis": f"Generated in {result['generation_time']:.1f}s using FLUX.1-Kontext",
-                    "generationTime": f"{result['generation_time']:.1f}",
-                    "prompt": final_prompt,
-                    "model": "FLUX.1-Kontext-dev (local)"
-                })
-            else:
-                raise HTTPException(status_code=500, detail=result["error"])
-                
-        finally:
-            # Cleanup
-            try:
-                os.unlink(temp_img_path)
-                shutil.rmtree(output_dir, ignore_errors=True)
-            except:
-                pass
-        
+        image_bytes = await image.read()
+
+        # Run generation in thread pool
+        loop = asyncio.get_event_loop()
+        result = await loop.run_in_executor(
+            executor,
+            run_flux_generation,
+            image_bytes,
+            final_prompt,
+            15  # Steps
+        )
+
+        if result["success"]:
+            return JSONResponse({
+                "success": True,
+                "imageUrl": result["imageUrl"],
+                "analysis": f"Generated in {result['generation_time']:.1f}s using FLUX.1-Kontext",
+                "generationTime": f"{result['generation_time']:.1f}",
+                "prompt": final_prompt,
+                "model": "FLUX.1-Kontext-dev (local)"
+            })
+        else:
+            raise HTTPException(status_code=500, detail=result["error"])
+
     except Exception as e:
         logger.error(f"❌ Error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
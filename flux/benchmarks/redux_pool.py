@@ -0,0 +1,101 @@
+import math
+import time
+from dataclasses import replace
+
+import torch
+from fire import Fire
+
+from flux.model import Flux
+from flux.sampling import get_img_ids
+from flux.util import configs
+
+# SigLIP so400m at 384px produces a 27x27 token grid
+REDUX_GRID = 27
+
+
+def timed(fn, device: torch.device, num_runs: int, warmup: int) -> float:
+    for _ in range(warmup):
+        fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(num_runs):
+        fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / num_runs
+
+
+@torch.inference_mode()
+def main(
+    name: str = "flux-dev",
+    width: int = 1360,
+    height: int = 768,
+    pool_factors: tuple[int, ...] = (1, 2, 3),
+    t5_tokens: int = 512,
+    device: str = "cuda" if torch.cuda.is_available() else "cpu",
+    depth: int | None = None,
+    depth_single_blocks: int | None = None,
+    num_runs: int = 10,
+    warmup: int = 3,
+):
+    """
+    Measures the time of one transformer step with the Redux image tokens of each pooling
+    factor appended to the T5 tokens (729, 196 and 81 tokens for factors 1, 2 and 3), with
+    randomly initialized weights.
+
+    Args:
+        name: Name of the model config
+        width: width of the sample in pixels
+        height: height of the sample in pixels
+        pool_factors: pooling factors to compare, 1 (no pooling) is the reference
+        t5_tokens: number of T5 tokens in front of the Redux tokens
+        device: Pytorch device
+        depth: override the number of double stream blocks, e.g. to fit smaller GPUs
+        depth_single_blocks: override the number of single stream blocks
+        num_runs: timed runs per pooling factor
+        warmup: untimed runs per pooling factor
+    """
+    torch_device = torch.device(device)
+    params = configs[name].params
+    params = replace(
+        params,
+        depth=params.depth if depth is None else depth,
+        depth_single_blocks=params.depth_single_blocks
+        if depth_single_blocks is None
+        else depth_single_blocks,
+    )
+    with torch_device:
+        model = Flux(params).to(torch.bfloat16)
+
+    h, w = height // 16, width // 16
+    img = torch.randn(1, h * w, params.in_channels, device=torch_device, dtype=torch.bfloat16)
+    img_ids = get_img_ids(h, w, 1, device=torch_device)
+    vec = torch.randn(1, params.vec_in_dim, device=torch_device, dtype=torch.bfloat16)
+    timesteps = torch.full((1,), 0.5, device=torch_device, dtype=torch.bfloat16)
+    guidance = torch.full((1,), 2.5, device=torch_device, dtype=torch.bfloat16)
+
+    results = {}
+    for factor in sorted(set(pool_factors) | {1}):
+        # same token count as `ReduxImageEncoder.pool`, which pools with ceil_mode
+        redux_tokens = math.ceil(REDUX_GRID / factor) ** 2
+        length = t5_tokens + redux_tokens
+        txt = torch.randn(1, length, params.context_in_dim, device=torch_device, dtype=torch.bfloat16)
+        txt_ids = torch.zeros(1, length, 3, device=torch_device)
+
+        def step():
+            model(img, img_ids, txt, txt_ids, timesteps, vec, guidance=guidance)
+
+        results[factor] = (redux_tokens, timed(step, torch_device, num_runs, warmup))
+
+    reference = results[1][1]
+    print(f"{name}, {width}x{height}, {params.depth}+{params.depth_single_blocks} blocks on {device}")
+    for factor, (redux_tokens, step_time) in results.items():
+        print(
+            f"pool {factor}: {redux_tokens:3d} redux tokens, step {1000 * step_time:8.1f} ms "
+            f"({reference / step_time:.2f}x)"
+        )
+
+
+if __name__ == "__main__":
+    Fire(main)
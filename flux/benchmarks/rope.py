@@ -0,0 +1,70 @@
+import time
+
+import torch
+from fire import Fire
+
+from flux.math import apply_rope, apply_rope_cos_sin, rope_cos_sin
+from flux.modules.layers import EmbedND
+from flux.sampling import get_img_ids
+
+
+def main(
+    width: int = 1024,
+    height: int = 1024,
+    txt_len: int = 512,
+    num_heads: int = 24,
+    device: str = "cuda" if torch.cuda.is_available() else "cpu",
+    dtype: str = "bfloat16",
+    with_compile: bool = False,
+    num_runs: int = 50,
+):
+    """
+    Times applying rope to q and k of one attention layer with the float32 rotation
+    matrices against the cos/sin tables in the compute dtype.
+
+    Args:
+        width: width of the image in pixels
+        height: height of the image in pixels
+        txt_len: number of text tokens
+        num_heads: attention heads of the model
+        device: Pytorch device
+        dtype: dtype of q, k and the cos/sin tables
+        with_compile: also time the `torch.compile`d cos/sin kernel
+        num_runs: timed runs per variant
+    """
+    torch_device = torch.device(device)
+    torch_dtype = getattr(torch, dtype)
+    h, w = height // 16, width // 16
+    ids = torch.cat((torch.zeros(1, txt_len, 3), get_img_ids(h, w, 1)), dim=1).to(torch_device)
+    pe = EmbedND(dim=128, theta=10_000, axes_dim=[16, 56, 56])(ids)
+    cos_sin = rope_cos_sin(pe, torch_dtype)
+    q = torch.randn(1, num_heads, ids.shape[1], 128, device=torch_device, dtype=torch_dtype)
+    k = torch.randn_like(q)
+
+    variants = {
+        "rotation matrices": lambda: apply_rope(q, k, pe),
+        "cos/sin": lambda: apply_rope_cos_sin(q, k, *cos_sin),
+    }
+    if with_compile:
+        compiled = torch.compile(apply_rope_cos_sin, dynamic=True)
+        variants["cos/sin compiled"] = lambda: compiled(q, k, *cos_sin)
+
+    baseline = None
+    for name, fn in variants.items():
+        # warmup, which also compiles
+        for _ in range(3):
+            fn()
+        if torch_device.type == "cuda":
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        for _ in range(num_runs):
+            fn()
+        if torch_device.type == "cuda":
+            torch.cuda.synchronize()
+        elapsed = (time.perf_counter() - start) / num_runs
+        baseline = baseline or elapsed
+        print(f"{name:18s} {1000 * elapsed:8.3f} ms ({baseline / elapsed:.2f}x)")
+
+
+if __name__ == "__main__":
+    Fire(main)
@@ -0,0 +1,99 @@
+import time
+from dataclasses import replace
+
+import torch
+from fire import Fire
+
+from flux.model import Flux
+from flux.sampling import get_img_ids
+from flux.util import configs, load_t5
+
+
+def timed(fn, device: torch.device, num_runs: int, warmup: int) -> float:
+    for _ in range(warmup):
+        fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(num_runs):
+        fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / num_runs
+
+
+@torch.inference_mode()
+def main(
+    name: str = "flux-dev",
+    width: int = 1024,
+    height: int = 1024,
+    buckets: tuple[int, ...] = (64, 128, 256, 512),
+    device: str = "cuda" if torch.cuda.is_available() else "cpu",
+    depth: int | None = None,
+    depth_single_blocks: int | None = None,
+    num_runs: int = 10,
+    warmup: int = 3,
+    encoder: bool = False,
+):
+    """
+    Measures the time of one transformer step (and optionally of the T5 encoder) for each
+    text length bucket, with randomly initialized weights.
+
+    Args:
+        name: Name of the model config
+        width: width of the sample in pixels
+        height: height of the sample in pixels
+        buckets: padded text lengths to compare, the largest one is the reference
+        device: Pytorch device
+        depth: override the number of double stream blocks, e.g. to fit smaller GPUs
+        depth_single_blocks: override the number of single stream blocks
+        num_runs: timed runs per bucket
+        warmup: untimed runs per bucket
+        encoder: also time T5 (downloads the encoder weights)
+    """
+    torch_device = torch.device(device)
+    params = configs[name].params
+    params = replace(
+        params,
+        depth=params.depth if depth is None else depth,
+        depth_single_blocks=params.depth_single_blocks
+        if depth_single_blocks is None
+        else depth_single_blocks,
+    )
+    with torch_device:
+        model = Flux(params).to(torch.bfloat16)
+
+    h, w = height // 16, width // 16
+    img = torch.randn(1, h * w, params.in_channels, device=torch_device, dtype=torch.bfloat16)
+    img_ids = get_img_ids(h, w, 1, device=torch_device)
+    vec = torch.randn(1, params.vec_in_dim, device=torch_device, dtype=torch.bfloat16)
+    timesteps = torch.full((1,), 0.5, device=torch_device, dtype=torch.bfloat16)
+    guidance = torch.full((1,), 2.5, device=torch_device, dtype=torch.bfloat16)
+
+    t5 = load_t5(torch_device, max_length=max(buckets), length_buckets=list(buckets)) if encoder else None
+
+    results = {}
+    for length in sorted(buckets):
+        txt = torch.randn(1, length, params.context_in_dim, device=torch_device, dtype=torch.bfloat16)
+        txt_ids = torch.zeros(1, length, 3, device=torch_device)
+
+        def step():
+            model(img, img_ids, txt, txt_ids, timesteps, vec, guidance=guidance)
+
+        results[length] = {"step": timed(step, torch_device, num_runs, warmup)}
+        if t5 is not None:
+            # a prompt that fills about half of the bucket
+            prompt = " ".join(["word"] * (length // 2))
+            results[length]["t5"] = timed(lambda: t5([prompt]), torch_device, num_runs, warmup)
+
+    reference = results[max(buckets)]
+    print(f"{name}, {width}x{height}, {params.depth}+{params.depth_single_blocks} blocks on {device}")
+    for length, times in results.items():
+        line = f"bucket {length:4d}: step {1000 * times['step']:8.1f} ms ({reference['step'] / times['step']:.2f}x)"
+        if "t5" in times:
+            line += f", t5 {1000 * times['t5']:7.1f} ms ({reference['t5'] / times['t5']:.2f}x)"
+        print(line)
+
+
+if __name__ == "__main__":
+    Fire(main)
@@ -0,0 +1,46 @@
+import time
+
+import torch
+from fire import Fire
+
+from flux.util import WATERMARK_BITS, WatermarkEmbedder
+
+
+def main(
+    width: int = 1024,
+    height: int = 1024,
+    batch_sizes: tuple[int, ...] = (1, 2, 4, 8, 16),
+    num_workers: int = 8,
+    num_runs: int = 3,
+):
+    """
+    Compares watermarking batches in the calling process against the process pool.
+
+    Args:
+        width: width of the images in pixels
+        height: height of the images in pixels
+        batch_sizes: batch sizes to time
+        num_workers: processes of the pool
+        num_runs: timed runs per batch size
+    """
+    embedders = {"serial": WatermarkEmbedder(WATERMARK_BITS, num_workers=1)}
+    embedders["pool"] = WatermarkEmbedder(WATERMARK_BITS, num_workers=num_workers)
+    # start the pool outside of the timed runs
+    embedders["pool"](torch.zeros(2, 3, 256, 256))
+
+    for batch_size in batch_sizes:
+        image = torch.rand(batch_size, 3, height, width) * 2 - 1
+        times = {}
+        for name, embed in embedders.items():
+            start = time.perf_counter()
+            for _ in range(num_runs):
+                embed(image)
+            times[name] = (time.perf_counter() - start) / num_runs
+        print(
+            f"batch {batch_size:3d}: serial {1000 * times['serial']:8.1f} ms, "
+            f"pool {1000 * times['pool']:8.1f} ms ({times['serial'] / times['pool']:.2f}x)"
+        )
+
+
+if __name__ == "__main__":
+    Fire(main)
@@ -8,14 +8,17 @@ import torch
 from fire import Fire
 from transformers import pipeline
 
+from flux.modules.conditioner import T5_LENGTH_BUCKETS
 from flux.sampling import denoise, get_noise, get_schedule, prepare, unpack
 from flux.util import (
+    ImageWriter,
     check_onnx_access_for_trt,
     configs,
     load_ae,
     load_clip,
     load_flow_model,
     load_t5,
+    quantize_int8_dynamic,
     save_image,
 )
 
@@ -119,6 +122,16 @@ def main(
     trt: bool = False,
     trt_transformer_precision: str = "bf16",
     track_usage: bool = False,
+    solver: str = "euler",
+    memory_budget_gb: float | None = None,
+    cpu_int8: bool = False,
+    t5_length_buckets: bool = False,
+    precompute_modulations: bool = False,
+    keep_mmap: bool = False,
+    fast_rope: bool = False,
+    output_format: str = "jpg",
+    output_quality: int = 95,
+    write_workers: int = 2,
 ):
     """
     Sample the flux model. Either interactively (set `--loop`) or run for a
@@ -140,6 +153,24 @@ def main(
         trt: use TensorRT backend for optimized inference
         trt_transformer_precision: specify transformer precision for inference
         track_usage: track usage of the model for licensing purposes
+        solver: ODE solver used for sampling, one of euler, heun, midpoint, multistep or dpm
+        memory_budget_gb: chunk attention and mlps of the transformer so that their
+            intermediates stay within roughly this many GiB
+        cpu_int8: run the transformer and T5 with int8 dynamically quantized linears in
+            float32, for inference on CPU
+        t5_length_buckets: pad each prompt only to the smallest of 64, 128, 256 or 512
+            tokens that fits it instead of the maximum length, which shortens the text
+            sequence of the transformer but changes the embeddings slightly
+        precompute_modulations: compute the modulations of all steps in one batch before
+            sampling instead of once per step
+        keep_mmap: keep the transformer weights memory-mapped from the checkpoint instead of
+            copying them into RAM, so processes loading the same file share its pages (CPU only)
+        fast_rope: apply rotary position embeddings in the dtype of the transformer from
+            cos/sin tables instead of upcasting q and k to float32
+        output_format: file format of the saved images, one of jpg, webp or png
+        output_quality: encoder quality for jpg and webp
+        write_workers: number of background threads that encode and save the images while
+            the next one is sampled, 0 saves synchronously
     """
 
     prompt = prompt.split("|")
@@ -168,21 +199,40 @@ def main(
     height = 16 * (height // 16)
     width = 16 * (width // 16)
 
-    output_name = os.path.join(output_dir, "img_{idx}.jpg")
+    output_name = os.path.join(output_dir, f"img_{{idx}}.{output_format}")
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
         idx = 0
     else:
-        fns = [fn for fn in iglob(output_name.format(idx="*")) if re.search(r"img_[0-9]+\.jpg$", fn)]
+        fns = [
+            fn for fn in iglob(output_name.format(idx="*")) if re.search(rf"img_[0-9]+\.{output_format}$", fn)
+        ]
         if len(fns) > 0:
             idx = max(int(fn.split("_")[-1].split(".")[0]) for fn in fns) + 1
         else:
             idx = 0
 
+    writer = ImageWriter(num_workers=write_workers) if write_workers > 0 else None
+
     if not trt:
-        t5 = load_t5(torch_device, max_length=256 if name == "flux-schnell" else 512)
+        t5 = load_t5(
+            torch_device,
+            max_length=256 if name == "flux-schnell" else 512,
+            length_buckets=T5_LENGTH_BUCKETS if t5_length_buckets else None,
+        )
         clip = load_clip(torch_device)
-        model = load_flow_model(name, device="cpu" if offload else torch_device)
+        if keep_mmap:
+            # offloading would move the weights off the mapping again
+            assert torch_device.type == "cpu", "keep_mmap is only supported on CPU"
+        model = load_flow_model(name, device="cpu" if offload else torch_device, keep_mmap=keep_mmap)
+        if memory_budget_gb is not None:
+            model.set_memory_budget(int(memory_budget_gb * 2**30))
+        if cpu_int8:
+            assert torch_device.type == "cpu", "int8 dynamic quantization is only supported on CPU"
+            t5, model = quantize_int8_dynamic(t5), quantize_int8_dynamic(model)
+            clip.output_dtype = torch.float32
+        if fast_rope:
+            model.rope_dtype = torch.float32 if cpu_int8 else torch.bfloat16
         ae = load_ae(name, device="cpu" if offload else torch_device)
     else:
         # lazy import to make install optional
@@ -243,7 +293,7 @@ def main(
             opts.height,
             opts.width,
             device=torch_device,
-            dtype=torch.bfloat16,
+            dtype=torch.float32 if cpu_int8 else torch.bfloat16,
             seed=opts.seed,
         )
         opts.seed = None
@@ -261,7 +311,14 @@ def main(
             model = model.to(torch_device)
 
         # denoise initial noise
-        x = denoise(model, **inp, timesteps=timesteps, guidance=opts.guidance)
+        x = denoise(
+            model,
+            **inp,
+            timesteps=timesteps,
+            guidance=opts.guidance,
+            precompute_modulations=precompute_modulations,
+            solver=solver,
+        )
 
         # offload model, load autoencoder to gpu
         if offload:
@@ -282,7 +339,16 @@ def main(
         print(f"Done in {t1 - t0:.1f}s. Saving {fn}")
 
         idx = save_image(
-            nsfw_classifier, name, output_name, idx, x, add_sampling_metadata, prompt, track_usage=track_usage
+            nsfw_classifier,
+            name,
+            output_name,
+            idx,
+            x,
+            add_sampling_metadata,
+            prompt,
+            track_usage=track_usage,
+            quality=output_quality,
+            writer=writer,
         )
 
         if loop:
@@ -294,6 +360,9 @@ def main(
         else:
             opts = None
 
+    if writer is not None:
+        writer.close()
+
     if trt:
         trt_ctx_manager.stop_runtime()
 
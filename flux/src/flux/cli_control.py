@@ -9,8 +9,9 @@ from fire import Fire
 from transformers import pipeline
 
 from flux.modules.image_embedders import CannyImageEncoder, DepthImageEncoder
+from flux.modules.conditioner import EmbeddingCache
 from flux.sampling import denoise, get_noise, get_schedule, prepare_control, unpack
-from flux.util import configs, load_ae, load_clip, load_flow_model, load_t5, save_image
+from flux.util import PeakMemoryCounter, configs, load_ae, load_clip, load_flow_model, load_t5, save_image
 
 
 @dataclass
@@ -287,6 +288,9 @@ def main(
             if hasattr(module, "set_scale"):
                 module.set_scale(lora_scale)
 
+    # in loop mode, iterations on the same conditioning image skip encoding it again
+    conditioning_cache = EmbeddingCache(cache_dir=os.environ.get("FLUX_CONDITIONING_CACHE"))
+
     rng = torch.Generator(device="cpu")
     opts = SamplingOptions(
         prompt=prompt,
@@ -336,6 +340,7 @@ def main(
             ae=ae,
             encoder=img_embedder,
             img_cond_path=opts.img_cond_path,
+            cache=conditioning_cache,
         )
         timesteps = get_schedule(opts.num_steps, inp["img"].shape[1], shift=(name != "flux-schnell"))
 
@@ -346,7 +351,9 @@ def main(
             model = model.to(torch_device)
 
         # denoise initial noise
-        x = denoise(model, **inp, timesteps=timesteps, guidance=opts.guidance)
+        with PeakMemoryCounter(torch_device) as peak_memory:
+            x = denoise(model, **inp, timesteps=timesteps, guidance=opts.guidance)
+        print(f"Denoising peak memory: {peak_memory}")
 
         # offload model, load autoencoder to gpu
         if offload:
@@ -9,8 +9,9 @@ from fire import Fire
 from PIL import Image
 from transformers import pipeline
 
+from flux.modules.conditioner import EmbeddingCache
 from flux.sampling import denoise, get_noise, get_schedule, prepare_fill, unpack
-from flux.util import configs, load_ae, load_clip, load_flow_model, load_t5, save_image
+from flux.util import PeakMemoryCounter, configs, load_ae, load_clip, load_flow_model, load_t5, save_image
 
 
 @dataclass
@@ -185,6 +186,7 @@ def main(
     img_cond_path: str = "assets/cup.png",
     img_mask_path: str = "assets/cup_mask.png",
     track_usage: bool = False,
+    solver: str = "euler",
 ):
     """
     Sample the flux model. Either interactively (set `--loop`) or run for a
@@ -204,6 +206,7 @@ def main(
         img_cond_path: path to conditioning image (jpeg/png/webp)
         img_mask_path: path to conditioning mask (jpeg/png/webp)
         track_usage: track usage of the model for licensing purposes
+        solver: ODE solver used for sampling, one of euler, heun, midpoint, multistep or dpm
     """
     nsfw_classifier = pipeline("image-classification", model="Falconsai/nsfw_image_detection", device=device)
 
@@ -231,6 +234,9 @@ def main(
     model = load_flow_model(name, device="cpu" if offload else torch_device)
     ae = load_ae(name, device="cpu" if offload else torch_device)
 
+    # in loop mode, iterations on the same conditioning image skip encoding it again
+    conditioning_cache = EmbeddingCache(cache_dir=os.environ.get("FLUX_CONDITIONING_CACHE"))
+
     rng = torch.Generator(device="cpu")
     with Image.open(img_cond_path) as img:
         width, height = img.size
@@ -282,6 +288,7 @@ def main(
             ae=ae,
             img_cond_path=opts.img_cond_path,
             mask_path=opts.img_mask_path,
+            cache=conditioning_cache,
         )
 
         timesteps = get_schedule(opts.num_steps, inp["img"].shape[1], shift=(name != "flux-schnell"))
@@ -293,7 +300,9 @@ def main(
             model = model.to(torch_device)
 
         # denoise initial noise
-        x = denoise(model, **inp, timesteps=timesteps, guidance=opts.guidance)
+        with PeakMemoryCounter(torch_device) as peak_memory:
+            x = denoise(model, **inp, timesteps=timesteps, guidance=opts.guidance, solver=solver)
+        print(f"Denoising peak memory: {peak_memory}")
 
         # offload model, load autoencoder to gpu
         if offload:
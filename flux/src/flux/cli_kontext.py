@@ -8,14 +8,19 @@ import torch
 from fire import Fire
 
 from flux.content_filters import PixtralContentFilter
+from flux.model import FirstBlockCache
+from flux.modules.conditioner import T5_LENGTH_BUCKETS, EmbeddingCache
 from flux.sampling import denoise, get_schedule, prepare_kontext, unpack
 from flux.util import (
+    ImageWriter,
+    PeakMemoryCounter,
     aspect_ratio_to_height_width,
     check_onnx_access_for_trt,
     load_ae,
     load_clip,
     load_flow_model,
     load_t5,
+    quantize_int8_dynamic,
     save_image,
 )
 
@@ -163,6 +168,16 @@ def main(
     trt: bool = False,
     trt_transformer_precision: str = "bf16",
     track_usage: bool = False,
+    first_block_cache_threshold: float | None = None,
+    solver: str = "euler",
+    memory_budget_gb: float | None = None,
+    cpu_int8: bool = False,
+    t5_length_buckets: bool = False,
+    precompute_modulations: bool = False,
+    keep_mmap: bool = False,
+    output_format: str = "jpg",
+    output_quality: int = 95,
+    write_workers: int = 2,
 ):
     """
     Sample the flux model. Either interactively (set `--loop`) or run for a
@@ -185,22 +200,44 @@ def main(
         img_cond_path: path to conditioning image (jpeg/png/webp)
         trt: use TensorRT backend for optimized inference
         track_usage: track usage of the model for licensing purposes
+        first_block_cache_threshold: reuse the transformer output of earlier steps while the
+            relative change of the first block's input stays below this value (e.g. 0.05)
+        solver: ODE solver used for sampling, one of euler, heun, midpoint, multistep or dpm
+        memory_budget_gb: chunk attention and mlps of the transformer so that their
+            intermediates stay within roughly this many GiB
+        cpu_int8: run the transformer and T5 with int8 dynamically quantized linears in
+            float32, for inference on CPU
+        t5_length_buckets: pad each prompt only to the smallest of 64, 128, 256 or 512
+            tokens that fits it instead of the maximum length, which shortens the text
+            sequence of the transformer but changes the embeddings slightly
+        precompute_modulations: compute the modulations of all steps in one batch before
+            sampling instead of once per step
+        keep_mmap: keep the transformer weights memory-mapped from the checkpoint instead of
+            copying them into RAM, so processes loading the same file share its pages (CPU only)
+        output_format: file format of the saved images, one of jpg, webp or png
+        output_quality: encoder quality for jpg and webp
+        write_workers: number of background threads that encode and save the images while
+            the next one is sampled, 0 saves synchronously
     """
     assert name == "flux-dev-kontext", f"Got unknown model name: {name}"
 
     torch_device = torch.device(device)
 
-    output_name = os.path.join(output_dir, "img_{idx}.jpg")
+    output_name = os.path.join(output_dir, f"img_{{idx}}.{output_format}")
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
         idx = 0
     else:
-        fns = [fn for fn in iglob(output_name.format(idx="*")) if re.search(r"img_[0-9]+\.jpg$", fn)]
+        fns = [
+            fn for fn in iglob(output_name.format(idx="*")) if re.search(rf"img_[0-9]+\.{output_format}$", fn)
+        ]
         if len(fns) > 0:
             idx = max(int(fn.split("_")[-1].split(".")[0]) for fn in fns) + 1
         else:
             idx = 0
 
+    writer = ImageWriter(num_workers=write_workers) if write_workers > 0 else None
+
     if aspect_ratio is None:
         width = None
         height = None
@@ -208,9 +245,20 @@ def main(
         width, height = aspect_ratio_to_height_width(aspect_ratio)
 
     if not trt:
-        t5 = load_t5(torch_device, max_length=512)
+        t5 = load_t5(
+            torch_device, max_length=512, length_buckets=T5_LENGTH_BUCKETS if t5_length_buckets else None
+        )
         clip = load_clip(torch_device)
-        model = load_flow_model(name, device="cpu" if offload else torch_device)
+        if keep_mmap:
+            # offloading would move the weights off the mapping again
+            assert torch_device.type == "cpu", "keep_mmap is only supported on CPU"
+        model = load_flow_model(name, device="cpu" if offload else torch_device, keep_mmap=keep_mmap)
+        if memory_budget_gb is not None:
+            model.set_memory_budget(int(memory_budget_gb * 2**30))
+        if cpu_int8:
+            assert torch_device.type == "cpu", "int8 dynamic quantization is only supported on CPU"
+            t5, model = quantize_int8_dynamic(t5), quantize_int8_dynamic(model)
+            clip.output_dtype = torch.float32
     else:
         # lazy import to make install optional
         from flux.trt.trt_manager import ModuleName, TRTManager
@@ -246,6 +294,9 @@ def main(
     ae = load_ae(name, device="cpu" if offload else torch_device)
     content_filter = PixtralContentFilter(torch.device("cpu"))
 
+    # in loop mode, iterations on the same conditioning image skip encoding it again
+    conditioning_cache = EmbeddingCache(cache_dir=os.environ.get("FLUX_CONDITIONING_CACHE"))
+
     rng = torch.Generator(device="cpu")
     opts = SamplingOptions(
         prompt=prompt,
@@ -299,10 +350,9 @@ def main(
             bs=1,
             seed=opts.seed,
             device=torch_device,
+            dtype=torch.float32 if cpu_int8 else torch.bfloat16,
+            cache=conditioning_cache,
         )
-        from safetensors.torch import save_file
-
-        save_file({k: v.cpu().contiguous() for k, v in inp.items()}, "output/noise.sft")
         inp.pop("img_cond_orig")
         opts.seed = None
         timesteps = get_schedule(opts.num_steps, inp["img"].shape[1], shift=(name != "flux-schnell"))
@@ -315,10 +365,23 @@ def main(
 
         # denoise initial noise
         t00 = time.time()
-        x = denoise(model, **inp, timesteps=timesteps, guidance=opts.guidance)
-        torch.cuda.synchronize()
+        first_block_cache = None
+        if first_block_cache_threshold is not None and not trt:
+            first_block_cache = FirstBlockCache(first_block_cache_threshold)
+        with PeakMemoryCounter(torch_device) as peak_memory:
+            x = denoise(
+                model,
+                **inp,
+                timesteps=timesteps,
+                guidance=opts.guidance,
+                precompute_modulations=precompute_modulations,
+                first_block_cache=first_block_cache,
+                solver=solver,
+            )
         t01 = time.time()
-        print(f"Denoising took {t01 - t00:.3f}s")
+        print(f"Denoising took {t01 - t00:.3f}s, peak memory {peak_memory}")
+        if first_block_cache is not None:
+            print(f"Skipped {first_block_cache.skipped_steps}/{first_block_cache.steps} steps")
 
         # offload model, load autoencoder to gpu
         if offload:
@@ -353,7 +416,16 @@ def main(
         print(f"Done in {t1 - t0:.1f}s")
 
         idx = save_image(
-            None, name, output_name, idx, x, add_sampling_metadata, prompt, track_usage=track_usage
+            None,
+            name,
+            output_name,
+            idx,
+            x,
+            add_sampling_metadata,
+            prompt,
+            track_usage=track_usage,
+            quality=output_quality,
+            writer=writer,
         )
 
         if loop:
@@ -363,6 +435,9 @@ def main(
         else:
             opts = None
 
+    if writer is not None:
+        writer.close()
+
 
 if __name__ == "__main__":
     Fire(main)
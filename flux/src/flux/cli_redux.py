@@ -9,6 +9,7 @@ from fire import Fire
 from transformers import pipeline
 
 from flux.modules.image_embedders import ReduxImageEncoder
+from flux.modules.conditioner import EmbeddingCache
 from flux.sampling import denoise, get_noise, get_schedule, prepare_redux, unpack
 from flux.util import (
     get_checkpoint_path,
@@ -150,6 +151,7 @@ def main(
     add_sampling_metadata: bool = True,
     img_cond_path: str = "assets/robot.webp",
     track_usage: bool = False,
+    redux_pool: int = 1,
 ):
     """
     Sample the flux model. Either interactively (set `--loop`) or run for a
@@ -169,6 +171,8 @@ def main(
         add_sampling_metadata: Add the prompt to the image Exif metadata
         img_cond_path: path to conditioning image (jpeg/png/webp)
         track_usage: track usage of the model for licensing purposes
+        redux_pool: average pool the image tokens over this many tokens per side, e.g. 3
+            for 81 instead of 729 tokens, which shortens the transformer sequence
     """
 
     nsfw_classifier = pipeline("image-classification", model="Falconsai/nsfw_image_detection", device=device)
@@ -201,7 +205,10 @@ def main(
     redux_path = str(
         get_checkpoint_path("black-forest-labs/FLUX.1-Redux-dev", "flux1-redux-dev.safetensors", "FLUX_REDUX")
     )
-    img_embedder = ReduxImageEncoder(torch_device, redux_path=redux_path)
+    # in loop mode, prompt-only iterations reuse the tokens of the conditioning image
+    img_embedder = ReduxImageEncoder(
+        torch_device, redux_path=redux_path, pool_factor=redux_pool, cache=EmbeddingCache()
+    )
 
     rng = torch.Generator(device="cpu")
     prompt = ""
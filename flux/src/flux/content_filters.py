@@ -1,3 +1,8 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
 import torch
 from einops import rearrange
 from PIL import Image
@@ -56,16 +61,53 @@ Does this prompt have copyright concerns or includes public figures?
 """.strip()
 
 
+def perceptual_hash(image: Image.Image, hash_size: int = 8) -> str:
+    """
+    Difference hash of an image: the signs of horizontal gradients of a tiny grayscale
+    thumbnail. Re-encoded, resized or slightly recompressed copies get the same hash.
+    """
+    pixels = np.asarray(image.convert("L").resize((hash_size + 1, hash_size), Image.Resampling.LANCZOS))
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return np.packbits(bits).tobytes().hex()
+
+
+def image_digest(image: Image.Image) -> str:
+    """
+    Exact digest of the pixels, size and mode of an image.
+    """
+    digest = hashlib.sha256(f"{image.mode}\0{image.size}\0".encode())
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
 class PixtralContentFilter(torch.nn.Module):
+    """
+    Flags NSFW images (Falconsai classifier) and prompts or images with copyright concerns or
+    public figures (Pixtral).
+
+    Verdicts are cached by prompt hash and by an exact digest of the image pixels, up to
+    `cache_size` entries each. Perceptual image hashes are only remembered for flagged images,
+    so that near copies of a flagged image are flagged as well; a matching perceptual hash
+    never lets an image skip the checks. If `escalation_band` = (low, high) is set, images
+    with an NSFW score above `high` are flagged and images below `low` are passed without
+    running Pixtral; only scores in between are escalated. That trades the copyright check of
+    clearly safe images for speed, without it every image that passes the classifier is
+    checked by Pixtral.
+    """
+
     def __init__(
         self,
         device: torch.device = torch.device("cpu"),
         nsfw_threshold: float = 0.85,
+        escalation_band: tuple[float, float] | None = None,
+        cache_size: int = 10_000,
     ):
         super().__init__()
 
         model_id = "mistral-community/pixtral-12b"
         self.processor = AutoProcessor.from_pretrained(model_id)
+        # batched generation continues all sequences at the same (last) position
+        self.processor.tokenizer.padding_side = "left"
         self.model = LlavaForConditionalGeneration.from_pretrained(model_id, device_map=device)
 
         self.yes_token, self.no_token = self.processor.tokenizer.encode(["yes", "no"])
@@ -74,6 +116,25 @@ class PixtralContentFilter(torch.nn.Module):
             "image-classification", model="Falconsai/nsfw_image_detection", device=device
         )
         self.nsfw_threshold = nsfw_threshold
+        self.escalation_band = escalation_band
+
+        self.cache_size = cache_size
+        self._verdicts: OrderedDict[str, bool] = OrderedDict()
+        # the filter is called from worker threads
+        self._verdicts_lock = threading.Lock()
+
+    def _cached(self, key: str) -> bool | None:
+        with self._verdicts_lock:
+            if key in self._verdicts:
+                self._verdicts.move_to_end(key)
+            return self._verdicts.get(key)
+
+    def _store(self, key: str, verdict: bool) -> None:
+        with self._verdicts_lock:
+            self._verdicts[key] = verdict
+            self._verdicts.move_to_end(key)
+            while len(self._verdicts) > self.cache_size:
+                self._verdicts.popitem(last=False)
 
     def yes_no_logit_processor(
         self, input_ids: torch.LongTensor, scores: torch.FloatTensor
@@ -89,48 +150,15 @@ class PixtralContentFilter(torch.nn.Module):
         scores[:, self.no_token] = scores_no_token
         return scores
 
-    def test_image(self, image: Image.Image | str | torch.Tensor) -> bool:
-        if isinstance(image, torch.Tensor):
-            image = rearrange(image[0].clamp(-1.0, 1.0), "c h w -> h w c")
-            image = Image.fromarray((127.5 * (image + 1.0)).cpu().byte().numpy())
-        elif isinstance(image, str):
-            image = Image.open(image)
-
-        classification = next(c for c in self.nsfw_classifier(image) if c["label"] == "nsfw")
-        if classification["score"] > self.nsfw_threshold:
-            return True
-
-        # 512^2 pixels are enough for checking
-        w, h = image.size
-        f = (512**2 / (w * h)) ** 0.5
-        image = image.resize((int(f * w), int(f * h)))
-
-        chat = [
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "content": PROMPT_IMAGE_INTEGRITY,
-                    },
-                    {
-                        "type": "image",
-                        "image": image,
-                    },
-                    {
-                        "type": "text",
-                        "content": PROMPT_IMAGE_INTEGRITY_FOLLOW_UP,
-                    },
-                ],
-            }
-        ]
-
+    def _ask(self, chats: list[list[dict]]) -> list[bool]:
+        # one generate call for all chats, answering yes flags the item
         inputs = self.processor.apply_chat_template(
-            chat,
+            chats,
             add_generation_prompt=True,
             tokenize=True,
             return_dict=True,
             return_tensors="pt",
+            padding=True,
         ).to(self.model.device)
 
         generate_ids = self.model.generate(
@@ -139,33 +167,106 @@ class PixtralContentFilter(torch.nn.Module):
             logits_processor=[self.yes_no_logit_processor],
             do_sample=False,
         )
-        return generate_ids[0, -1].item() == self.yes_token
+        return [token == self.yes_token for token in generate_ids[:, -1].tolist()]
 
-    def test_txt(self, txt: str) -> bool:
-        chat = [
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "content": PROMPT_TEXT_INTEGRITY.format(prompt=txt),
-                    },
-                ],
-            }
-        ]
+    @staticmethod
+    def _to_pil(image: Image.Image | str | torch.Tensor) -> Image.Image:
+        if isinstance(image, torch.Tensor):
+            image = rearrange(image[0].clamp(-1.0, 1.0), "c h w -> h w c")
+            image = Image.fromarray((127.5 * (image + 1.0)).cpu().byte().numpy())
+        elif isinstance(image, str):
+            image = Image.open(image)
+        return image
 
-        inputs = self.processor.apply_chat_template(
-            chat,
-            add_generation_prompt=True,
-            tokenize=True,
-            return_dict=True,
-            return_tensors="pt",
-        ).to(self.model.device)
+    def test_images(self, images: list[Image.Image | str | torch.Tensor]) -> list[bool]:
+        images = [self._to_pil(image) for image in images]
+        keys = [f"image:{image_digest(image)}" for image in images]
+        similar_keys = [f"similar:{perceptual_hash(image)}" for image in images]
+        verdicts = [self._cached(key) for key in keys]
+        for i, similar_key in enumerate(similar_keys):
+            # near copies of flagged images are flagged, everything else is checked
+            if verdicts[i] is None and self._cached(similar_key):
+                verdicts[i] = True
 
-        generate_ids = self.model.generate(
-            **inputs,
-            max_new_tokens=1,
-            logits_processor=[self.yes_no_logit_processor],
-            do_sample=False,
-        )
-        return generate_ids[0, -1].item() == self.yes_token
+        todo = [i for i, verdict in enumerate(verdicts) if verdict is None]
+        escalate = []
+        if len(todo) > 0:
+            classifications = self.nsfw_classifier([images[i] for i in todo])
+            for i, classification in zip(todo, classifications):
+                score = next(c for c in classification if c["label"] == "nsfw")["score"]
+                if score > self.nsfw_threshold:
+                    verdicts[i] = True
+                elif self.escalation_band is not None and score < self.escalation_band[0]:
+                    verdicts[i] = False
+                elif self.escalation_band is not None and score > self.escalation_band[1]:
+                    verdicts[i] = True
+                else:
+                    escalate.append(i)
+
+        if len(escalate) > 0:
+            chats = []
+            for i in escalate:
+                # 512^2 pixels are enough for checking
+                w, h = images[i].size
+                f = (512**2 / (w * h)) ** 0.5
+                image = images[i].resize((int(f * w), int(f * h)))
+                chats.append(
+                    [
+                        {
+                            "role": "user",
+                            "content": [
+                                {
+                                    "type": "text",
+                                    "content": PROMPT_IMAGE_INTEGRITY,
+                                },
+                                {
+                                    "type": "image",
+                                    "image": image,
+                                },
+                                {
+                                    "type": "text",
+                                    "content": PROMPT_IMAGE_INTEGRITY_FOLLOW_UP,
+                                },
+                            ],
+                        }
+                    ]
+                )
+            for i, verdict in zip(escalate, self._ask(chats)):
+                verdicts[i] = verdict
+
+        for i in todo:
+            self._store(keys[i], verdicts[i])
+            if verdicts[i]:
+                self._store(similar_keys[i], True)
+        return verdicts
+
+    def test_image(self, image: Image.Image | str | torch.Tensor) -> bool:
+        return self.test_images([image])[0]
+
+    def test_txts(self, txts: list[str]) -> list[bool]:
+        keys = [f"txt:{hashlib.sha256(txt.encode()).hexdigest()}" for txt in txts]
+        verdicts = [self._cached(key) for key in keys]
+
+        todo = [i for i, verdict in enumerate(verdicts) if verdict is None]
+        if len(todo) > 0:
+            chats = [
+                [
+                    {
+                        "role": "user",
+                        "content": [
+                            {
+                                "type": "text",
+                                "content": PROMPT_TEXT_INTEGRITY.format(prompt=txts[i]),
+                            },
+                        ],
+                    }
+                ]
+                for i in todo
+            ]
+            for i, verdict in zip(todo, self._ask(chats)):
+                verdicts[i] = verdict
+                self._store(keys[i], verdict)
+        return verdicts
+
+    def test_txt(self, txt: str) -> bool:
+        return self.test_txts([txt])[0]
@@ -3,10 +3,36 @@ from einops import rearrange
 from torch import Tensor
 
 
-def attention(q: Tensor, k: Tensor, v: Tensor, pe: Tensor) -> Tensor:
-    q, k = apply_rope(q, k, pe)
+def chunk_rows(memory_budget: int | None, bytes_per_row: int, num_rows: int) -> int:
+    """
+    Number of rows that can be processed at once so that intermediates of `bytes_per_row`
+    per row stay within `memory_budget` bytes (all rows if there is no budget).
+    """
+    if memory_budget is None:
+        return num_rows
+    return max(1, min(num_rows, memory_budget // max(bytes_per_row, 1)))
 
-    x = torch.nn.functional.scaled_dot_product_attention(q, k, v)
+
+def attention(
+    q: Tensor, k: Tensor, v: Tensor, pe: Tensor | tuple[Tensor, Tensor], memory_budget: int | None = None
+) -> Tensor:
+    if isinstance(pe, tuple):
+        q, k = _apply_rope_cos_sin(q, k, *pe)
+    else:
+        q, k = apply_rope(q, k, pe)
+
+    B, H, L, _ = q.shape
+    # without a fused kernel, every query row materializes float32 scores and
+    # probabilities over all keys
+    rows = chunk_rows(memory_budget, 2 * B * H * k.shape[2] * 4, L)
+    if rows >= L:
+        x = torch.nn.functional.scaled_dot_product_attention(q, k, v)
+    else:
+        x = torch.empty_like(q)
+        for start in range(0, L, rows):
+            x[:, :, start : start + rows] = torch.nn.functional.scaled_dot_product_attention(
+                q[:, :, start : start + rows], k, v
+            )
     x = rearrange(x, "B H L D -> B L (H D)")
 
     return x
@@ -28,3 +54,33 @@ def apply_rope(xq: Tensor, xk: Tensor, freqs_cis: Tensor) -> tuple[Tensor, Tenso
     xq_out = freqs_cis[..., 0] * xq_[..., 0] + freqs_cis[..., 1] * xq_[..., 1]
     xk_out = freqs_cis[..., 0] * xk_[..., 0] + freqs_cis[..., 1] * xk_[..., 1]
     return xq_out.reshape(*xq.shape).type_as(xq), xk_out.reshape(*xk.shape).type_as(xk)
+
+
+def rope_cos_sin(pe: Tensor, dtype: torch.dtype) -> tuple[Tensor, Tensor]:
+    """
+    Converts the rotation matrices of `rope` into cos/sin tables of shape (..., D) in `dtype`,
+    which `attention` applies without upcasting q and k to float32.
+    """
+    cos = pe[..., 0, 0].repeat_interleave(2, dim=-1).to(dtype)
+    sin = pe[..., 1, 0].repeat_interleave(2, dim=-1).to(dtype)
+    return cos.contiguous(), sin.contiguous()
+
+
+def apply_rope_cos_sin(xq: Tensor, xk: Tensor, cos: Tensor, sin: Tensor) -> tuple[Tensor, Tensor]:
+    # same rotation of interleaved pairs as `apply_rope`: (x0, x1) -> (x0 cos - x1 sin, x0 sin + x1 cos)
+    def rotate_pairs(x: Tensor) -> Tensor:
+        x0, x1 = x.unflatten(-1, (-1, 2)).unbind(-1)
+        return torch.stack((-x1, x0), dim=-1).flatten(-2)
+
+    return xq * cos + rotate_pairs(xq) * sin, xk * cos + rotate_pairs(xk) * sin
+
+
+_apply_rope_cos_sin = apply_rope_cos_sin
+
+
+def compile_rope(enabled: bool = True) -> None:
+    """
+    Applies cos/sin rope through a `torch.compile`d kernel, which fuses the elementwise ops.
+    """
+    global _apply_rope_cos_sin
+    _apply_rope_cos_sin = torch.compile(apply_rope_cos_sin, dynamic=True) if enabled else apply_rope_cos_sin
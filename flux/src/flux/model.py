@@ -1,8 +1,11 @@
+from collections.abc import Iterator
 from dataclasses import dataclass
+from itertools import islice
 
 import torch
 from torch import Tensor, nn
 
+from flux.math import rope_cos_sin
 from flux.modules.layers import (
     DoubleStreamBlock,
     EmbedND,
@@ -12,6 +15,7 @@ from flux.modules.layers import (
     timestep_embedding,
 )
 from flux.modules.lora import LinearLora, replace_linear_with_lora
+from flux.offload import BlockStreamer
 
 
 @dataclass
@@ -31,6 +35,58 @@ class FluxParams:
     guidance_embed: bool
 
 
+@dataclass
+class FluxModulations:
+    """
+    Precomputed conditioning vector and outputs of all modulation linears. Every tensor has a
+    leading step dimension, indexing with a step returns the modulations of that step.
+    """
+
+    vec: Tensor
+    double: list[tuple[Tensor, Tensor]]
+    single: list[Tensor]
+    final: Tensor
+
+    def __getitem__(self, step: int) -> "FluxModulations":
+        return FluxModulations(
+            vec=self.vec[step],
+            double=[(img_mod[step], txt_mod[step]) for img_mod, txt_mod in self.double],
+            single=[mod[step] for mod in self.single],
+            final=self.final[step],
+        )
+
+
+class FirstBlockCache:
+    """
+    Reuses the residual of all but the first transformer block across denoising steps.
+
+    Every step, the modulated input of the first double stream block is compared to the one
+    of the last fully computed step. If the relative mean absolute change is below
+    `threshold`, the remaining blocks are skipped and their cached residual is added to the
+    output of the first block instead. Create one instance per sampling run.
+    """
+
+    def __init__(self, threshold: float = 0.05):
+        self.threshold = threshold
+        self.reset()
+
+    def reset(self) -> None:
+        self.reference: Tensor | None = None
+        self.residual: Tensor | None = None
+        self.steps = 0
+        self.skipped_steps = 0
+
+    def can_reuse(self, modulated: Tensor) -> bool:
+        if self.reference is None or self.reference.shape != modulated.shape:
+            return False
+        change = (modulated - self.reference).abs().mean() / self.reference.abs().mean()
+        return change.item() < self.threshold
+
+    def update(self, modulated: Tensor, residual: Tensor) -> None:
+        self.reference = modulated
+        self.residual = residual
+
+
 class Flux(nn.Module):
     """
     Transformer model for flow matching on sequences.
@@ -52,6 +108,8 @@ class Flux(nn.Module):
         self.hidden_size = params.hidden_size
         self.num_heads = params.num_heads
         self.pe_embedder = EmbedND(dim=pe_dim, theta=params.theta, axes_dim=params.axes_dim)
+        # dtype of the cos/sin rope tables, None uses the float32 rotation matrices
+        self.rope_dtype: torch.dtype | None = None
         self.img_in = nn.Linear(self.in_channels, self.hidden_size, bias=True)
         self.time_in = MLPEmbedder(in_dim=256, hidden_dim=self.hidden_size)
         self.vector_in = MLPEmbedder(params.vec_in_dim, self.hidden_size)
@@ -80,6 +138,98 @@ class Flux(nn.Module):
         )
 
         self.final_layer = LastLayer(self.hidden_size, 1, self.out_channels)
+        self.block_streamer: BlockStreamer | None = None
+
+    def enable_block_streaming(
+        self, device: str | torch.device, window: int | None = None, memory_budget: int | None = None
+    ) -> None:
+        """
+        Keeps the transformer blocks on the CPU and streams them to `device` while the model
+        runs, with `window` blocks resident at a time (see `BlockStreamer`). Instead of
+        `window`, a `memory_budget` in bytes for the resident blocks may be given. All other
+        layers are moved to `device`.
+        """
+        blocks = [*self.double_blocks, *self.single_blocks]
+        if window is None:
+            window = 2 if memory_budget is None else BlockStreamer.window_from_budget(blocks, memory_budget)
+        for name, module in self.named_children():
+            if name not in ("double_blocks", "single_blocks"):
+                module.to(device)
+        self.block_streamer = BlockStreamer(blocks, device, window=window)
+
+    def iter_blocks(self) -> Iterator[nn.Module]:
+        """
+        Yields the double and then the single stream blocks, streamed to the compute device if
+        block streaming is enabled.
+        """
+        if self.block_streamer is None:
+            yield from self.double_blocks
+            yield from self.single_blocks
+        else:
+            yield from self.block_streamer
+
+    def embed_positions(self, ids: Tensor) -> Tensor | tuple[Tensor, Tensor]:
+        pe = self.pe_embedder(ids)
+        if self.rope_dtype is not None:
+            return rope_cos_sin(pe, self.rope_dtype)
+        return pe
+
+    def set_memory_budget(self, memory_budget: int | None) -> None:
+        """
+        Limits the intermediates of attention and mlps to roughly `memory_budget` bytes by
+        processing them in chunks of query/sequence rows, so peak memory grows linearly with
+        the sequence length. None disables chunking.
+        """
+        for block in [*self.double_blocks, *self.single_blocks]:
+            block.memory_budget = memory_budget
+
+    def embed_vec(self, timesteps: Tensor, y: Tensor, guidance: Tensor | None = None) -> Tensor:
+        vec = self.time_in(timestep_embedding(timesteps, 256))
+        if self.params.guidance_embed:
+            if guidance is None:
+                raise ValueError("Didn't get guidance strength for guidance distilled model.")
+            vec = vec + self.guidance_in(timestep_embedding(guidance, 256))
+        return vec + self.vector_in(y)
+
+    def precompute_modulations(
+        self, timesteps: Tensor, y: Tensor, guidance: Tensor | None = None
+    ) -> FluxModulations:
+        """
+        Runs the timestep/guidance/vector embedders and all modulation linears for every
+        timestep of a schedule at once.
+
+        Args:
+            timesteps: (S,) timesteps of all steps
+            y: (B, vec_in_dim) pooled text embedding
+            guidance: (B,) guidance strength
+
+        Returns:
+            modulations with a leading (S,) dimension, index them to get the ones of a step
+        """
+        n_steps, bs = timesteps.shape[0], y.shape[0]
+        t_vec = timesteps[:, None].expand(n_steps, bs).reshape(-1)
+        y = y.repeat(n_steps, 1)
+        if guidance is not None:
+            guidance = guidance.repeat(n_steps)
+        vec = self.embed_vec(t_vec, y, guidance)
+
+        # all modulation linears take silu(vec), so this is one large matmul per linear
+        vec_act = nn.functional.silu(vec)
+
+        def unflatten(x: Tensor) -> Tensor:
+            return x.reshape(n_steps, bs, *x.shape[1:])
+
+        # with block streaming, this is a single pass over the streamed blocks as well
+        blocks = self.iter_blocks()
+        return FluxModulations(
+            vec=unflatten(vec),
+            double=[
+                (unflatten(block.img_mod.lin(vec_act)), unflatten(block.txt_mod.lin(vec_act)))
+                for block in islice(blocks, len(self.double_blocks))
+            ],
+            single=[unflatten(block.modulation.lin(vec_act)) for block in blocks],
+            final=unflatten(self.final_layer.adaLN_modulation(vec)),
+        )
 
     def forward(
         self,
@@ -90,32 +240,58 @@ class Flux(nn.Module):
         timesteps: Tensor,
         y: Tensor,
         guidance: Tensor | None = None,
+        pe: Tensor | tuple[Tensor, Tensor] | None = None,
+        modulations: FluxModulations | None = None,
+        first_block_cache: FirstBlockCache | None = None,
     ) -> Tensor:
         if img.ndim != 3 or txt.ndim != 3:
             raise ValueError("Input img and txt tensors must have 3 dimensions.")
 
         # running on sequences img
         img = self.img_in(img)
-        vec = self.time_in(timestep_embedding(timesteps, 256))
-        if self.params.guidance_embed:
-            if guidance is None:
-                raise ValueError("Didn't get guidance strength for guidance distilled model.")
-            vec = vec + self.guidance_in(timestep_embedding(guidance, 256))
-        vec = vec + self.vector_in(y)
+        # modulations of a single step, e.g. from `precompute_modulations(...)[step]`
+        vec = self.embed_vec(timesteps, y, guidance) if modulations is None else modulations.vec
         txt = self.txt_in(txt)
 
-        ids = torch.cat((txt_ids, img_ids), dim=1)
-        pe = self.pe_embedder(ids)
+        # the positional embedding only depends on the ids, so samplers may pass it in precomputed
+        if pe is None:
+            ids = torch.cat((txt_ids, img_ids), dim=1)
+            pe = self.embed_positions(ids)
+
+        # with a first block cache, everything after the first block may be replaced by the
+        # residual of an earlier step
+        cached_residual = None
+        blocks = self.iter_blocks()
+        for i, block in enumerate(islice(blocks, len(self.double_blocks))):
+            mod = None if modulations is None else modulations.double[i]
+            if i == 0 and first_block_cache is not None:
+                first_block_cache.steps += 1
+                first_modulated = block.modulated_img(img, vec, mod=mod)
+                if first_block_cache.can_reuse(first_modulated):
+                    cached_residual = first_block_cache.residual
+
+            img, txt = block(img=img, txt=txt, vec=vec, pe=pe, mod=mod)
+            if i == 0 and first_block_cache is not None:
+                if cached_residual is not None:
+                    break
+                first_img = img
 
-        for block in self.double_blocks:
-            img, txt = block(img=img, txt=txt, vec=vec, pe=pe)
+        if cached_residual is not None:
+            blocks.close()
+            first_block_cache.skipped_steps += 1
+            img = img + cached_residual
+        else:
+            img = torch.cat((txt, img), 1)
+            for i, block in enumerate(blocks):
+                mod = None if modulations is None else modulations.single[i]
+                img = block(img, vec=vec, pe=pe, mod=mod)
+            img = img[:, txt.shape[1] :, ...]
 
-        img = torch.cat((txt, img), 1)
-        for block in self.single_blocks:
-            img = block(img, vec=vec, pe=pe)
-        img = img[:, txt.shape[1] :, ...]
+            if first_block_cache is not None:
+                first_block_cache.update(first_modulated, img - first_img)
 
-        img = self.final_layer(img, vec)  # (N, T, patch_size ** 2 * out_channels)
+        mod = None if modulations is None else modulations.final
+        img = self.final_layer(img, vec, mod=mod)  # (N, T, patch_size ** 2 * out_channels)
         return img
 
 
@@ -141,3 +317,18 @@ class FluxLoraWrapper(Flux):
         for module in self.modules():
             if isinstance(module, LinearLora):
                 module.set_scale(scale=scale)
+
+    def merge_lora(self, keep_base_weight: bool = False) -> None:
+        """
+        Folds all LoRA updates into the base weights, see `LinearLora.merge`. With
+        `keep_base_weight`, a CPU copy of every wrapped linear is kept, i.e. about as much host
+        memory as the transformer itself.
+        """
+        for module in self.modules():
+            if isinstance(module, LinearLora):
+                module.merge(keep_base_weight=keep_base_weight)
+
+    def unmerge_lora(self) -> None:
+        for module in self.modules():
+            if isinstance(module, LinearLora):
+                module.unmerge()
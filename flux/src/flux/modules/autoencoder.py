@@ -279,6 +279,70 @@ class DiagonalGaussian(nn.Module):
             return mean
 
 
+def _blend_weights(size: int, overlap: int, ramp_start: bool, ramp_end: bool) -> Tensor:
+    # linear ramps on the edges that overlap with a neighbouring tile, strictly positive so
+    # that every position gets some weight
+    weights = torch.ones(size)
+    overlap = min(overlap, size // 2)
+    if overlap > 0:
+        ramp = torch.linspace(0, 1, overlap + 2)[1:-1]
+        if ramp_start:
+            weights[:overlap] = ramp
+        if ramp_end:
+            weights[-overlap:] = ramp.flip(0)
+    return weights
+
+
+def _tile_starts(size: int, tile: int, stride: int) -> list[int]:
+    if size <= tile:
+        return [0]
+    starts = list(range(0, size - tile + 1, stride))
+    if starts[-1] + tile < size:
+        starts.append(size - tile)
+    return starts
+
+
+def tiled_apply(fn, x: Tensor, tile: int, overlap: int, scale_num: int = 1, scale_den: int = 1) -> Tensor:
+    """
+    Applies `fn` to overlapping spatial tiles of `x` and blends the results linearly.
+
+    Args:
+        fn: maps a (B, C, h, w) tile to (B, C', h * scale, w * scale)
+        x: (B, C, H, W) input
+        tile: tile size in input pixels
+        overlap: overlap between neighbouring tiles in input pixels
+        scale_num, scale_den: spatial scale factor scale_num / scale_den of `fn`
+
+    Returns:
+        (B, C', H * scale, W * scale) blended output
+    """
+    _, _, height, width = x.shape
+    stride = tile - overlap
+    out = None
+    for top in _tile_starts(height, tile, stride):
+        for left in _tile_starts(width, tile, stride):
+            x_tile = x[:, :, top : top + tile, left : left + tile]
+            y_tile = fn(x_tile)
+            if out is None:
+                out_h, out_w = height * scale_num // scale_den, width * scale_num // scale_den
+                out = torch.zeros(
+                    (*y_tile.shape[:2], out_h, out_w), dtype=torch.float32, device=y_tile.device
+                )
+                weight = torch.zeros((out_h, out_w), dtype=torch.float32, device=y_tile.device)
+
+            tile_h, tile_w = y_tile.shape[-2:]
+            out_top, out_left = top * scale_num // scale_den, left * scale_num // scale_den
+            out_overlap = overlap * scale_num // scale_den
+            w_h = _blend_weights(tile_h, out_overlap, top > 0, top + tile < height)
+            w_w = _blend_weights(tile_w, out_overlap, left > 0, left + tile < width)
+            w = (w_h[:, None] * w_w[None, :]).to(y_tile.device)
+
+            out[:, :, out_top : out_top + tile_h, out_left : out_left + tile_w] += y_tile.float() * w
+            weight[out_top : out_top + tile_h, out_left : out_left + tile_w] += w
+
+    return (out / weight).to(y_tile.dtype)
+
+
 class AutoEncoder(nn.Module):
     def __init__(self, params: AutoEncoderParams, sample_z: bool = False):
         super().__init__()
@@ -304,13 +368,64 @@ class AutoEncoder(nn.Module):
 
         self.scale_factor = params.scale_factor
         self.shift_factor = params.shift_factor
+        # spatial downsampling factor between pixels and latents
+        self.ffactor = 2 ** (len(params.ch_mult) - 1)
+        self.set_tiling()
+
+    def set_tiling(
+        self, tile_size: int = 1024, tile_overlap: int = 128, pixel_threshold: int | None = 2048 * 2048
+    ) -> None:
+        """
+        Configures tiled encoding/decoding, which bounds the memory of the attention in the
+        mid blocks for large images.
+
+        Args:
+            tile_size: tile size in pixels
+            tile_overlap: overlap between neighbouring tiles in pixels, blended linearly
+            pixel_threshold: images with more pixels are encoded/decoded in tiles,
+                None disables tiling
+        """
+        if tile_size % self.ffactor != 0 or tile_overlap % self.ffactor != 0:
+            raise ValueError(f"Tile size and overlap must be multiples of {self.ffactor}")
+        if not 0 <= tile_overlap < tile_size:
+            raise ValueError(f"Tile overlap {tile_overlap} must be smaller than the tile size {tile_size}")
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
+        self.pixel_threshold = pixel_threshold
+
+    def _use_tiling(self, height: int, width: int) -> bool:
+        return self.pixel_threshold is not None and height * width > self.pixel_threshold
+
+    def tiled_encode(self, x: Tensor) -> Tensor:
+        z = tiled_apply(
+            lambda x_tile: self.reg(self.encoder(x_tile)),
+            x,
+            tile=self.tile_size,
+            overlap=self.tile_overlap,
+            scale_den=self.ffactor,
+        )
+        return self.scale_factor * (z - self.shift_factor)
+
+    def tiled_decode(self, z: Tensor) -> Tensor:
+        z = z / self.scale_factor + self.shift_factor
+        return tiled_apply(
+            self.decoder,
+            z,
+            tile=self.tile_size // self.ffactor,
+            overlap=self.tile_overlap // self.ffactor,
+            scale_num=self.ffactor,
+        )
 
     def encode(self, x: Tensor) -> Tensor:
+        if self._use_tiling(*x.shape[-2:]):
+            return self.tiled_encode(x)
         z = self.reg(self.encoder(x))
         z = self.scale_factor * (z - self.shift_factor)
         return z
 
     def decode(self, z: Tensor) -> Tensor:
+        if self._use_tiling(z.shape[-2] * self.ffactor, z.shape[-1] * self.ffactor):
+            return self.tiled_decode(z)
         z = z / self.scale_factor + self.shift_factor
         return self.decoder(z)
 
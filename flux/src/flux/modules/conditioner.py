@@ -1,13 +1,122 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import torch
+from safetensors.torch import load_file as load_sft, save_file as save_sft
 from torch import Tensor, nn
-from transformers import CLIPTextModel, CLIPTokenizer, T5EncoderModel, T5Tokenizer
+from transformers import BatchEncoding, CLIPTextModel, CLIPTokenizer, T5EncoderModel, T5Tokenizer
+
+# sequence lengths the T5 encoder is padded to when running with length buckets
+T5_LENGTH_BUCKETS = [64, 128, 256, 512]
+
+
+class EmbeddingCache:
+    """
+    LRU cache for per-prompt text embeddings, bounded by the number of bytes held in memory.
+
+    Entries are keyed by (model version, padded length, output dtype, prompt). If `cache_dir`
+    is set, every computed embedding is also written to `cache_dir` as a safetensors file so
+    that it survives process restarts; entries evicted from memory are then reloaded from disk.
+    The same cache also holds conditioning latents, see `flux.sampling.conditioning_key`.
+    """
+
+    def __init__(self, max_bytes: int = 1 << 30, cache_dir: str | None = None):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+        self._entries: OrderedDict[str, Tensor] = OrderedDict()
+        self._lock = threading.Lock()
+        self.num_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(version: str, max_length: int, prompt: str, dtype: torch.dtype = torch.bfloat16) -> str:
+        return hashlib.sha256(f"{version}\0{max_length}\0{dtype}\0{prompt}".encode()).hexdigest()
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.safetensors")
+
+    def _insert(self, key: str, value: Tensor) -> None:
+        size = value.numel() * value.element_size()
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return
+        self._entries[key] = value
+        self.num_bytes += size
+        while self.num_bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.num_bytes -= evicted.numel() * evicted.element_size()
+
+    def get(self, key: str) -> Tensor | None:
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+
+            if self.cache_dir is not None and os.path.exists(self._disk_path(key)):
+                value = load_sft(self._disk_path(key))["embedding"]
+                self._insert(key, value)
+                self.disk_hits += 1
+                return value
+
+            self.misses += 1
+            return None
+
+    def put(self, key: str, value: Tensor) -> None:
+        with self._lock:
+            self._insert(key, value)
+            if self.cache_dir is not None and not os.path.exists(self._disk_path(key)):
+                # write to a temporary file first so concurrent readers never see partial files
+                tmp_path = f"{self._disk_path(key)}.{os.getpid()}.tmp"
+                save_sft({"embedding": value.detach().cpu().contiguous()}, tmp_path)
+                os.replace(tmp_path, self._disk_path(key))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.num_bytes = 0
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "entries": len(self._entries),
+            "bytes": self.num_bytes,
+        }
 
 
 class HFEmbedder(nn.Module):
-    def __init__(self, version: str, max_length: int, **hf_kwargs):
+    def __init__(
+        self,
+        version: str,
+        max_length: int,
+        cache: EmbeddingCache | None = None,
+        length_buckets: list[int] | None = None,
+        **hf_kwargs,
+    ):
         super().__init__()
+        self.version = version
         self.is_clip = version.startswith("openai")
         self.max_length = max_length
         self.output_key = "pooler_output" if self.is_clip else "last_hidden_state"
+        self.cache = cache
+        # int8 CPU inference runs in float32, see `flux.util.quantize_int8_dynamic`
+        self.output_dtype = torch.bfloat16
+        # CLIP only returns the pooled output, so shorter padding would not save anything
+        if length_buckets is not None and not self.is_clip:
+            self.length_buckets = sorted(b for b in length_buckets if b < max_length) + [max_length]
+        else:
+            self.length_buckets = None
 
         if self.is_clip:
             self.tokenizer: CLIPTokenizer = CLIPTokenizer.from_pretrained(version, max_length=max_length)
@@ -18,8 +127,8 @@ class HFEmbedder(nn.Module):
 
         self.hf_module = self.hf_module.eval().requires_grad_(False)
 
-    def forward(self, text: list[str]) -> Tensor:
-        batch_encoding = self.tokenizer(
+    def tokenize(self, text: list[str]) -> BatchEncoding:
+        return self.tokenizer(
             text,
             truncation=True,
             max_length=self.max_length,
@@ -29,9 +138,54 @@ class HFEmbedder(nn.Module):
             return_tensors="pt",
         )
 
+    def padded_length(self, attention_mask: Tensor) -> int:
+        """
+        Returns the sequence length the batch is padded to, which is the smallest length
+        bucket that fits the longest prompt, or `max_length` if bucketing is disabled.
+        """
+        if self.length_buckets is None:
+            return self.max_length
+        longest = int(attention_mask.sum(dim=1).max())
+        return next(b for b in self.length_buckets if b >= longest)
+
+    def encode(self, input_ids: Tensor) -> Tensor:
+        # like the original models, the padding is not masked out. Prompt tokens attend to it,
+        # so embeddings padded to a length bucket differ slightly from those padded to
+        # `max_length`, which is why bucketing is opt-in
         outputs = self.hf_module(
-            input_ids=batch_encoding["input_ids"].to(self.hf_module.device),
+            input_ids=input_ids.to(self.hf_module.device),
             attention_mask=None,
             output_hidden_states=False,
         )
-        return outputs[self.output_key].bfloat16()
+        return outputs[self.output_key].to(self.output_dtype)
+
+    def cache_key(self, length: int, text: str) -> str:
+        return EmbeddingCache.make_key(self.version, length, text, dtype=self.output_dtype)
+
+    def forward(self, text: list[str]) -> Tensor:
+        batch_encoding = self.tokenize(text)
+        length = self.padded_length(batch_encoding["attention_mask"])
+        # the padding is at the end, so cutting it to the bucket keeps every prompt token
+        input_ids = batch_encoding["input_ids"][:, :length]
+        if self.cache is None:
+            return self.encode(input_ids)
+
+        # every prompt is encoded independently, so the batch can be served per prompt
+        keys = [self.cache_key(length, t) for t in text]
+        embeddings = [self.cache.get(key) for key in keys]
+
+        # first row of every distinct prompt that is not cached yet
+        missing: dict[str, int] = {}
+        for i, (t, emb) in enumerate(zip(text, embeddings)):
+            if emb is None:
+                missing.setdefault(t, i)
+        if len(missing) > 0:
+            # clone so that cached entries don't keep the whole batch tensor alive
+            encoded = self.encode(input_ids[list(missing.values())])
+            encoded = {t: emb.clone() for t, emb in zip(missing, encoded)}
+            for t, emb in encoded.items():
+                self.cache.put(self.cache_key(length, t), emb)
+            embeddings = [encoded[t] if emb is None else emb for t, emb in zip(text, embeddings)]
+
+        device = self.hf_module.device
+        return torch.stack([emb.to(device, self.output_dtype) for emb in embeddings])
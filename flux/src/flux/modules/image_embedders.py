@@ -1,3 +1,7 @@
+import hashlib
+import math
+from concurrent.futures import ThreadPoolExecutor
+
 import cv2
 import numpy as np
 import torch
@@ -7,16 +11,30 @@ from safetensors.torch import load_file as load_sft
 from torch import nn
 from transformers import AutoModelForDepthEstimation, AutoProcessor, SiglipImageProcessor, SiglipVisionModel
 
+from flux.modules.conditioner import EmbeddingCache
 from flux.util import print_load_warning
 
 
+def image_key(img_byte: torch.Tensor, *parts) -> str:
+    """
+    Content hash of an 8-bit image (including its shape) and anything else a map computed
+    from it depends on.
+    """
+    h = hashlib.sha256(img_byte.cpu().numpy().tobytes())
+    h.update("\0".join(str(p) for p in (*img_byte.shape, *parts)).encode())
+    return h.hexdigest()
+
+
 class DepthImageEncoder:
     depth_model_name = "LiheYoung/depth-anything-large-hf"
 
-    def __init__(self, device):
+    def __init__(self, device, cache: EmbeddingCache | None = None, batch_size: int = 4):
         self.device = device
         self.depth_model = AutoModelForDepthEstimation.from_pretrained(self.depth_model_name).to(device)
         self.processor = AutoProcessor.from_pretrained(self.depth_model_name)
+        # depth maps by image content, the depth model only runs for images not seen before
+        self.cache = cache
+        self.batch_size = batch_size
 
     def __call__(self, img: torch.Tensor) -> torch.Tensor:
         hw = img.shape[-2:]
@@ -24,10 +42,23 @@ class DepthImageEncoder:
         img = torch.clamp(img, -1.0, 1.0)
         img_byte = ((img + 1.0) * 127.5).byte()
 
-        img = self.processor(img_byte, return_tensors="pt")["pixel_values"]
-        depth = self.depth_model(img.to(self.device)).predicted_depth
-        depth = repeat(depth, "b h w -> b 3 h w")
-        depth = torch.nn.functional.interpolate(depth, hw, mode="bicubic", antialias=True)
+        keys = [image_key(b, self.depth_model_name) for b in img_byte] if self.cache is not None else None
+        depths = [None] * len(img_byte) if keys is None else [self.cache.get(key) for key in keys]
+
+        missing = [i for i, depth in enumerate(depths) if depth is None]
+        for start in range(0, len(missing), self.batch_size):
+            batch = missing[start : start + self.batch_size]
+            pixel_values = self.processor(img_byte[batch], return_tensors="pt")["pixel_values"]
+            depth = self.depth_model(pixel_values.to(self.device)).predicted_depth
+            depth = torch.nn.functional.interpolate(depth[:, None], hw, mode="bicubic", antialias=True)
+            for i, d in zip(batch, depth):
+                # clone so that cached maps don't keep the whole batch alive
+                depths[i] = d.clone()
+                if self.cache is not None:
+                    self.cache.put(keys[i], depths[i])
+
+        depth = torch.stack([d.to(self.device) for d in depths])
+        depth = repeat(depth, "b 1 h w -> b 3 h w")
 
         depth = depth / 127.5 - 1.0
         return depth
@@ -39,25 +70,40 @@ class CannyImageEncoder:
         device,
         min_t: int = 50,
         max_t: int = 200,
+        cache: EmbeddingCache | None = None,
+        num_threads: int = 4,
     ):
         self.device = device
         self.min_t = min_t
         self.max_t = max_t
+        # edge maps by image content and thresholds
+        self.cache = cache
+        # cv2 releases the GIL, so the images of a batch are processed in parallel
+        self._executor = ThreadPoolExecutor(max_workers=num_threads)
 
-    def __call__(self, img: torch.Tensor) -> torch.Tensor:
-        assert img.shape[0] == 1, "Only batch size 1 is supported"
+    def _canny(self, img_np: np.ndarray) -> torch.Tensor:
+        return torch.from_numpy(cv2.Canny(img_np, self.min_t, self.max_t))
 
-        img = rearrange(img[0], "c h w -> h w c")
+    def __call__(self, img: torch.Tensor) -> torch.Tensor:
+        img = rearrange(img, "b c h w -> b h w c")
         img = torch.clamp(img, -1.0, 1.0)
-        img_np = ((img + 1.0) * 127.5).numpy().astype(np.uint8)
+        img_byte = ((img + 1.0) * 127.5).cpu().byte()
+
+        keys = None
+        if self.cache is not None:
+            keys = [image_key(b, "canny", self.min_t, self.max_t) for b in img_byte]
+        edges = [None] * len(img_byte) if keys is None else [self.cache.get(key) for key in keys]
 
         # Apply Canny edge detection
-        canny = cv2.Canny(img_np, self.min_t, self.max_t)
+        missing = [i for i, e in enumerate(edges) if e is None]
+        for i, e in zip(missing, self._executor.map(self._canny, [img_byte[i].numpy() for i in missing])):
+            edges[i] = e
+            if self.cache is not None:
+                self.cache.put(keys[i], e)
 
         # Convert back to torch tensor and reshape
-        canny = torch.from_numpy(canny).float() / 127.5 - 1.0
-        canny = rearrange(canny, "h w -> 1 1 h w")
-        canny = repeat(canny, "b 1 ... -> b 3 ...")
+        canny = torch.stack(edges).float() / 127.5 - 1.0
+        canny = repeat(canny, "b h w -> b 3 h w")
         return canny.to(self.device)
 
 
@@ -71,10 +117,16 @@ class ReduxImageEncoder(nn.Module):
         redux_dim: int = 1152,
         txt_in_features: int = 4096,
         dtype=torch.bfloat16,
+        pool_factor: int = 1,
+        cache: EmbeddingCache | None = None,
     ) -> None:
         super().__init__()
 
         self.redux_dim = redux_dim
+        # average pooling of the SigLIP token grid, e.g. 3 turns the 27x27 tokens into 9x9
+        self.pool_factor = pool_factor
+        # projected tokens by image content
+        self.cache = cache
         self.device = device if isinstance(device, torch.device) else torch.device(device)
         self.dtype = dtype
 
@@ -89,11 +141,32 @@ class ReduxImageEncoder(nn.Module):
             self.siglip = SiglipVisionModel.from_pretrained(self.siglip_model_name).to(dtype=dtype)
         self.normalize = SiglipImageProcessor.from_pretrained(self.siglip_model_name)
 
+    def pool(self, tokens: torch.Tensor) -> torch.Tensor:
+        if self.pool_factor == 1:
+            return tokens
+        side = math.isqrt(tokens.shape[1])
+        grid = rearrange(tokens, "b (h w) d -> b d h w", h=side, w=side)
+        # with ceil_mode, windows at the border only average the tokens they cover
+        grid = nn.functional.avg_pool2d(grid, self.pool_factor, ceil_mode=True)
+        return rearrange(grid, "b d h w -> b (h w) d")
+
     def __call__(self, x: Image.Image) -> torch.Tensor:
+        key = None
+        if self.cache is not None:
+            key = image_key(
+                torch.frombuffer(bytearray(x.tobytes()), dtype=torch.uint8), x.size, x.mode, self.pool_factor
+            )
+            projected_x = self.cache.get(key)
+            if projected_x is not None:
+                return projected_x.to(self.device)
+
         imgs = self.normalize.preprocess(images=[x], do_resize=True, return_tensors="pt", do_convert_rgb=True)
 
         _encoded_x = self.siglip(**imgs.to(device=self.device, dtype=self.dtype)).last_hidden_state
+        _encoded_x = self.pool(_encoded_x)
 
         projected_x = self.redux_down(nn.functional.silu(self.redux_up(_encoded_x)))
 
+        if self.cache is not None:
+            self.cache.put(key, projected_x)
         return projected_x
@@ -1,11 +1,22 @@
 import math
 from dataclasses import dataclass
+from typing import Callable
 
 import torch
 from einops import rearrange
 from torch import Tensor, nn
 
-from flux.math import attention, rope
+from flux.math import attention, chunk_rows, rope
+
+
+def chunked(fn: Callable[[Tensor], Tensor], x: Tensor, rows: int) -> Tensor:
+    """
+    Applies the token-wise `fn` to chunks of `rows` tokens of x (B, L, D), which bounds the
+    size of the intermediates of `fn`.
+    """
+    if rows >= x.shape[1]:
+        return fn(x)
+    return torch.cat([fn(chunk) for chunk in x.split(rows, dim=1)], dim=1)
 
 
 class EmbedND(nn.Module):
@@ -118,7 +129,14 @@ class Modulation(nn.Module):
         self.lin = nn.Linear(dim, self.multiplier * dim, bias=True)
 
     def forward(self, vec: Tensor) -> tuple[ModulationOut, ModulationOut | None]:
-        out = self.lin(nn.functional.silu(vec))[:, None, :].chunk(self.multiplier, dim=-1)
+        return self.split(self.lin(nn.functional.silu(vec)))
+
+    def split(self, lin_out: Tensor) -> tuple[ModulationOut, ModulationOut | None]:
+        """
+        Splits the output of `self.lin` into shift/scale/gate, so that precomputed
+        modulations can be used instead of running the linear layer again.
+        """
+        out = lin_out[:, None, :].chunk(self.multiplier, dim=-1)
 
         return (
             ModulationOut(*out[:3]),
@@ -133,6 +151,9 @@ class DoubleStreamBlock(nn.Module):
         mlp_hidden_dim = int(hidden_size * mlp_ratio)
         self.num_heads = num_heads
         self.hidden_size = hidden_size
+        self.mlp_hidden_dim = mlp_hidden_dim
+        # bytes available for attention/mlp intermediates, None runs them unchunked
+        self.memory_budget: int | None = None
         self.img_mod = Modulation(hidden_size, double=True)
         self.img_norm1 = nn.LayerNorm(hidden_size, elementwise_affine=False, eps=1e-6)
         self.img_attn = SelfAttention(dim=hidden_size, num_heads=num_heads, qkv_bias=qkv_bias)
@@ -155,9 +176,22 @@ class DoubleStreamBlock(nn.Module):
             nn.Linear(mlp_hidden_dim, hidden_size, bias=True),
         )
 
-    def forward(self, img: Tensor, txt: Tensor, vec: Tensor, pe: Tensor) -> tuple[Tensor, Tensor]:
-        img_mod1, img_mod2 = self.img_mod(vec)
-        txt_mod1, txt_mod2 = self.txt_mod(vec)
+    def modulated_img(self, img: Tensor, vec: Tensor, mod: tuple[Tensor, Tensor] | None = None) -> Tensor:
+        """
+        The normalized and modulated image stream that goes into the attention of this block.
+        """
+        img_mod1, _ = self.img_mod(vec) if mod is None else self.img_mod.split(mod[0])
+        return (1 + img_mod1.scale) * self.img_norm1(img) + img_mod1.shift
+
+    def forward(
+        self, img: Tensor, txt: Tensor, vec: Tensor, pe: Tensor, mod: tuple[Tensor, Tensor] | None = None
+    ) -> tuple[Tensor, Tensor]:
+        if mod is None:
+            img_mod1, img_mod2 = self.img_mod(vec)
+            txt_mod1, txt_mod2 = self.txt_mod(vec)
+        else:
+            img_mod1, img_mod2 = self.img_mod.split(mod[0])
+            txt_mod1, txt_mod2 = self.txt_mod.split(mod[1])
 
         # prepare image for attention
         img_modulated = self.img_norm1(img)
@@ -178,16 +212,27 @@ class DoubleStreamBlock(nn.Module):
         k = torch.cat((txt_k, img_k), dim=2)
         v = torch.cat((txt_v, img_v), dim=2)
 
-        attn = attention(q, k, v, pe=pe)
+        attn = attention(q, k, v, pe=pe, memory_budget=self.memory_budget)
         txt_attn, img_attn = attn[:, : txt.shape[1]], attn[:, txt.shape[1] :]
 
+        # the mlp hidden activations (and their gelu) dominate the memory of the mlps
+        mlp_rows = chunk_rows(
+            self.memory_budget,
+            2 * img.shape[0] * self.mlp_hidden_dim * img.element_size(),
+            max(img.shape[1], txt.shape[1]),
+        )
+
         # calculate the img blocks
         img = img + img_mod1.gate * self.img_attn.proj(img_attn)
-        img = img + img_mod2.gate * self.img_mlp((1 + img_mod2.scale) * self.img_norm2(img) + img_mod2.shift)
+        img = img + img_mod2.gate * chunked(
+            lambda x: self.img_mlp((1 + img_mod2.scale) * self.img_norm2(x) + img_mod2.shift), img, mlp_rows
+        )
 
         # calculate the txt blocks
         txt = txt + txt_mod1.gate * self.txt_attn.proj(txt_attn)
-        txt = txt + txt_mod2.gate * self.txt_mlp((1 + txt_mod2.scale) * self.txt_norm2(txt) + txt_mod2.shift)
+        txt = txt + txt_mod2.gate * chunked(
+            lambda x: self.txt_mlp((1 + txt_mod2.scale) * self.txt_norm2(x) + txt_mod2.shift), txt, mlp_rows
+        )
         return img, txt
 
 
@@ -223,19 +268,51 @@ class SingleStreamBlock(nn.Module):
 
         self.mlp_act = nn.GELU(approximate="tanh")
         self.modulation = Modulation(hidden_size, double=False)
+        # bytes available for attention/mlp intermediates, None runs them unchunked
+        self.memory_budget: int | None = None
 
-    def forward(self, x: Tensor, vec: Tensor, pe: Tensor) -> Tensor:
-        mod, _ = self.modulation(vec)
+    def forward(self, x: Tensor, vec: Tensor, pe: Tensor, mod: Tensor | None = None) -> Tensor:
+        mod, _ = self.modulation(vec) if mod is None else self.modulation.split(mod)
         x_mod = (1 + mod.scale) * self.pre_norm(x) + mod.shift
-        qkv, mlp = torch.split(self.linear1(x_mod), [3 * self.hidden_size, self.mlp_hidden_dim], dim=-1)
+        B, L, _ = x.shape
+        rows = chunk_rows(
+            self.memory_budget,
+            2 * B * (3 * self.hidden_size + self.mlp_hidden_dim) * x.element_size(),
+            L,
+        )
+        if rows >= L:
+            qkv, mlp = torch.split(self.linear1(x_mod), [3 * self.hidden_size, self.mlp_hidden_dim], dim=-1)
+            mlp = self.mlp_act(mlp)
+        else:
+            # run linear1 and the activation on chunks of tokens, so that only the results
+            # but not the intermediates exist for the whole sequence
+            qkv = x_mod.new_empty((B, L, 3 * self.hidden_size))
+            mlp = x_mod.new_empty((B, L, self.mlp_hidden_dim))
+            for start in range(0, L, rows):
+                qkv_chunk, mlp_chunk = torch.split(
+                    self.linear1(x_mod[:, start : start + rows]),
+                    [3 * self.hidden_size, self.mlp_hidden_dim],
+                    dim=-1,
+                )
+                qkv[:, start : start + rows] = qkv_chunk
+                mlp[:, start : start + rows] = self.mlp_act(mlp_chunk)
 
         q, k, v = rearrange(qkv, "B L (K H D) -> K B H L D", K=3, H=self.num_heads)
         q, k = self.norm(q, k, v)
 
         # compute attention
-        attn = attention(q, k, v, pe=pe)
-        # compute activation in mlp stream, cat again and run second linear layer
-        output = self.linear2(torch.cat((attn, self.mlp_act(mlp)), 2))
+        attn = attention(q, k, v, pe=pe, memory_budget=self.memory_budget)
+        # cat the mlp stream again and run second linear layer
+        if rows >= L:
+            output = self.linear2(torch.cat((attn, mlp), 2))
+        else:
+            output = torch.cat(
+                [
+                    self.linear2(torch.cat((attn[:, start : start + rows], mlp[:, start : start + rows]), 2))
+                    for start in range(0, L, rows)
+                ],
+                dim=1,
+            )
         return x + mod.gate * output
 
 
@@ -246,8 +323,10 @@ class LastLayer(nn.Module):
         self.linear = nn.Linear(hidden_size, patch_size * patch_size * out_channels, bias=True)
         self.adaLN_modulation = nn.Sequential(nn.SiLU(), nn.Linear(hidden_size, 2 * hidden_size, bias=True))
 
-    def forward(self, x: Tensor, vec: Tensor) -> Tensor:
-        shift, scale = self.adaLN_modulation(vec).chunk(2, dim=1)
+    def forward(self, x: Tensor, vec: Tensor, mod: Tensor | None = None) -> Tensor:
+        if mod is None:
+            mod = self.adaLN_modulation(vec)
+        shift, scale = mod.chunk(2, dim=1)
         x = (1 + scale[:, None, :]) * self.norm_final(x) + shift[:, None, :]
         x = self.linear(x)
         return x
@@ -1,4 +1,8 @@
+import threading
+from collections import OrderedDict
+
 import torch
+from safetensors.torch import load_file as load_sft
 from torch import nn
 
 
@@ -81,14 +85,277 @@ class LinearLora(nn.Linear):
             device=device,
         )
 
+        self.merged = False
+        self._base_weight: torch.Tensor | None = None
+        self._base_bias: torch.Tensor | None = None
+        self._added_bias = False
+
     def set_scale(self, scale: float) -> None:
         assert isinstance(scale, float), "scalar value must be a float"
-        self.scale = scale
+        if scale == self.scale:
+            return
+        if self.merged and self._base_weight is not None:
+            # re-merge from the copy of the base weight, which is exact
+            self.unmerge()
+            self.scale = scale
+            self.merge(keep_base_weight=True)
+        elif self.merged:
+            # add the difference of the updates in float32, which rounds once per change
+            with torch.no_grad():
+                self.weight.copy_(self.weight.float() + self.delta_weight(scale - self.scale))
+                if self.lora_B.bias is not None:
+                    self.bias.copy_(self.bias.float() + (scale - self.scale) * self.lora_B.bias.float())
+            self.scale = scale
+        else:
+            self.scale = scale
+
+    def delta_weight(self, scale: float | None = None) -> torch.Tensor:
+        scale = self.scale if scale is None else scale
+        return scale * (self.lora_B.weight.float() @ self.lora_A.weight.float())
+
+    @torch.no_grad()
+    def merge(self, keep_base_weight: bool = False) -> None:
+        """
+        Folds `scale * B @ A` (and the scaled lora bias) into the base weight, so that
+        forward only costs a plain linear layer. The update is computed in float32.
+
+        Args:
+            keep_base_weight: keep a CPU copy of the base weight and bias so that `unmerge`
+                and `set_scale` restore them bit-exactly instead of subtracting the update
+                again, which rounds once per call. The copy costs as much host memory as the
+                weights themselves, about 24GB for all linears of the 12B transformer.
+        """
+        if self.merged:
+            return
+
+        if keep_base_weight:
+            self._base_weight = self.weight.detach().to("cpu", copy=True)
+            self._base_bias = None if self.bias is None else self.bias.detach().to("cpu", copy=True)
+
+        self.weight.copy_(self.weight.float() + self.delta_weight())
+        if self.lora_B.bias is not None:
+            if self.bias is None:
+                self.bias = nn.Parameter(
+                    torch.zeros(self.out_features, dtype=self.weight.dtype, device=self.weight.device),
+                    requires_grad=False,
+                )
+                self._added_bias = True
+            self.bias.copy_(self.bias.float() + self.scale * self.lora_B.bias.float())
+        self.merged = True
+
+    @torch.no_grad()
+    def unmerge(self) -> None:
+        if not self.merged:
+            return
+
+        if self._base_weight is not None:
+            self.weight.copy_(self._base_weight)
+            if self._base_bias is not None:
+                self.bias.copy_(self._base_bias)
+            self._base_weight = self._base_bias = None
+        else:
+            self.weight.copy_(self.weight.float() - self.delta_weight())
+            if self.lora_B.bias is not None and not self._added_bias:
+                self.bias.copy_(self.bias.float() - self.scale * self.lora_B.bias.float())
+
+        if self._added_bias:
+            self.bias = None
+            self._added_bias = False
+        self.merged = False
 
     def forward(self, input: torch.Tensor) -> torch.Tensor:
         base_out = super().forward(input)
+        if self.merged:
+            return base_out
 
         _lora_out_B = self.lora_B(self.lora_A(input))
         lora_update = _lora_out_B * self.scale
 
         return base_out + lora_update
+
+
+# suffixes of the LoRA tensors of one linear layer, in PEFT/diffusers and kohya naming
+LORA_KEY_SUFFIXES = {
+    ".lora_A.weight": "lora_A",
+    ".lora_B.weight": "lora_B",
+    ".lora_B.bias": "lora_bias",
+    ".lora_down.weight": "lora_A",
+    ".lora_up.weight": "lora_B",
+    ".alpha": "alpha",
+}
+# prefixes that diffusers and ComfyUI put in front of the module names of the flow model
+LORA_MODULE_PREFIXES = ["transformer.", "diffusion_model.", "model.diffusion_model.", "base_model.model."]
+
+
+class LoraAdapterRegistry:
+    """
+    Pool of LoRA adapters that can be switched on a resident model without reloading it.
+
+    Adapters are registered by name with the path of a LoRA safetensors file and loaded into
+    CPU memory on first use. Supported are the PEFT/diffusers layout (`<module>.lora_A.weight`,
+    `<module>.lora_B.weight`, optionally `<module>.lora_B.bias`, module names optionally
+    prefixed with `transformer.` or `diffusion_model.`) and the kohya layout
+    (`lora_unet_<module with _>.lora_down.weight`, `.lora_up.weight`). An `<module>.alpha`
+    scales the update by alpha / rank. Module names have to match the linear layers of the
+    model, files with other keys (e.g. text encoder LoRAs or DoRA) are rejected.
+
+    `activate` applies a weighted combination of adapters: the weights of every targeted
+    layer are recomputed in float32 from a CPU copy of its base weights plus
+    `scale * B @ A` of each active adapter, so switching adapters never accumulates rounding
+    errors and deactivating restores the base weights exactly. Inactive adapters are evicted
+    least recently used first once the loaded adapters exceed `memory_budget` bytes.
+    """
+
+    def __init__(self, model: nn.Module, memory_budget: int = 4 << 30):
+        self.model = model
+        self.memory_budget = memory_budget
+        self.paths: dict[str, str] = {}
+        self.active: dict[str, float] = {}
+        self._adapters: OrderedDict[str, dict[str, tuple]] = OrderedDict()
+        # per targeted layer: base weight and bias, and the adapters currently applied to it
+        self._base: dict[str, tuple[torch.Tensor, torch.Tensor | None]] = {}
+        self._applied: dict[str, dict[str, float]] = {}
+        self._linears = {name for name, module in model.named_modules() if isinstance(module, nn.Linear)}
+        self._kohya_names = {f"lora_unet_{name.replace('.', '_')}": name for name in self._linears}
+        self._lock = threading.Lock()
+
+    def register(self, name: str, path: str) -> None:
+        self.paths[name] = path
+
+    @staticmethod
+    def _num_bytes(adapter: dict[str, tuple]) -> int:
+        return sum(
+            t.numel() * t.element_size()
+            for tensors in adapter.values()
+            for t in tensors
+            if isinstance(t, torch.Tensor)
+        )
+
+    @property
+    def num_bytes(self) -> int:
+        return sum(self._num_bytes(adapter) for adapter in self._adapters.values())
+
+    def _module_name(self, name: str) -> str | None:
+        if name in self._linears:
+            return name
+        if name in self._kohya_names:
+            return self._kohya_names[name]
+        for prefix in LORA_MODULE_PREFIXES:
+            if name.startswith(prefix) and name[len(prefix) :] in self._linears:
+                return name[len(prefix) :]
+        return None
+
+    def _parse(self, name: str, sd: dict[str, torch.Tensor]) -> dict[str, tuple]:
+        # module name -> (lora_A, lora_B, lora_bias or None, alpha / rank)
+        parts: dict[str, dict[str, torch.Tensor]] = {}
+        unsupported = []
+        for key, tensor in sd.items():
+            suffix = next((s for s in LORA_KEY_SUFFIXES if key.endswith(s)), None)
+            module_name = None if suffix is None else self._module_name(key[: -len(suffix)])
+            if module_name is None:
+                unsupported.append(key)
+                continue
+            parts.setdefault(module_name, {})[LORA_KEY_SUFFIXES[suffix]] = tensor
+        if len(unsupported) > 0:
+            raise ValueError(
+                f"LoRA adapter {name} has {len(unsupported)} keys that don't belong to a linear layer "
+                f"of the model, e.g. {', '.join(unsupported[:3])}"
+            )
+
+        adapter = {}
+        for module_name, tensors in parts.items():
+            if "lora_A" not in tensors or "lora_B" not in tensors:
+                raise ValueError(f"LoRA adapter {name} misses lora_A or lora_B for {module_name}")
+            lora_A, lora_B = tensors["lora_A"], tensors["lora_B"]
+            weight = self.model.get_submodule(module_name).weight
+            rank = lora_A.shape[0]
+            if lora_B.shape[1] != rank or (lora_B.shape[0], lora_A.shape[1]) != tuple(weight.shape):
+                raise ValueError(
+                    f"LoRA adapter {name} doesn't fit {module_name}: got A {tuple(lora_A.shape)} and "
+                    f"B {tuple(lora_B.shape)} for a weight of shape {tuple(weight.shape)}"
+                )
+            lora_bias = tensors.get("lora_bias")
+            if lora_bias is not None and self.model.get_submodule(module_name).bias is None:
+                raise ValueError(f"LoRA adapter {name} has a bias for {module_name}, which has none")
+            factor = tensors["alpha"].item() / rank if "alpha" in tensors else 1.0
+            adapter[module_name] = (lora_A, lora_B, lora_bias, factor)
+        return adapter
+
+    def _load(self, name: str) -> dict[str, tuple]:
+        if name in self._adapters:
+            self._adapters.move_to_end(name)
+            return self._adapters[name]
+        if name not in self.paths:
+            raise KeyError(f"Unknown LoRA adapter: {name}, chose from {', '.join(self.paths)}")
+
+        adapter = self._parse(name, load_sft(self.paths[name], device="cpu"))
+        self._adapters[name] = adapter
+        return adapter
+
+    def _evict(self) -> None:
+        for name in list(self._adapters):
+            if self.num_bytes <= self.memory_budget:
+                break
+            if name not in self.active:
+                del self._adapters[name]
+
+    @torch.no_grad()
+    def _update(self, module_name: str) -> None:
+        # recompute the weights of one layer from its base and the adapters applied to it
+        module = self.model.get_submodule(module_name)
+        base_weight, base_bias = self._base[module_name]
+        if len(self._applied[module_name]) == 0:
+            module.weight.copy_(base_weight)
+            if base_bias is not None:
+                module.bias.copy_(base_bias)
+            del self._base[module_name], self._applied[module_name]
+            return
+
+        device = module.weight.device
+        weight = base_weight.to(device, torch.float32)
+        bias = None if base_bias is None else base_bias.to(device, torch.float32)
+        for name, scale in self._applied[module_name].items():
+            lora_A, lora_B, lora_bias, factor = self._adapters[name][module_name]
+            weight += (scale * factor) * (lora_B.to(device, torch.float32) @ lora_A.to(device, torch.float32))
+            if lora_bias is not None:
+                bias += (scale * factor) * lora_bias.to(device, torch.float32)
+        module.weight.copy_(weight)
+        if bias is not None:
+            module.bias.copy_(bias)
+
+    def activate(self, scales: dict[str, float]) -> None:
+        """
+        Makes `scales` (adapter name -> scale) the applied adapters. All adapters are loaded
+        and checked before any weight is changed, and only layers targeted by adapters whose
+        scale changed are recomputed.
+        """
+        with self._lock:
+            scales = {name: scale for name, scale in scales.items() if scale != 0.0}
+            changed = [
+                name
+                for name in dict.fromkeys([*self.active, *scales])
+                if scales.get(name) != self.active.get(name)
+            ]
+            # raises for unknown or broken adapters while the model is still untouched
+            adapters = {name: self._load(name) for name in changed}
+
+            for name in changed:
+                for module_name in adapters[name]:
+                    if module_name not in self._base:
+                        module = self.model.get_submodule(module_name)
+                        bias = None if module.bias is None else module.bias.detach().to("cpu", copy=True)
+                        self._base[module_name] = (module.weight.detach().to("cpu", copy=True), bias)
+                        self._applied[module_name] = {}
+                    if name in scales:
+                        self._applied[module_name][name] = scales[name]
+                    else:
+                        self._applied[module_name].pop(name, None)
+                    self._update(module_name)
+                if name in scales:
+                    self.active[name] = scales[name]
+                else:
+                    del self.active[name]
+            self._evict()
+
+    def deactivate(self) -> None:
+        self.activate({})
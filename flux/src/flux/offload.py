@@ -0,0 +1,145 @@
+import time
+from collections.abc import Iterator, Sequence
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import nullcontext
+
+import torch
+from torch import Tensor, nn
+
+# ai-backend/PuLID/flux/offload.py is a copy of this module: the PuLID app ships its own
+# `flux` package, which shadows this one on its path, so it can't import it from here.
+# Keep both in sync.
+
+
+class BlockStreamer:
+    """
+    Executes a sequence of blocks whose weights live on the CPU, keeping at most `window`
+    of them on `device` at a time.
+
+    Iterating yields the blocks in order. While block i runs, the weights of the following
+    blocks up to i + window - 1 are copied to `device` by a background thread (on a side
+    stream on CUDA, from pinned memory), so transfers overlap with compute. Once the next
+    block is requested, the device copies of block i are dropped again. The weights are not
+    modified during inference, so nothing has to be copied back.
+
+    The transfer itself is done by `transfer`, which can be overridden, e.g. to simulate a
+    slow device when testing the scheduling on CPU. `wait_time` accumulates the time the
+    compute thread spent waiting for transfers that were not finished yet.
+
+    Only plain tensors can be streamed. Tensor subclasses, such as the weights of modules
+    quantized with optimum.quanto, keep their data in inner tensors that swapping `.data`
+    and pinning would not move, so blocks holding them are rejected with a ValueError.
+    """
+
+    def __init__(self, blocks: Sequence[nn.Module], device: str | torch.device, window: int = 2):
+        self.blocks = list(blocks)
+        self.device = torch.device(device)
+        self.window = max(1, window)
+        self.wait_time = 0.0
+        for block in self.blocks:
+            self._check_streamable(block)
+
+        self._stream = torch.cuda.Stream(self.device) if self.device.type == "cuda" else None
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending: dict[int, Future] = {}
+        # CPU copies of the parameters and buffers of every block, pinned for async copies
+        self._offloaded = [[self._offload(t.data) for t in self._tensors(block)] for block in self.blocks]
+        for i in range(len(self.blocks)):
+            self._evict(i)
+
+    @staticmethod
+    def _tensors(block: nn.Module) -> list[Tensor]:
+        return [*block.parameters(), *block.buffers()]
+
+    @staticmethod
+    def _check_streamable(block: nn.Module) -> None:
+        for name, tensor in [*block.named_parameters(), *block.named_buffers()]:
+            if type(tensor) not in (Tensor, nn.Parameter) or type(tensor.data) is not Tensor:
+                raise ValueError(
+                    f"Can't stream {name} of type {type(tensor).__name__}, "
+                    "only blocks with plain tensors (e.g. not quantized) can be streamed"
+                )
+
+    @staticmethod
+    def can_stream(blocks: Sequence[nn.Module]) -> bool:
+        """
+        Whether all `blocks` hold only plain tensors, i.e. whether they can be streamed.
+        """
+        try:
+            for block in blocks:
+                BlockStreamer._check_streamable(block)
+        except ValueError:
+            return False
+        return True
+
+    @staticmethod
+    def block_bytes(block: nn.Module) -> int:
+        return sum(t.numel() * t.element_size() for t in BlockStreamer._tensors(block))
+
+    @staticmethod
+    def window_from_budget(blocks: Sequence[nn.Module], memory_budget: int) -> int:
+        """
+        Returns the number of blocks that fit into `memory_budget` bytes, at least one.
+        """
+        return max(1, memory_budget // max(BlockStreamer.block_bytes(block) for block in blocks))
+
+    def _offload(self, tensor: Tensor) -> Tensor:
+        tensor = tensor.cpu()
+        if self._stream is not None and not tensor.is_pinned():
+            tensor = tensor.pin_memory()
+        return tensor
+
+    def transfer(self, tensors: list[Tensor]) -> list[Tensor]:
+        return [t.to(self.device, non_blocking=True) for t in tensors]
+
+    def _load(self, i: int) -> tuple[list[Tensor], torch.cuda.Event | None]:
+        with torch.cuda.stream(self._stream) if self._stream is not None else nullcontext():
+            copies = self.transfer(self._offloaded[i])
+        event = None
+        if self._stream is not None:
+            event = torch.cuda.Event()
+            event.record(self._stream)
+        return copies, event
+
+    def _prefetch(self, i: int) -> None:
+        self._pending[i] = self._executor.submit(self._load, i)
+
+    def _acquire(self, i: int) -> None:
+        start = time.perf_counter()
+        copies, event = self._pending.pop(i).result()
+        if event is not None:
+            compute_stream = torch.cuda.current_stream(self.device)
+            compute_stream.wait_event(event)
+            for copy in copies:
+                # the copies were allocated on the side stream but are used on the compute stream
+                copy.record_stream(compute_stream)
+        self.wait_time += time.perf_counter() - start
+
+        for tensor, copy in zip(self._tensors(self.blocks[i]), copies):
+            tensor.data = copy
+
+    def _evict(self, i: int) -> None:
+        for tensor, offloaded in zip(self._tensors(self.blocks[i]), self._offloaded[i]):
+            tensor.data = offloaded
+
+    def __len__(self) -> int:
+        return len(self.blocks)
+
+    def __iter__(self) -> Iterator[nn.Module]:
+        num_blocks = len(self.blocks)
+        for i in range(min(self.window, num_blocks)):
+            self._prefetch(i)
+        try:
+            for i, block in enumerate(self.blocks):
+                self._acquire(i)
+                yield block
+                self._evict(i)
+                if i + self.window < num_blocks:
+                    self._prefetch(i + self.window)
+        finally:
+            # stopped early (or failed), wait for outstanding transfers and drop all device copies
+            for future in self._pending.values():
+                future.result()
+            self._pending.clear()
+            for i in range(num_blocks):
+                self._evict(i)
@@ -1,4 +1,8 @@
+import hashlib
 import math
+import threading
+import weakref
+from collections import OrderedDict
 from typing import Callable
 
 import numpy as np
@@ -7,12 +11,103 @@ from einops import rearrange, repeat
 from PIL import Image
 from torch import Tensor
 
-from .model import Flux
+from .model import FirstBlockCache, Flux
 from .modules.autoencoder import AutoEncoder
-from .modules.conditioner import HFEmbedder
+from .modules.conditioner import EmbeddingCache, HFEmbedder
 from .modules.image_embedders import CannyImageEncoder, DepthImageEncoder, ReduxImageEncoder
 from .util import PREFERED_KONTEXT_RESOLUTIONS
 
+# position ids and rotary embeddings only depend on the sequence layout, so they are shared
+# between all requests with the same resolution (and prompt length)
+POSITION_CACHE_SIZE = 16
+_position_cache_lock = threading.Lock()
+_img_ids_cache: OrderedDict[tuple, Tensor] = OrderedDict()
+_pe_cache: OrderedDict[tuple, tuple[Tensor, Tensor | tuple[Tensor, Tensor]]] = OrderedDict()
+
+
+def _cache_store(cache: OrderedDict, key: tuple, value) -> None:
+    cache[key] = value
+    while len(cache) > POSITION_CACHE_SIZE:
+        cache.popitem(last=False)
+
+
+def get_img_ids(
+    height: int, width: int, bs: int, device: torch.device | str = "cpu", index: int = 0
+) -> Tensor:
+    """
+    Position ids (index, row, column) of a packed latent with `height` x `width` tokens,
+    expanded to batch size `bs`. The returned tensor is shared and must not be modified.
+    """
+    key = (height, width, index, str(device))
+    with _position_cache_lock:
+        img_ids = _img_ids_cache.get(key)
+        if img_ids is None:
+            img_ids = torch.zeros(height, width, 3)
+            img_ids[..., 0] = index
+            img_ids[..., 1] = img_ids[..., 1] + torch.arange(height)[:, None]
+            img_ids[..., 2] = img_ids[..., 2] + torch.arange(width)[None, :]
+            img_ids = rearrange(img_ids, "h w c -> 1 (h w) c").to(device)
+            _cache_store(_img_ids_cache, key, img_ids)
+        else:
+            _img_ids_cache.move_to_end(key)
+    return img_ids.expand(bs, -1, -1)
+
+
+# fingerprints of the autoencoder weights, computed once per instance
+_ae_fingerprints: "weakref.WeakKeyDictionary[AutoEncoder, str]" = weakref.WeakKeyDictionary()
+
+
+def conditioning_key(img_cond_path, ae: AutoEncoder, *parts) -> str:
+    """
+    Content address of a conditioning latent: a hash of the image bytes, the autoencoder it
+    is encoded with and everything else the latent depends on (encoder type, target size, ...).
+    `img_cond_path` may also be a file object, which is rewound after reading.
+    """
+    if hasattr(img_cond_path, "read"):
+        image_bytes = img_cond_path.read()
+        img_cond_path.seek(0)
+    else:
+        with open(img_cond_path, "rb") as f:
+            image_bytes = f.read()
+
+    if ae not in _ae_fingerprints:
+        # the first conv of the encoder tells apart different autoencoder weights
+        weight = ae.encoder.conv_in.weight.detach().float().cpu().numpy()
+        _ae_fingerprints[ae] = hashlib.sha256(
+            weight.tobytes() + f"{ae.scale_factor}\0{ae.shift_factor}".encode()
+        ).hexdigest()
+
+    h = hashlib.sha256(image_bytes)
+    h.update(_ae_fingerprints[ae].encode())
+    h.update("\0".join(str(p) for p in parts).encode())
+    return h.hexdigest()
+
+
+def get_pe(model: Flux, ids: Tensor) -> Tensor | tuple[Tensor, Tensor]:
+    """
+    Rotary position embeddings of `model` for `ids`, reused across calls with the same ids.
+    """
+    pe_embedder = model.pe_embedder
+    key = (
+        pe_embedder.theta,
+        tuple(pe_embedder.axes_dim),
+        model.rope_dtype,
+        tuple(ids.shape),
+        ids.dtype,
+        str(ids.device),
+    )
+    with _position_cache_lock:
+        cached = _pe_cache.get(key)
+        # the key only covers the layout, make sure the ids actually match
+        if cached is not None and torch.equal(cached[0], ids):
+            _pe_cache.move_to_end(key)
+            return cached[1]
+
+    pe = model.embed_positions(ids)
+    with _position_cache_lock:
+        _cache_store(_pe_cache, key, (ids, pe))
+    return pe
+
 
 def get_noise(
     num_samples: int,
@@ -42,10 +137,7 @@ def prepare(t5: HFEmbedder, clip: HFEmbedder, img: Tensor, prompt: str | list[st
     if img.shape[0] == 1 and bs > 1:
         img = repeat(img, "1 ... -> bs ...", bs=bs)
 
-    img_ids = torch.zeros(h // 2, w // 2, 3)
-    img_ids[..., 1] = img_ids[..., 1] + torch.arange(h // 2)[:, None]
-    img_ids[..., 2] = img_ids[..., 2] + torch.arange(w // 2)[None, :]
-    img_ids = repeat(img_ids, "h w c -> b (h w) c", b=bs)
+    img_ids = get_img_ids(h // 2, w // 2, bs, device=img.device)
 
     if isinstance(prompt, str):
         prompt = [prompt]
@@ -60,7 +152,7 @@ def prepare(t5: HFEmbedder, clip: HFEmbedder, img: Tensor, prompt: str | list[st
 
     return {
         "img": img,
-        "img_ids": img_ids.to(img.device),
+        "img_ids": img_ids,
         "txt": txt.to(img.device),
         "txt_ids": txt_ids.to(img.device),
         "vec": vec.to(img.device),
@@ -75,27 +167,44 @@ def prepare_control(
     ae: AutoEncoder,
     encoder: DepthImageEncoder | CannyImageEncoder,
     img_cond_path: str,
+    cache: EmbeddingCache | None = None,
 ) -> dict[str, Tensor]:
     # load and encode the conditioning image
     bs, _, h, w = img.shape
     if bs == 1 and not isinstance(prompt, str):
         bs = len(prompt)
 
-    img_cond = Image.open(img_cond_path).convert("RGB")
-
     width = w * 8
     height = h * 8
-    img_cond = img_cond.resize((width, height), Image.Resampling.LANCZOS)
-    img_cond = np.array(img_cond)
-    img_cond = torch.from_numpy(img_cond).float() / 127.5 - 1.0
-    img_cond = rearrange(img_cond, "h w c -> 1 c h w")
-
-    with torch.no_grad():
-        img_cond = encoder(img_cond)
-        img_cond = ae.encode(img_cond)
 
-    img_cond = img_cond.to(torch.bfloat16)
-    img_cond = rearrange(img_cond, "b c (h ph) (w pw) -> b (h w) (c ph pw)", ph=2, pw=2)
+    # with a cache, the encoders only run for images that weren't seen at this size before
+    img_cond = None
+    if cache is not None:
+        encoder_type = (
+            type(encoder).__name__,
+            getattr(encoder, "min_t", None),
+            getattr(encoder, "max_t", None),
+        )
+        key = conditioning_key(img_cond_path, ae, *encoder_type, width, height)
+        img_cond = cache.get(key)
+
+    if img_cond is None:
+        img_cond = Image.open(img_cond_path).convert("RGB")
+        img_cond = img_cond.resize((width, height), Image.Resampling.LANCZOS)
+        img_cond = np.array(img_cond)
+        img_cond = torch.from_numpy(img_cond).float() / 127.5 - 1.0
+        img_cond = rearrange(img_cond, "h w c -> 1 c h w")
+
+        with torch.no_grad():
+            img_cond = encoder(img_cond)
+            img_cond = ae.encode(img_cond)
+
+        img_cond = img_cond.to(torch.bfloat16)
+        img_cond = rearrange(img_cond, "b c (h ph) (w pw) -> b (h w) (c ph pw)", ph=2, pw=2)
+        if cache is not None:
+            cache.put(key, img_cond)
+
+    img_cond = img_cond.to(img.device)
     if img_cond.shape[0] == 1 and bs > 1:
         img_cond = repeat(img_cond, "1 ... -> bs ...", bs=bs)
 
@@ -112,46 +221,54 @@ def prepare_fill(
     ae: AutoEncoder,
     img_cond_path: str,
     mask_path: str,
+    cache: EmbeddingCache | None = None,
 ) -> dict[str, Tensor]:
     # load and encode the conditioning image and the mask
     bs, _, _, _ = img.shape
     if bs == 1 and not isinstance(prompt, str):
         bs = len(prompt)
 
-    img_cond = Image.open(img_cond_path).convert("RGB")
-    img_cond = np.array(img_cond)
-    img_cond = torch.from_numpy(img_cond).float() / 127.5 - 1.0
-    img_cond = rearrange(img_cond, "h w c -> 1 c h w")
+    # the packed latent depends on the image and the mask, so both are part of the key
+    img_cond = None
+    if cache is not None:
+        key = conditioning_key(img_cond_path, ae, "fill", conditioning_key(mask_path, ae))
+        img_cond = cache.get(key)
+
+    if img_cond is None:
+        img_cond = Image.open(img_cond_path).convert("RGB")
+        img_cond = np.array(img_cond)
+        img_cond = torch.from_numpy(img_cond).float() / 127.5 - 1.0
+        img_cond = rearrange(img_cond, "h w c -> 1 c h w")
+
+        mask = Image.open(mask_path).convert("L")
+        mask = np.array(mask)
+        mask = torch.from_numpy(mask).float() / 255.0
+        mask = rearrange(mask, "h w -> 1 1 h w")
+
+        with torch.no_grad():
+            img_cond = img_cond.to(img.device)
+            mask = mask.to(img.device)
+            img_cond = img_cond * (1 - mask)
+            img_cond = ae.encode(img_cond)
+            mask = mask[:, 0, :, :]
+            mask = mask.to(torch.bfloat16)
+            mask = rearrange(
+                mask,
+                "b (h ph) (w pw) -> b (ph pw) h w",
+                ph=8,
+                pw=8,
+            )
+            mask = rearrange(mask, "b c (h ph) (w pw) -> b (h w) (c ph pw)", ph=2, pw=2)
+
+        img_cond = img_cond.to(torch.bfloat16)
+        img_cond = rearrange(img_cond, "b c (h ph) (w pw) -> b (h w) (c ph pw)", ph=2, pw=2)
+        img_cond = torch.cat((img_cond, mask), dim=-1)
+        if cache is not None:
+            cache.put(key, img_cond)
 
-    mask = Image.open(mask_path).convert("L")
-    mask = np.array(mask)
-    mask = torch.from_numpy(mask).float() / 255.0
-    mask = rearrange(mask, "h w -> 1 1 h w")
-
-    with torch.no_grad():
-        img_cond = img_cond.to(img.device)
-        mask = mask.to(img.device)
-        img_cond = img_cond * (1 - mask)
-        img_cond = ae.encode(img_cond)
-        mask = mask[:, 0, :, :]
-        mask = mask.to(torch.bfloat16)
-        mask = rearrange(
-            mask,
-            "b (h ph) (w pw) -> b (ph pw) h w",
-            ph=8,
-            pw=8,
-        )
-        mask = rearrange(mask, "b c (h ph) (w pw) -> b (h w) (c ph pw)", ph=2, pw=2)
-        if mask.shape[0] == 1 and bs > 1:
-            mask = repeat(mask, "1 ... -> bs ...", bs=bs)
-
-    img_cond = img_cond.to(torch.bfloat16)
-    img_cond = rearrange(img_cond, "b c (h ph) (w pw) -> b (h w) (c ph pw)", ph=2, pw=2)
     if img_cond.shape[0] == 1 and bs > 1:
         img_cond = repeat(img_cond, "1 ... -> bs ...", bs=bs)
 
-    img_cond = torch.cat((img_cond, mask), dim=-1)
-
     return_dict = prepare(t5, clip, img, prompt)
     return_dict["img_cond"] = img_cond.to(img.device)
     return return_dict
@@ -181,10 +298,7 @@ def prepare_redux(
     if img.shape[0] == 1 and bs > 1:
         img = repeat(img, "1 ... -> bs ...", bs=bs)
 
-    img_ids = torch.zeros(h // 2, w // 2, 3)
-    img_ids[..., 1] = img_ids[..., 1] + torch.arange(h // 2)[:, None]
-    img_ids[..., 2] = img_ids[..., 2] + torch.arange(w // 2)[None, :]
-    img_ids = repeat(img_ids, "h w c -> b (h w) c", b=bs)
+    img_ids = get_img_ids(h // 2, w // 2, bs, device=img.device)
 
     if isinstance(prompt, str):
         prompt = [prompt]
@@ -200,7 +314,7 @@ def prepare_redux(
 
     return {
         "img": img,
-        "img_ids": img_ids.to(img.device),
+        "img_ids": img_ids,
         "txt": txt.to(img.device),
         "txt_ids": txt_ids.to(img.device),
         "vec": vec.to(img.device),
@@ -218,6 +332,8 @@ def prepare_kontext(
     target_width: int | None = None,
     target_height: int | None = None,
     bs: int = 1,
+    dtype: torch.dtype = torch.bfloat16,
+    cache: EmbeddingCache | None = None,
 ) -> tuple[dict[str, Tensor], int, int]:
     # load and encode the conditioning image
     if bs == 1 and not isinstance(prompt, str):
@@ -237,21 +353,30 @@ def prepare_kontext(
     img_cond = rearrange(img_cond, "h w c -> 1 c h w")
     img_cond_orig = img_cond.clone()
 
-    with torch.no_grad():
-        img_cond = ae.encode(img_cond.to(device))
+    # with a cache, the autoencoder only runs for images that weren't seen before
+    latent = None
+    if cache is not None:
+        if hasattr(img_cond_path, "seek"):
+            img_cond_path.seek(0)
+        key = conditioning_key(img_cond_path, ae, "kontext", 8 * width, 8 * height)
+        latent = cache.get(key)
 
-    img_cond = img_cond.to(torch.bfloat16)
-    img_cond = rearrange(img_cond, "b c (h ph) (w pw) -> b (h w) (c ph pw)", ph=2, pw=2)
+    if latent is None:
+        with torch.no_grad():
+            latent = ae.encode(img_cond.to(device))
+
+        latent = latent.to(torch.bfloat16)
+        latent = rearrange(latent, "b c (h ph) (w pw) -> b (h w) (c ph pw)", ph=2, pw=2)
+        if cache is not None:
+            cache.put(key, latent)
+
+    img_cond = latent.to(device)
     if img_cond.shape[0] == 1 and bs > 1:
         img_cond = repeat(img_cond, "1 ... -> bs ...", bs=bs)
 
     # image ids are the same as base image with the first dimension set to 1
     # instead of 0
-    img_cond_ids = torch.zeros(height // 2, width // 2, 3)
-    img_cond_ids[..., 0] = 1
-    img_cond_ids[..., 1] = img_cond_ids[..., 1] + torch.arange(height // 2)[:, None]
-    img_cond_ids[..., 2] = img_cond_ids[..., 2] + torch.arange(width // 2)[None, :]
-    img_cond_ids = repeat(img_cond_ids, "h w c -> b (h w) c", b=bs)
+    img_cond_ids = get_img_ids(height // 2, width // 2, bs, device=device, index=1)
 
     if target_width is None:
         target_width = 8 * width
@@ -263,13 +388,13 @@ def prepare_kontext(
         target_height,
         target_width,
         device=device,
-        dtype=torch.bfloat16,
+        dtype=dtype,
         seed=seed,
     )
 
     return_dict = prepare(t5, clip, img, prompt)
     return_dict["img_cond_seq"] = img_cond
-    return_dict["img_cond_seq_ids"] = img_cond_ids.to(device)
+    return_dict["img_cond_seq_ids"] = img_cond_ids
     return_dict["img_cond_orig"] = img_cond_orig
     return return_dict, target_height, target_width
 
@@ -305,6 +430,35 @@ def get_schedule(
     return timesteps.tolist()
 
 
+SOLVERS = ("euler", "heun", "midpoint", "multistep", "dpm")
+
+
+def _half_log_snr(t: float) -> float:
+    # log(alpha_t / sigma_t) for the rectified flow x_t = (1 - t) * x_0 + t * noise
+    return math.log((1 - t) / t)
+
+
+def _dpm_solver_2m_step(
+    img: Tensor, x0: Tensor, t_curr: float, t_prev: float, prev_x0: Tensor | None, prev_t: float | None
+) -> Tensor:
+    """
+    DPM-Solver++(2M) step for rectified flow, using the data prediction x0 = x_t - t * v.
+    Falls back to first order on the first step and returns x0 on the final step to t=0.
+    """
+    if t_prev == 0:
+        return x0
+
+    d = x0
+    # at t=1 the log-SNR is -inf, so there is no usable previous step yet
+    if prev_x0 is not None and prev_t < 1:
+        h = _half_log_snr(t_prev) - _half_log_snr(t_curr)
+        r = (_half_log_snr(t_curr) - _half_log_snr(prev_t)) / h
+        d = (1 + 1 / (2 * r)) * x0 - (1 / (2 * r)) * prev_x0
+
+    # (sigma_prev / sigma_curr) * x - alpha_prev * (exp(-h) - 1) * d, without the infinite h at t=1
+    return img.mul_(t_prev / t_curr).add_(d, alpha=(1 - t_prev) - t_prev * (1 - t_curr) / t_curr)
+
+
 def denoise(
     model: Flux,
     # model input
@@ -321,34 +475,111 @@ def denoise(
     # extra img tokens (sequence-wise)
     img_cond_seq: Tensor | None = None,
     img_cond_seq_ids: Tensor | None = None,
+    # run the modulations of all steps as one batch up front (native model only)
+    precompute_modulations: bool = False,
+    # skip the blocks after the first one on steps that barely change (native model only),
+    # `first_block_cache.skipped_steps` reports how many steps were skipped
+    first_block_cache: FirstBlockCache | None = None,
+    # ODE solver, one of SOLVERS
+    solver: str = "euler",
 ):
+    if solver not in SOLVERS:
+        raise ValueError(f"Got unknown solver: {solver}, chose from {', '.join(SOLVERS)}")
+
     # this is ignored for schnell
     guidance_vec = torch.full((img.shape[0],), guidance, device=img.device, dtype=img.dtype)
-    for t_curr, t_prev in zip(timesteps[:-1], timesteps[1:]):
-        t_vec = torch.full((img.shape[0],), t_curr, dtype=img.dtype, device=img.device)
-        img_input = img
-        img_input_ids = img_ids
+
+    img_input_ids = img_ids
+    if img_cond_seq is not None:
+        assert (
+            img_cond_seq_ids is not None
+        ), "You need to provide either both or neither of the sequence conditioning"
+        img_input_ids = torch.cat((img_input_ids, img_cond_seq_ids), dim=1)
+
+    # the rotary embeddings are the same for every step, compute them once
+    # (only the native model accepts them, TRT engines compute their own)
+    model_kwargs = {}
+    if isinstance(model, Flux):
+        model_kwargs["pe"] = get_pe(model, torch.cat((txt_ids, img_input_ids), dim=1))
+        if first_block_cache is not None:
+            model_kwargs["first_block_cache"] = first_block_cache
+
+    # timesteps the model is evaluated at, the midpoint solver also needs the step midpoints
+    eval_timesteps = list(timesteps[:-1])
+    if solver == "midpoint":
+        eval_timesteps += [(t_curr + t_prev) / 2 for t_curr, t_prev in zip(timesteps[:-1], timesteps[1:])]
+    modulation_index = {t: i for i, t in enumerate(dict.fromkeys(eval_timesteps))}
+
+    modulations = None
+    if precompute_modulations and isinstance(model, Flux):
+        t_all = torch.tensor(list(modulation_index), dtype=img.dtype, device=img.device)
+        modulations = model.precompute_modulations(t_all, vec, guidance_vec)
+
+    # the conditioning never changes, so it is written into a preallocated input buffer
+    # once and only the img slice is updated in place every step
+    bs, seq_len, channels = img.shape
+    img_input = None
+    if img_cond is not None or img_cond_seq is not None:
+        cond_channels = 0 if img_cond is None else img_cond.shape[-1]
+        cond_seq_len = 0 if img_cond_seq is None else img_cond_seq.shape[1]
+        img_input = torch.empty(
+            (bs, seq_len + cond_seq_len, channels + cond_channels), dtype=img.dtype, device=img.device
+        )
         if img_cond is not None:
-            img_input = torch.cat((img, img_cond), dim=-1)
+            img_input[:, :seq_len, channels:] = img_cond
         if img_cond_seq is not None:
-            assert (
-                img_cond_seq_ids is not None
-            ), "You need to provide either both or neither of the sequence conditioning"
-            img_input = torch.cat((img_input, img_cond_seq), dim=1)
-            img_input_ids = torch.cat((img_input_ids, img_cond_seq_ids), dim=1)
+            img_input[:, seq_len:] = img_cond_seq
+
+    t_vec = torch.empty((bs,), dtype=img.dtype, device=img.device)
+
+    def velocity(x: Tensor, t: float) -> Tensor:
+        t_vec.fill_(t)
+        if modulations is not None:
+            model_kwargs["modulations"] = modulations[modulation_index[t]]
+        if img_input is not None:
+            img_input[:, :seq_len, :channels] = x
         pred = model(
-            img=img_input,
+            img=x if img_input is None else img_input,
             img_ids=img_input_ids,
             txt=txt,
             txt_ids=txt_ids,
             y=vec,
             timesteps=t_vec,
             guidance=guidance_vec,
+            **model_kwargs,
         )
-        if img_input_ids is not None:
-            pred = pred[:, : img.shape[1]]
+        return pred[:, :seq_len]
 
-        img = img + (t_prev - t_curr) * pred
+    # latents are updated in place, don't modify the caller's tensor
+    img = img.clone()
+    # velocity (multistep) or data prediction (dpm) of the previous step
+    prev_pred, prev_t = None, None
+    for t_curr, t_prev in zip(timesteps[:-1], timesteps[1:]):
+        dt = t_prev - t_curr
+        pred = velocity(img, t_curr)
+
+        if solver == "heun" and t_prev > 0:
+            # the corrector at t_prev is the next step's evaluation time, so the last step
+            # (to t=0) stays a plain euler step
+            pred_prev = velocity(img + dt * pred, t_prev)
+            img.add_(pred + pred_prev, alpha=dt / 2)
+        elif solver == "midpoint":
+            pred_mid = velocity(img + (dt / 2) * pred, (t_curr + t_prev) / 2)
+            img.add_(pred_mid, alpha=dt)
+        elif solver == "multistep" and prev_pred is not None:
+            # 2nd order Adams-Bashforth with variable step sizes, reuses the last velocity
+            r = dt / (t_curr - prev_t)
+            img.add_(pred, alpha=dt * (1 + r / 2)).add_(prev_pred, alpha=-dt * r / 2)
+        elif solver == "dpm":
+            x0 = img - t_curr * pred
+            img = _dpm_solver_2m_step(img, x0, t_curr, t_prev, prev_pred, prev_t)
+        else:
+            img.add_(pred, alpha=dt)
+
+        if solver == "multistep":
+            prev_pred, prev_t = pred, t_curr
+        elif solver == "dpm":
+            prev_pred, prev_t = x0, t_curr
 
     return img
 
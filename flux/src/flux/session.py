@@ -0,0 +1,341 @@
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import torch
+from PIL import Image
+from torch import Tensor, nn
+
+from flux.model import Flux, FluxLoraWrapper
+from flux.modules.conditioner import EmbeddingCache
+from flux.modules.image_embedders import CannyImageEncoder, DepthImageEncoder, ReduxImageEncoder
+from flux.sampling import (
+    denoise,
+    get_noise,
+    get_schedule,
+    prepare,
+    prepare_control,
+    prepare_fill,
+    prepare_kontext,
+    prepare_redux,
+    unpack,
+)
+from flux.util import configs, get_checkpoint_path, load_ae, load_clip, load_flow_model, load_t5
+
+
+class FluxSession:
+    """
+    One resident set of text encoders and autoencoder shared by all sampling modes.
+
+    T5, CLIP and the AE are loaded once (all variants use the same autoencoder). Flow models
+    are loaded the first time a variant is used and kept in least recently used order. If
+    `memory_budget` (bytes) is set, older flow models are dropped before a new one is loaded
+    so that the attached flow models stay within the budget.
+
+    With `offload`, all models are kept on the CPU and each is moved to `device` only while
+    it is used, like `--offload` of the CLIs, so only one of them occupies device memory at a
+    time. The image encoders of the control and redux variants stay on `device`.
+    `precompute_modulations` is passed on to `denoise`. With `keep_mmap` (CPU only), the flow
+    model weights stay memory-mapped from the checkpoint, see `load_checkpoint_streamed`.
+
+    The `generate*` methods take the same options as the corresponding CLIs and return the
+    decoded image as a (1, 3, H, W) tensor in [-1, 1], e.g. for `flux.util.save_image`.
+    """
+
+    def __init__(
+        self,
+        device: str | torch.device = "cuda",
+        memory_budget: int | None = None,
+        embedding_cache: EmbeddingCache | None = None,
+        conditioning_cache: EmbeddingCache | None = None,
+        offload: bool = False,
+        precompute_modulations: bool = False,
+        keep_mmap: bool = False,
+    ):
+        self.device = torch.device(device)
+        self.memory_budget = memory_budget
+        self.offload = offload
+        self.precompute_modulations = precompute_modulations
+        if keep_mmap and self.device.type != "cpu":
+            raise ValueError(f"keep_mmap is only supported on CPU, got device {self.device}")
+        self.keep_mmap = keep_mmap
+        # where the models live between uses
+        self._home = torch.device("cpu") if offload else self.device
+        self.t5 = load_t5(self._home, max_length=512, cache=embedding_cache)
+        self.clip = load_clip(self._home, cache=embedding_cache)
+        self.ae = load_ae("flux-dev", device=self._home)
+        # encoded conditioning images, shared by kontext, fill and control
+        self.conditioning_cache = conditioning_cache
+
+        self._models: OrderedDict[str, Flux] = OrderedDict()
+        # LoRA scale each resident LoRA model is merged with
+        self._lora_scales: dict[str, float] = {}
+        self._image_encoders: dict[str, DepthImageEncoder | CannyImageEncoder | ReduxImageEncoder] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def model_bytes(name: str) -> int:
+        # the parameter count of a variant, without loading anything
+        config = configs[name]
+        with torch.device("meta"):
+            if config.lora_repo_id is not None and config.lora_filename is not None:
+                model = FluxLoraWrapper(params=config.params)
+            else:
+                model = Flux(config.params)
+        # weights are kept in bfloat16
+        return 2 * sum(p.numel() for p in model.parameters())
+
+    @property
+    def attached(self) -> list[str]:
+        return list(self._models)
+
+    def _evict(self, required_bytes: int) -> None:
+        def num_bytes(model: Flux) -> int:
+            return sum(p.numel() * p.element_size() for p in model.parameters())
+
+        resident = sum(num_bytes(model) for model in self._models.values())
+        while self._models and resident + required_bytes > self.memory_budget:
+            name, model = self._models.popitem(last=False)
+            self._lora_scales.pop(name, None)
+            resident -= num_bytes(model)
+            print(f"Detaching {name}")
+        if self.device.type == "cuda":
+            torch.cuda.empty_cache()
+
+    @contextmanager
+    def _on_device(self, *modules: nn.Module):
+        """Moves `modules` to the device for the duration of the block when offloading"""
+        if not self.offload:
+            yield
+            return
+        for module in modules:
+            module.to(self.device)
+        try:
+            yield
+        finally:
+            for module in modules:
+                module.cpu()
+            if self.device.type == "cuda":
+                torch.cuda.empty_cache()
+            elif self.device.type == "mps":
+                torch.mps.empty_cache()
+
+    def get_model(self, name: str) -> Flux:
+        if name not in configs:
+            available = ", ".join(configs.keys())
+            raise ValueError(f"Got unknown model name: {name}, chose from {available}")
+
+        with self._lock:
+            if name in self._models:
+                self._models.move_to_end(name)
+                return self._models[name]
+
+            if self.memory_budget is not None:
+                self._evict(self.model_bytes(name))
+            model = load_flow_model(name, device=self._home, keep_mmap=self.keep_mmap)
+            self._models[name] = model
+            return model
+
+    def _image_encoder(self, name: str) -> DepthImageEncoder | CannyImageEncoder | ReduxImageEncoder:
+        if name not in self._image_encoders:
+            # depth and canny maps share the cache with the latents
+            if name == "depth":
+                self._image_encoders[name] = DepthImageEncoder(self.device, cache=self.conditioning_cache)
+            elif name == "canny":
+                self._image_encoders[name] = CannyImageEncoder(self.device, cache=self.conditioning_cache)
+            elif name == "redux":
+                redux_path = str(
+                    get_checkpoint_path(
+                        "black-forest-labs/FLUX.1-Redux-dev", "flux1-redux-dev.safetensors", "FLUX_REDUX"
+                    )
+                )
+                self._image_encoders[name] = ReduxImageEncoder(
+                    self.device, redux_path=redux_path, cache=self.conditioning_cache
+                )
+        return self._image_encoders[name]
+
+    def _noise(self, width: int, height: int, seed: int | None) -> Tensor:
+        if seed is None:
+            seed = torch.Generator(device="cpu").seed()
+        return get_noise(1, height, width, self.device, torch.bfloat16, seed)
+
+    def _sample(
+        self,
+        name: str,
+        inp: dict[str, Tensor],
+        width: int,
+        height: int,
+        num_steps: int,
+        guidance: float,
+        solver: str = "euler",
+    ) -> Tensor:
+        model = self.get_model(name)
+        timesteps = get_schedule(num_steps, inp["img"].shape[1], shift=(name != "flux-schnell"))
+        with self._on_device(model):
+            x = denoise(
+                model,
+                **inp,
+                timesteps=timesteps,
+                guidance=guidance,
+                precompute_modulations=self.precompute_modulations,
+                solver=solver,
+            )
+
+        # decode latents to pixel space
+        x = unpack(x.float(), height, width)
+        with self._on_device(self.ae.decoder):
+            with torch.autocast(device_type=self.device.type, dtype=torch.bfloat16):
+                return self.ae.decode(x)
+
+    @torch.inference_mode()
+    def generate(
+        self,
+        prompt: str,
+        name: str = "flux-dev-krea",
+        width: int = 1360,
+        height: int = 768,
+        num_steps: int | None = None,
+        guidance: float = 2.5,
+        seed: int | None = None,
+        solver: str = "euler",
+    ) -> Tensor:
+        if num_steps is None:
+            num_steps = 4 if name == "flux-schnell" else 50
+        # allow for packing and conversion to latent space
+        height, width = 16 * (height // 16), 16 * (width // 16)
+        x = self._noise(width, height, seed)
+        with self._on_device(self.t5, self.clip):
+            inp = prepare(self.t5, self.clip, x, prompt=prompt)
+        return self._sample(name, inp, width, height, num_steps, guidance, solver=solver)
+
+    @torch.inference_mode()
+    def generate_kontext(
+        self,
+        prompt: str,
+        img_cond_path: str,
+        width: int | None = None,
+        height: int | None = None,
+        num_steps: int = 30,
+        guidance: float = 2.5,
+        seed: int | None = None,
+        solver: str = "euler",
+    ) -> Tensor:
+        if seed is None:
+            seed = torch.Generator(device="cpu").seed()
+        with self._on_device(self.t5, self.clip, self.ae):
+            inp, height, width = prepare_kontext(
+                t5=self.t5,
+                clip=self.clip,
+                prompt=prompt,
+                ae=self.ae,
+                img_cond_path=img_cond_path,
+                seed=seed,
+                device=self.device,
+                target_width=width,
+                target_height=height,
+                cache=self.conditioning_cache,
+            )
+        inp.pop("img_cond_orig")
+        return self._sample("flux-dev-kontext", inp, width, height, num_steps, guidance, solver=solver)
+
+    @torch.inference_mode()
+    def generate_fill(
+        self,
+        prompt: str,
+        img_cond_path: str,
+        img_mask_path: str,
+        num_steps: int = 50,
+        guidance: float = 30.0,
+        seed: int | None = None,
+        solver: str = "euler",
+    ) -> Tensor:
+        # the output has the size of the conditioning image
+        with Image.open(img_cond_path) as img:
+            width, height = img.size
+        x = self._noise(width, height, seed)
+        with self._on_device(self.t5, self.clip, self.ae):
+            inp = prepare_fill(
+                self.t5,
+                self.clip,
+                x,
+                prompt=prompt,
+                ae=self.ae,
+                img_cond_path=img_cond_path,
+                mask_path=img_mask_path,
+                cache=self.conditioning_cache,
+            )
+        return self._sample("flux-dev-fill", inp, width, height, num_steps, guidance, solver=solver)
+
+    @torch.inference_mode()
+    def generate_control(
+        self,
+        prompt: str,
+        img_cond_path: str,
+        name: str = "flux-dev-canny",
+        width: int = 1024,
+        height: int = 1024,
+        num_steps: int = 50,
+        guidance: float | None = None,
+        seed: int | None = None,
+        lora_scale: float | None = 0.85,
+        solver: str = "euler",
+    ) -> Tensor:
+        if name in ["flux-dev-depth", "flux-dev-depth-lora"]:
+            encoder = self._image_encoder("depth")
+            guidance = 10.0 if guidance is None else guidance
+        elif name in ["flux-dev-canny", "flux-dev-canny-lora"]:
+            encoder = self._image_encoder("canny")
+            guidance = 30.0 if guidance is None else guidance
+        else:
+            raise ValueError(f"Got unknown control model name: {name}")
+
+        if "lora" in name and lora_scale is not None:
+            model = self.get_model(name)
+            # changing the scale re-merges every LoRA layer, skip it if the scale is unchanged
+            if self._lora_scales.get(name) != lora_scale:
+                model.set_lora_scale(float(lora_scale))
+                self._lora_scales[name] = lora_scale
+
+        # allow for packing and conversion to latent space
+        height, width = 16 * (height // 16), 16 * (width // 16)
+        x = self._noise(width, height, seed)
+        with self._on_device(self.t5, self.clip, self.ae):
+            inp = prepare_control(
+                self.t5,
+                self.clip,
+                x,
+                prompt=prompt,
+                ae=self.ae,
+                encoder=encoder,
+                img_cond_path=img_cond_path,
+                cache=self.conditioning_cache,
+            )
+        return self._sample(name, inp, width, height, num_steps, guidance, solver=solver)
+
+    @torch.inference_mode()
+    def generate_redux(
+        self,
+        img_cond_path: str,
+        name: str = "flux-dev",
+        width: int = 1360,
+        height: int = 768,
+        num_steps: int | None = None,
+        guidance: float = 2.5,
+        seed: int | None = None,
+        solver: str = "euler",
+    ) -> Tensor:
+        if num_steps is None:
+            num_steps = 4 if name == "flux-schnell" else 50
+        # allow for packing and conversion to latent space
+        height, width = 16 * (height // 16), 16 * (width // 16)
+        x = self._noise(width, height, seed)
+        with self._on_device(self.t5, self.clip):
+            inp = prepare_redux(
+                self.t5,
+                self.clip,
+                x,
+                prompt="",
+                encoder=self._image_encoder("redux"),
+                img_cond_path=img_cond_path,
+            )
+        return self._sample(name, inp, width, height, num_steps, guidance, solver=solver)
@@ -1,20 +1,34 @@
+import atexit
 import getpass
 import math
+import multiprocessing
 import os
+import queue
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import nullcontext
 from dataclasses import dataclass
 from pathlib import Path
 
+import numpy as np
 import requests
 import torch
 from einops import rearrange
 from huggingface_hub import hf_hub_download, login
 from imwatermark import WatermarkEncoder
 from PIL import ExifTags, Image
-from safetensors.torch import load_file as load_sft
+from safetensors import safe_open
 
 from flux.model import Flux, FluxLoraWrapper, FluxParams
 from flux.modules.autoencoder import AutoEncoder, AutoEncoderParams
-from flux.modules.conditioner import HFEmbedder
+from flux.modules.conditioner import EmbeddingCache, HFEmbedder
+from flux.modules.lora import LinearLora
+from flux.watermark import encode as encode_watermark
+from flux.watermark import encode_frame as encode_watermark_frame
+from flux.watermark import init_worker as init_watermark_worker
 
 CHECKPOINTS_DIR = Path("checkpoints")
 CHECKPOINTS_DIR.mkdir(exist_ok=True)
@@ -240,47 +254,183 @@ def track_usage_via_api(name: str, n=1) -> None:
         print(f"Successfully tracked usage for {name} with {n} generations")
 
 
-def save_image(
+def _save_kwargs(fn: str, quality: int) -> dict:
+    # PIL picks the format from the file extension
+    ext = os.path.splitext(fn)[1].lower()
+    if ext in [".jpg", ".jpeg"]:
+        return {"quality": quality, "subsampling": 0}
+    if ext == ".webp":
+        return {"quality": quality}
+    if ext == ".png":
+        # lossless, the quality doesn't apply
+        return {}
+    raise ValueError(f"Got unsupported output format: {ext}, chose from .jpg, .jpeg, .webp, .png")
+
+
+def _write_image(
     nsfw_classifier,
     name: str,
-    output_name: str,
-    idx: int,
+    fn: str,
     x: torch.Tensor,
     add_sampling_metadata: bool,
     prompt: str,
     nsfw_threshold: float = 0.85,
     track_usage: bool = False,
-) -> int:
-    fn = output_name.format(idx=idx)
-    print(f"Saving {fn}")
-    # bring into PIL format and save
-    x = x.clamp(-1, 1)
-    x = embed_watermark(x.float())
+    quality: int = 95,
+    nsfw_lock: threading.Lock | None = None,
+) -> bool:
+    # expects x clamped to [-1, 1], returns whether the image was written
+    x = embed_watermark(x)
     x = rearrange(x[0], "c h w -> h w c")
 
     img = Image.fromarray((127.5 * (x + 1.0)).cpu().byte().numpy())
     if nsfw_classifier is not None:
-        nsfw_score = [x["score"] for x in nsfw_classifier(img) if x["label"] == "nsfw"][0]
+        with nsfw_lock if nsfw_lock is not None else nullcontext():
+            nsfw_score = [x["score"] for x in nsfw_classifier(img) if x["label"] == "nsfw"][0]
     else:
         nsfw_score = nsfw_threshold - 1.0
 
-    if nsfw_score < nsfw_threshold:
-        exif_data = Image.Exif()
-        if name in ["flux-dev", "flux-schnell"]:
-            exif_data[ExifTags.Base.Software] = "AI generated;txt2img;flux"
-        else:
-            exif_data[ExifTags.Base.Software] = "AI generated;img2img;flux"
-        exif_data[ExifTags.Base.Make] = "Black Forest Labs"
-        exif_data[ExifTags.Base.Model] = name
-        if add_sampling_metadata:
-            exif_data[ExifTags.Base.ImageDescription] = prompt
-        img.save(fn, exif=exif_data, quality=95, subsampling=0)
-        if track_usage:
-            track_usage_via_api(name, 1)
-        idx += 1
-    else:
+    if nsfw_score >= nsfw_threshold:
         print("Your generated image may contain NSFW content.")
+        return False
+
+    exif_data = Image.Exif()
+    if name in ["flux-dev", "flux-schnell"]:
+        exif_data[ExifTags.Base.Software] = "AI generated;txt2img;flux"
+    else:
+        exif_data[ExifTags.Base.Software] = "AI generated;img2img;flux"
+    exif_data[ExifTags.Base.Make] = "Black Forest Labs"
+    exif_data[ExifTags.Base.Model] = name
+    if add_sampling_metadata:
+        exif_data[ExifTags.Base.ImageDescription] = prompt
+    img.save(fn, exif=exif_data, **_save_kwargs(fn, quality))
+    if track_usage:
+        track_usage_via_api(name, 1)
+    return True
+
+
+class ImageWriter:
+    """
+    Watermarks, classifies, encodes and writes images on background threads, so that
+    sampling can move on to the next prompt while the previous image is still being saved.
+
+    At most `max_pending` images wait in the queue; `submit` blocks beyond that so decoded
+    images can't pile up in memory. `flush` waits until everything submitted is on disk, and
+    pending images are also written when the writer is closed or the interpreter exits.
+    Errors raised on the worker threads are raised again by the next `submit` or `flush`.
+    """
+
+    def __init__(self, num_workers: int = 2, max_pending: int = 4):
+        self.saved = 0
+        self.flagged = 0
+        self._queue: queue.Queue[dict | None] = queue.Queue(maxsize=max_pending)
+        self._lock = threading.Lock()
+        # the classifier pipeline is shared by all workers
+        self._nsfw_lock = threading.Lock()
+        self._error: BaseException | None = None
+        self._closed = False
+        self._workers = [threading.Thread(target=self._run, daemon=True) for _ in range(max(1, num_workers))]
+        for worker in self._workers:
+            worker.start()
+        atexit.register(self.close)
+
+    def _run(self) -> None:
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                saved = _write_image(**job, nsfw_lock=self._nsfw_lock)
+                with self._lock:
+                    if saved:
+                        self.saved += 1
+                    else:
+                        self.flagged += 1
+            except BaseException as e:
+                with self._lock:
+                    if self._error is None:
+                        self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _raise_error(self) -> None:
+        with self._lock:
+            error, self._error = self._error, None
+        if error is not None:
+            raise error
+
+    def submit(self, **job) -> None:
+        """
+        Queues an image, takes the keyword arguments of `save_image` without `idx` and
+        `output_name` but with the file name `fn`.
+        """
+        assert not self._closed, "ImageWriter is closed"
+        self._raise_error()
+        self._queue.put(job)
+
+    def flush(self) -> None:
+        self._queue.join()
+        self._raise_error()
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        atexit.unregister(self.close)
+        self._raise_error()
+
+    def __enter__(self) -> "ImageWriter":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+def save_image(
+    nsfw_classifier,
+    name: str,
+    output_name: str,
+    idx: int,
+    x: torch.Tensor,
+    add_sampling_metadata: bool,
+    prompt: str,
+    nsfw_threshold: float = 0.85,
+    track_usage: bool = False,
+    quality: int = 95,
+    writer: ImageWriter | None = None,
+) -> int:
+    """
+    Saves the decoded image `x` to `output_name` formatted with `idx` and returns the next
+    index. The format follows the file extension (jpg, webp or png), `quality` applies to
+    jpg and webp.
 
+    With a `writer` the image is only moved to the CPU here and saved in the background. The
+    index is then advanced even if the image ends up flagged, since that isn't known yet.
+    """
+    fn = output_name.format(idx=idx)
+    x = x.clamp(-1, 1).float()
+    job = dict(
+        nsfw_classifier=nsfw_classifier,
+        name=name,
+        fn=fn,
+        add_sampling_metadata=add_sampling_metadata,
+        prompt=prompt,
+        nsfw_threshold=nsfw_threshold,
+        track_usage=track_usage,
+        quality=quality,
+    )
+    if writer is not None:
+        print(f"Queued {fn}")
+        writer.submit(x=x.cpu(), **job)
+        return idx + 1
+
+    print(f"Saving {fn}")
+    if _write_image(x=x, **job):
+        idx += 1
     return idx
 
 
@@ -654,48 +804,132 @@ def print_load_warning(missing: list[str], unexpected: list[str]) -> None:
         print(f"Got {len(unexpected)} unexpected keys:\n\t" + "\n\t".join(unexpected))
 
 
-def load_flow_model(name: str, device: str | torch.device = "cuda", verbose: bool = True) -> Flux:
+def _block_prefix(key: str) -> str:
+    # "double_blocks.3.img_attn.qkv.weight" -> "double_blocks.3", "img_in.weight" -> "img_in"
+    parts = key.split(".")
+    return ".".join(parts[:2]) if len(parts) > 2 and parts[1].isdigit() else parts[0]
+
+
+def load_checkpoint_streamed(
+    model: torch.nn.Module, ckpt_path: str, device: str | torch.device = "cuda", keep_mmap: bool = False
+) -> tuple[list[str], list[str]]:
+    """
+    Loads a safetensors checkpoint into a (meta-initialized) model one block at a time.
+
+    The file is memory-mapped and the tensors of each top-level block (e.g. `double_blocks.3`)
+    are materialized on `device` and assigned before the next block is read, so the loader
+    never holds more than one block in addition to the model. With `keep_mmap` (CPU only) the
+    parameters stay backed by the mapped file, so the pages are shared with other processes
+    loading the same checkpoint through the OS page cache.
+
+    Returns the missing and unexpected keys like `load_state_dict` and prints the time spent
+    in each phase.
+    """
+    device = torch.device(device)
+    if keep_mmap and device.type != "cpu":
+        raise ValueError(f"keep_mmap is only supported on CPU, got device {device}")
+
+    timings = defaultdict(float)
+    start = time.perf_counter()
+    model_keys = set(model.state_dict().keys())
+    with safe_open(ckpt_path, framework="pt", device="cpu") as f:
+        file_keys = list(f.keys())
+        blocks: dict[str, list[str]] = defaultdict(list)
+        for key in file_keys:
+            if key in model_keys:
+                blocks[_block_prefix(key)].append(key)
+        timings["index"] = time.perf_counter() - start
+
+        for keys in blocks.values():
+            t = time.perf_counter()
+            block_sd = {key: f.get_tensor(key) for key in keys}
+            timings["read"] += time.perf_counter() - t
+
+            t = time.perf_counter()
+            if not keep_mmap:
+                block_sd = {key: value.to(device, copy=True) for key, value in block_sd.items()}
+            timings["materialize"] += time.perf_counter() - t
+
+            t = time.perf_counter()
+            block_sd = optionally_expand_state_dict(model, block_sd)
+            model.load_state_dict(block_sd, strict=False, assign=True)
+            timings["assign"] += time.perf_counter() - t
+
+    phases = ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in timings.items())
+    print(f"Loaded {ckpt_path} in {time.perf_counter() - start:.2f}s ({phases})")
+
+    missing = sorted(model_keys.difference(file_keys))
+    unexpected = sorted(set(file_keys).difference(model_keys))
+    return missing, unexpected
+
+
+def load_flow_model(
+    name: str,
+    device: str | torch.device = "cuda",
+    verbose: bool = True,
+    merge_lora: bool = True,
+    keep_mmap: bool = False,
+    keep_lora_base_weight: bool = False,
+) -> Flux:
     # Loading Flux
     print("Init model")
     config = configs[name]
 
     ckpt_path = str(get_checkpoint_path(config.repo_id, config.repo_flow, "FLUX_MODEL"))
 
+    start = time.perf_counter()
     with torch.device("meta"):
         if config.lora_repo_id is not None and config.lora_filename is not None:
             model = FluxLoraWrapper(params=config.params).to(torch.bfloat16)
         else:
             model = Flux(config.params).to(torch.bfloat16)
+    print(f"Init model in {time.perf_counter() - start:.2f}s")
 
     print(f"Loading checkpoint: {ckpt_path}")
-    # load_sft doesn't support torch.device
-    sd = load_sft(ckpt_path, device=str(device))
-    sd = optionally_expand_state_dict(model, sd)
-    missing, unexpected = model.load_state_dict(sd, strict=False, assign=True)
+    missing, unexpected = load_checkpoint_streamed(model, ckpt_path, device, keep_mmap=keep_mmap)
     if verbose:
         print_load_warning(missing, unexpected)
 
     if config.lora_repo_id is not None and config.lora_filename is not None:
         print("Loading LoRA")
         lora_path = str(get_checkpoint_path(config.lora_repo_id, config.lora_filename, "FLUX_LORA"))
-        lora_sd = load_sft(lora_path, device=str(device))
         # loading the lora params + overwriting scale values in the norms
-        missing, unexpected = model.load_state_dict(lora_sd, strict=False, assign=True)
+        missing, unexpected = load_checkpoint_streamed(model, lora_path, device, keep_mmap=keep_mmap)
         if verbose:
             print_load_warning(missing, unexpected)
+        if merge_lora:
+            # run inference at plain linear cost, `set_lora_scale` adds the change of the update.
+            # Keeping the base weights makes that exact, but costs a CPU copy of the transformer
+            model.merge_lora(keep_base_weight=keep_lora_base_weight)
     return model
 
 
-def load_t5(device: str | torch.device = "cuda", max_length: int = 512) -> HFEmbedder:
+def load_t5(
+    device: str | torch.device = "cuda",
+    max_length: int = 512,
+    cache: EmbeddingCache | None = None,
+    length_buckets: list[int] | None = None,
+) -> HFEmbedder:
     # max length 64, 128, 256 and 512 should work (if your sequence is short enough)
-    return HFEmbedder("google/t5-v1_1-xxl", max_length=max_length, torch_dtype=torch.bfloat16).to(device)
+    # with `length_buckets` (e.g. T5_LENGTH_BUCKETS) each batch is only padded to the
+    # smallest bucket that fits its longest prompt, which also shortens the txt sequence
+    # of the transformer
+    return HFEmbedder(
+        "google/t5-v1_1-xxl",
+        max_length=max_length,
+        cache=cache,
+        length_buckets=length_buckets,
+        torch_dtype=torch.bfloat16,
+    ).to(device)
 
 
-def load_clip(device: str | torch.device = "cuda") -> HFEmbedder:
-    return HFEmbedder("openai/clip-vit-large-patch14", max_length=77, torch_dtype=torch.bfloat16).to(device)
+def load_clip(device: str | torch.device = "cuda", cache: EmbeddingCache | None = None) -> HFEmbedder:
+    return HFEmbedder(
+        "openai/clip-vit-large-patch14", max_length=77, cache=cache, torch_dtype=torch.bfloat16
+    ).to(device)
 
 
-def load_ae(name: str, device: str | torch.device = "cuda") -> AutoEncoder:
+def load_ae(name: str, device: str | torch.device = "cuda", keep_mmap: bool = False) -> AutoEncoder:
     config = configs[name]
     ckpt_path = str(get_checkpoint_path(config.repo_id, config.repo_ae, "FLUX_AE"))
 
@@ -705,8 +939,7 @@ def load_ae(name: str, device: str | torch.device = "cuda") -> AutoEncoder:
         ae = AutoEncoder(config.ae_params)
 
     print(f"Loading AE checkpoint: {ckpt_path}")
-    sd = load_sft(ckpt_path, device=str(device))
-    missing, unexpected = ae.load_state_dict(sd, strict=False, assign=True)
+    missing, unexpected = load_checkpoint_streamed(ae, ckpt_path, device, keep_mmap=keep_mmap)
     print_load_warning(missing, unexpected)
     return ae
 
@@ -730,12 +963,132 @@ def optionally_expand_state_dict(model: torch.nn.Module, state_dict: dict) -> di
     return state_dict
 
 
+def _replace_linear_with_int8(module: torch.nn.Module) -> None:
+    for name, child in module.named_children():
+        if isinstance(child, torch.nn.Linear):
+            # merged LoRA layers behave like plain linears
+            if isinstance(child, LinearLora) and not child.merged:
+                child.merge()
+            linear = torch.nn.Linear(child.in_features, child.out_features, bias=child.bias is not None)
+            linear.weight = torch.nn.Parameter(child.weight.detach().float(), requires_grad=False)
+            if child.bias is not None:
+                linear.bias = torch.nn.Parameter(child.bias.detach().float(), requires_grad=False)
+            linear.qconfig = torch.ao.quantization.default_dynamic_qconfig
+            setattr(module, name, torch.ao.nn.quantized.dynamic.Linear.from_float(linear))
+        else:
+            _replace_linear_with_int8(child)
+
+
+def quantize_int8_dynamic(module: torch.nn.Module) -> torch.nn.Module:
+    """
+    Prepares a module for CPU inference with int8 dynamic quantization: every `nn.Linear`
+    is replaced by a linear with int8 weights whose inputs are quantized on the fly, and all
+    remaining parameters are converted to float32, the activation dtype of these kernels.
+    The linears are converted one at a time, so no float32 copy of the whole model is made.
+
+    For `HFEmbedder`s the embeddings are returned in float32 as well.
+    """
+    _replace_linear_with_int8(module)
+    module = module.float()
+    if isinstance(module, HFEmbedder):
+        module.output_dtype = torch.float32
+    return module
+
+
+class PeakMemoryCounter:
+    """
+    Context manager that records the peak memory used on `device` while it is active.
+
+    On CUDA this is the peak of the caching allocator above the memory allocated on entry.
+    On CPU the current resident set size of the process is polled every `interval` seconds
+    from a background thread and the peak above the size on entry is reported, so short
+    spikes between two samples can be missed. Without /proc (e.g. on macOS) the growth of
+    the lifetime peak resident set size is used instead, which only increases once the
+    previous peak of the process is exceeded.
+    """
+
+    def __init__(self, device: str | torch.device, interval: float = 0.01):
+        self.device = torch.device(device)
+        self.interval = interval
+        self.peak_bytes = 0
+
+    def _cpu_max_rss(self) -> int:
+        import resource
+
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is reported in bytes on macOS and in kilobytes everywhere else
+        return max_rss if sys.platform == "darwin" else 1024 * max_rss
+
+    @staticmethod
+    def _cpu_rss() -> int | None:
+        try:
+            with open("/proc/self/statm") as f:
+                # the second field is the number of resident pages
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except OSError:
+            return None
+
+    def _poll_rss(self) -> None:
+        while not self._stop.wait(self.interval):
+            self._peak_rss = max(self._peak_rss, self._cpu_rss())
+
+    def __enter__(self) -> "PeakMemoryCounter":
+        self._poller = None
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+            torch.cuda.reset_peak_memory_stats(self.device)
+            self._start = torch.cuda.memory_allocated(self.device)
+        elif (rss := self._cpu_rss()) is not None:
+            self._start = self._peak_rss = rss
+            self._stop = threading.Event()
+            self._poller = threading.Thread(target=self._poll_rss, daemon=True)
+            self._poller.start()
+        else:
+            self._start = self._cpu_max_rss()
+        return self
+
+    def __exit__(self, *args) -> None:
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+            self.peak_bytes = torch.cuda.max_memory_allocated(self.device) - self._start
+        elif self._poller is not None:
+            self._stop.set()
+            self._poller.join()
+            self.peak_bytes = max(self._peak_rss, self._cpu_rss()) - self._start
+        else:
+            self.peak_bytes = self._cpu_max_rss() - self._start
+
+    def __str__(self) -> str:
+        return f"{self.peak_bytes / 2**30:.2f}GiB"
+
+
 class WatermarkEmbedder:
-    def __init__(self, watermark):
+    def __init__(self, watermark, num_workers: int = min(8, os.cpu_count() or 1)):
         self.watermark = watermark
         self.num_bits = len(WATERMARK_BITS)
         self.encoder = WatermarkEncoder()
         self.encoder.set_watermark("bits", self.watermark)
+        # batches are encoded in this many processes, see `flux.watermark`
+        self.num_workers = num_workers
+        self._pool = None
+        self._async_executor = None
+        # the executors are created on first use, possibly from several ImageWriter threads
+        self._lock = threading.Lock()
+
+    def _encode_batch(self, images_bgr: np.ndarray) -> list[np.ndarray]:
+        if len(images_bgr) == 1 or self.num_workers <= 1:
+            return [encode_watermark_frame(self.encoder, image_bgr) for image_bgr in images_bgr]
+
+        with self._lock:
+            if self._pool is None:
+                # spawn, forking a process that has initialized CUDA is not safe
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.num_workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=init_watermark_worker,
+                    initargs=(self.watermark,),
+                )
+        return list(self._pool.map(encode_watermark, images_bgr))
 
     def __call__(self, image: torch.Tensor) -> torch.Tensor:
         """
@@ -747,24 +1100,31 @@ class WatermarkEmbedder:
         Returns:
             same as input but watermarked
         """
-        image = 0.5 * image + 0.5
-        squeeze = len(image.shape) == 4
-        if squeeze:
-            image = image[None, ...]
-        n = image.shape[0]
-        image_np = rearrange((255 * image).detach().cpu(), "n b c h w -> (n b) h w c").numpy()[:, :, :, ::-1]
-        # torch (b, c, h, w) in [0, 1] -> numpy (b, h, w, c) [0, 255]
-        # watermarking libary expects input as cv2 BGR format
-        for k in range(image_np.shape[0]):
-            image_np[k] = self.encoder.encode(image_np[k], "dwtDct")
-        image = torch.from_numpy(rearrange(image_np[:, :, :, ::-1], "(n b) h w c -> n b c h w", n=n)).to(
-            image.device
+        # torch (..., c, h, w) in [-1, 1] -> numpy uint8 (b, h, w, c), the frames sent to the pool
+        image_np = (
+            ((rearrange(image.detach(), "... c h w -> (...) h w c").float() + 1.0) * 127.5)
+            .round_()
+            .clamp_(0, 255)
+            .to(torch.uint8)
+            .cpu()
+            .numpy()
         )
-        image = torch.clamp(image / 255, min=0.0, max=1.0)
-        if squeeze:
-            image = image[0]
-        image = 2 * image - 1
-        return image
+        # watermarking libary expects input as cv2 BGR format, flipping is a view
+        encoded = self._encode_batch(image_np[..., ::-1])
+
+        encoded = torch.from_numpy(np.ascontiguousarray(np.stack(encoded)[..., ::-1]))
+        encoded = rearrange(encoded, "b h w c -> b c h w").reshape(image.shape)
+        return encoded.to(image.device, torch.float32).div_(127.5).sub_(1.0)
+
+    def embed_async(self, image: torch.Tensor) -> Future:
+        """
+        Watermarks `image` on a background thread, e.g. after the response of a request has
+        been produced. Returns a future of the watermarked image.
+        """
+        with self._lock:
+            if self._async_executor is None:
+                self._async_executor = ThreadPoolExecutor(max_workers=1)
+        return self._async_executor.submit(self, image)
 
 
 # A fixed 48-bit message that was chosen at random
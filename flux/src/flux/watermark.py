@@ -0,0 +1,34 @@
+"""
+Watermark encoding of `flux.util.WatermarkEmbedder`, in the calling process or in its pool.
+
+The dwtDct encoder of imwatermark is mostly Python code that holds the GIL, so batches are
+encoded in separate processes. They are started with spawn, which re-imports the `__main__`
+module of the parent in every worker (e.g. the CLI and torch for `python -m flux`), so the
+pool is created once and kept for the life of the embedder. Frames are exchanged as uint8,
+a quarter of the size of float32 frames.
+"""
+
+import numpy as np
+from imwatermark import WatermarkEncoder
+
+# encoder of the current worker process
+_encoder: WatermarkEncoder | None = None
+
+
+def init_worker(watermark: list[int]) -> None:
+    global _encoder
+    _encoder = WatermarkEncoder()
+    _encoder.set_watermark("bits", watermark)
+
+
+def encode_frame(encoder: WatermarkEncoder, image_bgr: np.ndarray) -> np.ndarray:
+    """
+    Watermarks a uint8 (h, w, BGR) frame. The encoder works in float32 and its output is
+    rounded back to uint8, so the calling process and the workers give the same result.
+    """
+    encoded = encoder.encode(image_bgr.astype(np.float32), "dwtDct")
+    return np.clip(np.rint(encoded), 0, 255).astype(np.uint8)
+
+
+def encode(image_bgr: np.ndarray) -> np.ndarray:
+    return encode_frame(_encoder, image_bgr)
@@ -0,0 +1,40 @@
+import pytest
+import torch
+
+from flux.model import Flux, FluxParams
+from flux.sampling import get_img_ids
+
+
+@pytest.fixture
+def tiny_flux() -> Flux:
+    """A randomly initialized two plus two block model that runs on the CPU in float32"""
+    torch.manual_seed(0)
+    params = FluxParams(
+        in_channels=16,
+        out_channels=16,
+        vec_in_dim=32,
+        context_in_dim=32,
+        hidden_size=64,
+        mlp_ratio=4.0,
+        num_heads=4,
+        depth=2,
+        depth_single_blocks=2,
+        axes_dim=[4, 6, 6],
+        theta=10_000,
+        qkv_bias=True,
+        guidance_embed=True,
+    )
+    return Flux(params).eval()
+
+
+@pytest.fixture
+def tiny_inputs() -> dict[str, torch.Tensor]:
+    """Inputs of `denoise` for an 8x8 token latent and 8 text tokens"""
+    torch.manual_seed(1)
+    return {
+        "img": torch.randn(1, 64, 16),
+        "img_ids": get_img_ids(8, 8, 1).clone(),
+        "txt": torch.randn(1, 8, 32),
+        "txt_ids": torch.zeros(1, 8, 3),
+        "vec": torch.randn(1, 32),
+    }
@@ -0,0 +1,75 @@
+import pytest
+import torch
+
+from flux.modules.autoencoder import AutoEncoder, AutoEncoderParams, tiled_apply
+
+# tiles see a different receptive field at their borders and GroupNorm/attention statistics
+# of their own part of the image, so tiled results only match the full frame approximately
+TOLERANCE = 0.1
+
+
+@pytest.fixture
+def tiny_ae() -> AutoEncoder:
+    torch.manual_seed(0)
+    params = AutoEncoderParams(
+        resolution=128,
+        in_channels=3,
+        ch=32,
+        out_ch=3,
+        ch_mult=[1, 2],
+        num_res_blocks=1,
+        z_channels=4,
+        scale_factor=0.3611,
+        shift_factor=0.1159,
+    )
+    ae = AutoEncoder(params).eval()
+    ae.set_tiling(tile_size=64, tile_overlap=32, pixel_threshold=None)
+    return ae
+
+
+def smooth_image(size: int = 128) -> torch.Tensor:
+    # low frequency content, like a natural image and unlike white noise
+    torch.manual_seed(1)
+    coarse = torch.rand(1, 3, size // 16, size // 16) * 2 - 1
+    return torch.nn.functional.interpolate(coarse, size=(size, size), mode="bicubic").clamp(-1, 1)
+
+
+def relative_error(output: torch.Tensor, reference: torch.Tensor) -> float:
+    return ((output - reference).abs().mean() / reference.abs().mean()).item()
+
+
+def test_tiled_apply_is_exact_for_pointwise_functions():
+    x = torch.randn(1, 4, 40, 56)
+    y = tiled_apply(
+        lambda t: t.repeat_interleave(2, -1).repeat_interleave(2, -2), x, tile=16, overlap=6, scale_num=2
+    )
+    torch.testing.assert_close(y, x.repeat_interleave(2, -1).repeat_interleave(2, -2))
+
+
+def test_tiled_encode_matches_full_frame(tiny_ae):
+    x = smooth_image()
+    with torch.inference_mode():
+        reference = tiny_ae.encode(x)
+        tiled = tiny_ae.tiled_encode(x)
+
+    assert tiled.shape == reference.shape
+    error = relative_error(tiled, reference)
+    assert error < TOLERANCE, f"relative error {error:.4f}"
+
+
+def test_tiled_decode_matches_full_frame(tiny_ae):
+    with torch.inference_mode():
+        z = tiny_ae.encode(smooth_image())
+        reference = tiny_ae.decode(z)
+        tiled = tiny_ae.tiled_decode(z)
+
+    assert tiled.shape == reference.shape
+    error = relative_error(tiled, reference)
+    assert error < TOLERANCE, f"relative error {error:.4f}"
+
+
+def test_decode_switches_to_tiles_above_the_threshold(tiny_ae):
+    tiny_ae.set_tiling(tile_size=64, tile_overlap=32, pixel_threshold=64 * 64)
+    z = torch.randn(1, 4, 64, 64)
+    with torch.inference_mode():
+        torch.testing.assert_close(tiny_ae.decode(z), tiny_ae.tiled_decode(z))
@@ -0,0 +1,46 @@
+import torch
+
+from flux.model import FirstBlockCache
+from flux.sampling import denoise, get_schedule
+
+NUM_STEPS = 30
+
+
+def sample(model, inputs, first_block_cache=None) -> torch.Tensor:
+    timesteps = get_schedule(NUM_STEPS, inputs["img"].shape[1])
+    with torch.inference_mode():
+        return denoise(
+            model, **inputs, timesteps=timesteps, guidance=3.5, first_block_cache=first_block_cache
+        )
+
+
+def relative_error(output: torch.Tensor, reference: torch.Tensor) -> float:
+    return ((output - reference).abs().mean() / reference.abs().mean()).item()
+
+
+def test_default_threshold_stays_close_to_full_model(tiny_flux, tiny_inputs):
+    reference = sample(tiny_flux, tiny_inputs)
+    cache = FirstBlockCache()
+    output = sample(tiny_flux, tiny_inputs, first_block_cache=cache)
+
+    assert cache.steps == NUM_STEPS
+    error = relative_error(output, reference)
+    assert error < 0.05, f"relative error {error:.4f} with {cache.skipped_steps} skipped steps"
+
+
+def test_zero_threshold_never_skips(tiny_flux, tiny_inputs):
+    reference = sample(tiny_flux, tiny_inputs)
+    cache = FirstBlockCache(threshold=0.0)
+    output = sample(tiny_flux, tiny_inputs, first_block_cache=cache)
+
+    assert cache.skipped_steps == 0
+    torch.testing.assert_close(output, reference)
+
+
+def test_huge_threshold_skips_all_but_first_step(tiny_flux, tiny_inputs):
+    cache = FirstBlockCache(threshold=float("inf"))
+    output = sample(tiny_flux, tiny_inputs, first_block_cache=cache)
+
+    assert cache.steps == NUM_STEPS
+    assert cache.skipped_steps == NUM_STEPS - 1
+    assert torch.isfinite(output).all()
@@ -0,0 +1,21 @@
+import copy
+
+import torch
+
+from flux.sampling import denoise, get_schedule
+from flux.util import quantize_int8_dynamic
+
+
+def test_int8_transformer_stays_close_to_float32(tiny_flux, tiny_inputs):
+    quantized = quantize_int8_dynamic(copy.deepcopy(tiny_flux))
+
+    assert not any(type(m) is torch.nn.Linear for m in quantized.modules())
+    assert all(p.dtype == torch.float32 for p in quantized.parameters())
+
+    timesteps = get_schedule(10, tiny_inputs["img"].shape[1])
+    with torch.inference_mode():
+        reference = denoise(tiny_flux, **tiny_inputs, timesteps=timesteps, guidance=3.5)
+        output = denoise(quantized, **tiny_inputs, timesteps=timesteps, guidance=3.5)
+
+    error = ((output - reference).abs().mean() / reference.abs().mean()).item()
+    assert error < 0.05, f"relative error {error:.4f}"
@@ -0,0 +1,143 @@
+import pytest
+import torch
+from safetensors.torch import load_file, save_file
+from torch import nn
+
+from flux.modules.lora import LinearLora, LoraAdapterRegistry
+
+
+def tiny_model() -> nn.Module:
+    torch.manual_seed(0)
+    model = nn.ModuleDict(
+        {
+            "img_attn": nn.ModuleDict({"qkv": nn.Linear(16, 48)}),
+            "proj": nn.Linear(48, 16, bias=False),
+        }
+    )
+    return model.to(torch.bfloat16)
+
+
+def snapshot(model: nn.Module) -> dict[str, torch.Tensor]:
+    return {k: v.detach().clone() for k, v in model.state_dict().items()}
+
+
+@pytest.fixture
+def registry(tmp_path) -> LoraAdapterRegistry:
+    torch.manual_seed(1)
+    rank = 4
+    # PEFT layout with a bias
+    save_file(
+        {
+            "img_attn.qkv.lora_A.weight": torch.randn(rank, 16, dtype=torch.bfloat16),
+            "img_attn.qkv.lora_B.weight": torch.randn(48, rank, dtype=torch.bfloat16),
+            "img_attn.qkv.lora_B.bias": torch.randn(48, dtype=torch.bfloat16),
+        },
+        str(tmp_path / "peft.safetensors"),
+    )
+    # diffusers prefix
+    save_file(
+        {
+            "transformer.proj.lora_A.weight": torch.randn(rank, 48, dtype=torch.bfloat16),
+            "transformer.proj.lora_B.weight": torch.randn(16, rank, dtype=torch.bfloat16),
+        },
+        str(tmp_path / "diffusers.safetensors"),
+    )
+    # kohya layout with alpha
+    save_file(
+        {
+            "lora_unet_img_attn_qkv.lora_down.weight": torch.randn(rank, 16, dtype=torch.bfloat16),
+            "lora_unet_img_attn_qkv.lora_up.weight": torch.randn(48, rank, dtype=torch.bfloat16),
+            "lora_unet_img_attn_qkv.alpha": torch.tensor(2.0),
+        },
+        str(tmp_path / "kohya.safetensors"),
+    )
+
+    registry = LoraAdapterRegistry(tiny_model())
+    for name in ["peft", "diffusers", "kohya"]:
+        registry.register(name, str(tmp_path / f"{name}.safetensors"))
+    return registry
+
+
+def test_activate_deactivate_round_trip(registry):
+    original = snapshot(registry.model)
+    for scales in [
+        {"peft": 1.0, "kohya": 0.5},
+        {"peft": 0.3, "diffusers": 1.0},
+        {"kohya": 1.0},
+        {"peft": 0.7, "diffusers": 0.2, "kohya": 0.9},
+    ] * 5:
+        registry.activate(scales)
+        assert registry.active == scales
+    registry.deactivate()
+
+    assert registry.active == {}
+    for key, value in snapshot(registry.model).items():
+        assert torch.equal(value, original[key]), key
+
+
+def test_alpha_scaling(registry, tmp_path):
+    base = registry.model.get_submodule("img_attn.qkv").weight.detach().clone()
+    registry.activate({"kohya": 1.0})
+
+    sd = load_file(str(tmp_path / "kohya.safetensors"))
+    up, down = sd["lora_unet_img_attn_qkv.lora_up.weight"], sd["lora_unet_img_attn_qkv.lora_down.weight"]
+    expected = (base.float() + 2.0 / 4 * (up.float() @ down.float())).to(torch.bfloat16)
+    assert torch.equal(registry.model.get_submodule("img_attn.qkv").weight, expected)
+
+
+def test_failed_activate_leaves_weights_untouched(registry):
+    registry.activate({"peft": 1.0})
+    applied = snapshot(registry.model)
+
+    with pytest.raises(KeyError):
+        registry.activate({"diffusers": 1.0, "missing": 1.0})
+
+    assert registry.active == {"peft": 1.0}
+    for key, value in snapshot(registry.model).items():
+        assert torch.equal(value, applied[key]), key
+
+
+def test_unsupported_keys_are_rejected(registry, tmp_path):
+    save_file(
+        {
+            "lora_te1_text_model_encoder_layers_0_mlp_fc1.lora_down.weight": torch.randn(4, 16),
+            "lora_te1_text_model_encoder_layers_0_mlp_fc1.lora_up.weight": torch.randn(16, 4),
+        },
+        str(tmp_path / "te.safetensors"),
+    )
+    registry.register("te", str(tmp_path / "te.safetensors"))
+    original = snapshot(registry.model)
+
+    with pytest.raises(ValueError, match="don't belong to a linear layer"):
+        registry.activate({"te": 1.0})
+    for key, value in snapshot(registry.model).items():
+        assert torch.equal(value, original[key]), key
+
+
+def random_lora(scale: float = 1.0) -> LinearLora:
+    torch.manual_seed(2)
+    lora = LinearLora(
+        16, 48, bias=True, rank=4, dtype=torch.bfloat16, device=torch.device("cpu"), scale=scale
+    )
+    with torch.no_grad():
+        for p in lora.parameters():
+            p.normal_()
+    return lora
+
+
+@pytest.mark.parametrize("keep_base_weight", [False, True])
+def test_set_scale_matches_merging_at_that_scale(keep_base_weight):
+    lora = random_lora()
+    lora.merge(keep_base_weight=keep_base_weight)
+    for scale in [0.3, 0.85, 1.0, 0.5] * 5:
+        lora.set_scale(scale)
+
+    reference = random_lora(scale=0.5)
+    reference.merge()
+    assert (lora._base_weight is not None) == keep_base_weight
+    if keep_base_weight:
+        assert torch.equal(lora.weight, reference.weight)
+    else:
+        # one bfloat16 rounding per scale change
+        torch.testing.assert_close(lora.weight, reference.weight, atol=0.25, rtol=0.05)
+    torch.testing.assert_close(lora.bias, reference.bias, atol=0.25, rtol=0.05)
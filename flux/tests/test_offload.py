@@ -0,0 +1,91 @@
+import time
+
+import pytest
+import torch
+from torch import nn
+
+from flux.offload import BlockStreamer
+
+NUM_BLOCKS = 6
+DELAY = 0.02
+
+
+class SlowStreamer(BlockStreamer):
+    """Simulates a slow device on CPU: every transfer sleeps and is recorded by block index"""
+
+    def __init__(self, blocks, window):
+        self.transfers: list[int] = []
+        super().__init__(blocks, "cpu", window=window)
+
+    def transfer(self, tensors):
+        time.sleep(DELAY)
+        self.transfers.append(next(i for i, offloaded in enumerate(self._offloaded) if offloaded is tensors))
+        # fresh copies, so device copies can be told apart from the offloaded weights
+        return [t.clone() for t in tensors]
+
+
+def make_blocks() -> list[nn.Module]:
+    torch.manual_seed(0)
+    return [nn.Linear(8, 8) for _ in range(NUM_BLOCKS)]
+
+
+def resident(streamer: BlockStreamer) -> list[int]:
+    return [
+        i
+        for i, block in enumerate(streamer.blocks)
+        if block.weight.data_ptr() != streamer._offloaded[i][0].data_ptr()
+    ]
+
+
+@pytest.mark.parametrize("window", [1, 2, 3])
+def test_prefetch_order_and_eviction(window):
+    blocks = make_blocks()
+    x = torch.randn(2, 8)
+    with torch.inference_mode():
+        expected = x
+        for block in blocks:
+            expected = block(expected)
+
+        streamer = SlowStreamer(blocks, window=window)
+        out = x
+        for i, block in enumerate(streamer):
+            # only the running block holds device copies, the next ones are in flight
+            assert resident(streamer) == [i]
+            assert sorted(streamer._pending) == list(range(i + 1, min(i + window, NUM_BLOCKS)))
+            out = block(out)
+            # simulated compute, which the transfers of the next blocks overlap with
+            time.sleep(DELAY)
+
+    assert streamer.transfers == list(range(NUM_BLOCKS))
+    assert resident(streamer) == []
+    torch.testing.assert_close(out, expected)
+
+
+def test_prefetch_overlaps_compute():
+    streamer = SlowStreamer(make_blocks(), window=2)
+    for _ in streamer:
+        time.sleep(DELAY)
+    # only the first transfer can't be hidden behind the compute of an earlier block
+    assert streamer.wait_time < (NUM_BLOCKS - 1) * DELAY / 2
+
+
+def test_stopping_early_evicts_all_blocks():
+    streamer = SlowStreamer(make_blocks(), window=3)
+    iterator = iter(streamer)
+    next(iterator)
+    next(iterator)
+    iterator.close()
+
+    assert streamer._pending == {}
+    assert resident(streamer) == []
+
+
+class WrappedTensor(torch.Tensor):
+    pass
+
+
+def test_rejects_tensor_subclasses():
+    block = nn.Linear(8, 8)
+    block.register_buffer("scale", torch.ones(8).as_subclass(WrappedTensor))
+    with pytest.raises(ValueError, match="scale"):
+        BlockStreamer([nn.Linear(8, 8), block], "cpu")
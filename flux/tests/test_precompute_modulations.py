@@ -0,0 +1,22 @@
+import pytest
+import torch
+
+from flux.sampling import denoise, get_schedule
+
+
+@pytest.mark.parametrize("solver", ["euler", "midpoint"])
+def test_precomputed_modulations_match_per_step(tiny_flux, tiny_inputs, solver):
+    timesteps = get_schedule(8, tiny_inputs["img"].shape[1])
+    with torch.inference_mode():
+        reference = denoise(tiny_flux, **tiny_inputs, timesteps=timesteps, guidance=3.5, solver=solver)
+        output = denoise(
+            tiny_flux,
+            **tiny_inputs,
+            timesteps=timesteps,
+            guidance=3.5,
+            precompute_modulations=True,
+            solver=solver,
+        )
+
+    # the batched linears may sum in a different order than the per-step ones
+    torch.testing.assert_close(output, reference, atol=1e-5, rtol=1e-4)
@@ -0,0 +1,41 @@
+import pytest
+import torch
+
+from flux.math import apply_rope, apply_rope_cos_sin, rope_cos_sin
+from flux.modules.layers import EmbedND
+from flux.sampling import get_img_ids
+
+
+def rope_inputs(dtype: torch.dtype) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    torch.manual_seed(0)
+    # head dim 128 split over the axes like the released models, on a 16x16 token latent
+    pe = EmbedND(dim=128, theta=10_000, axes_dim=[16, 56, 56])(get_img_ids(16, 16, 1))
+    q = torch.randn(1, 4, 256, 128, dtype=dtype)
+    k = torch.randn(1, 4, 256, 128, dtype=dtype)
+    return q, k, pe
+
+
+@pytest.mark.parametrize(
+    ("dtype", "atol", "rtol"),
+    [(torch.float32, 1e-5, 1e-5), (torch.bfloat16, 3e-2, 2e-2)],
+)
+def test_cos_sin_matches_rotation_matrices(dtype, atol, rtol):
+    q, k, pe = rope_inputs(dtype)
+    q_ref, k_ref = apply_rope(q, k, pe)
+    q_out, k_out = apply_rope_cos_sin(q, k, *rope_cos_sin(pe, dtype))
+
+    assert q_out.dtype == k_out.dtype == dtype
+    torch.testing.assert_close(q_out, q_ref, atol=atol, rtol=rtol)
+    torch.testing.assert_close(k_out, k_ref, atol=atol, rtol=rtol)
+
+
+def test_bfloat16_error_is_a_rounding_error():
+    q, k, pe = rope_inputs(torch.bfloat16)
+    q_exact, _ = apply_rope(q.float(), k.float(), pe)
+    q_ref, _ = apply_rope(q, k, pe)
+    q_out, _ = apply_rope_cos_sin(q, k, *rope_cos_sin(pe, torch.bfloat16))
+
+    # within a few roundings of the float32 result, not a systematic deviation
+    ref_error = (q_ref.float() - q_exact).abs().mean()
+    error = (q_out.float() - q_exact).abs().mean()
+    assert error < 8 * ref_error